@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import json, math, os, threading, time
+
+import config, encoder, support
+
+############################################################################
+####                   GLOBAL VARIABLES AND CONSTANTS                   ####
+############################################################################
+
+LOGGER = None
+
+ACCOUNTING_FILE = "accounting.json"                             # Counters saved under BAK_PATH, reloaded at start
+TRAFFIC_CLASSES = ("telemetry", "backlog", "config", "firmware", "logs")
+
+COUNTERS = {}                                                   # Day -> interface -> class -> [payload, overhead] bytes
+COUNTERS_LOCK = threading.Lock()                                # Uplink scheduler and supervisor (updater) count together
+CURRENT_DAY = ""                                                # Day of the last counted transfer (rollover summary)
+T_LAST_SAVE = 0
+KEEP_DAYS = 62                                                  # Days of counters kept: the current and the last month
+
+HTTP_REQUEST_OVERHEAD = 1500                                    # Request and response headers, TCP handshake and teardown
+TCP_SEGMENT_SIZE = 1460                                         # Payload of a full TCP segment
+TCP_IP_OVERHEAD = 40                                            # IP and TCP headers of each segment
+
+    ############################ DATA ACCOUNTING ###################################
+    #   Bytes are counted per UTC day, interface ("gsm", "wlan0") and traffic      #
+    #   class. Payload is what the application sends or receives (UDP: nonce and   #
+    #   ciphertext, HTTP: body), overhead is an estimate of the protocol headers   #
+    #   the operator bills too. Only GSM has budgets (config.GSM_*_BUDGET):        #
+    #   transfers over them are held back, wlan0 is never limited                  #
+    ################################################################################
+
+############################################################################
+####                              FUNCTIONS                             ####
+############################################################################
+
+def init_accounter():
+
+    global LOGGER, CURRENT_DAY, T_LAST_SAVE
+
+    LOGGER = support.CustomLogger("acc")
+
+    try:
+        with open(config.BAK_PATH+ACCOUNTING_FILE, "r") as accounting_file:
+            saved = json.load(accounting_file)
+        with COUNTERS_LOCK:
+            COUNTERS.update(saved)
+        LOGGER.info("> Data accounting loaded: "+str(usage("gsm"))+" bytes on GSM today, "+str(month_usage("gsm"))+" this month")
+    except FileNotFoundError:
+        LOGGER.info("> No data accounting file found")
+    except Exception as e:
+        LOGGER.error(">> Can't load the data accounting: "+str(e))
+        LOGGER.exception(e)
+
+    CURRENT_DAY = today()
+    T_LAST_SAVE = time.monotonic()
+    return
+
+
+def today():
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def count(iface, traffic_class, payload, overhead = 0):
+
+    global CURRENT_DAY
+
+    if not iface:
+        return
+    day = today()
+    with COUNTERS_LOCK:
+        if day != CURRENT_DAY:
+            log_day(CURRENT_DAY)
+            CURRENT_DAY = day
+            for old_day in sorted(COUNTERS)[:-KEEP_DAYS]:
+                del COUNTERS[old_day]
+        counter = COUNTERS.setdefault(day, {}).setdefault(iface, {}).setdefault(traffic_class, [0, 0])
+        counter[0] += payload
+        counter[1] += overhead
+    save()
+
+
+def count_datagram(iface, traffic_class, size):
+
+    # size: the datagram as sent (nonce and ciphertext), IP/UDP headers are the overhead
+    count(iface, traffic_class, size, encoder.UDP_IP_OVERHEAD)
+
+
+def count_http(iface, traffic_class, size, request = True):
+
+    # size: body bytes received, request False for the following chunks of a streamed body
+    overhead = math.ceil(size/TCP_SEGMENT_SIZE)*TCP_IP_OVERHEAD
+    if request:
+        overhead += HTTP_REQUEST_OVERHEAD
+    count(iface, traffic_class, size, overhead)
+
+
+def usage(iface, traffic_class = None, day = None):
+
+    # Bytes (payload and overhead) of the day, of a class or of all of them
+    with COUNTERS_LOCK:
+        classes = COUNTERS.get(day or today(), {}).get(iface, {})
+        return sum(sum(counter) for name, counter in classes.items() if traffic_class in (None, name))
+
+
+def month_usage(iface):
+
+    month = today()[:7]
+    with COUNTERS_LOCK:
+        days = [day for day in COUNTERS if day.startswith(month)]
+    return sum(usage(iface, day=day) for day in days)
+
+
+def allowed(iface, traffic_class, size = 0, class_budget = True):
+
+    # Whether size more bytes of traffic_class fit the budgets of iface (0 budget: no limit)
+    if iface != "gsm":
+        return True
+
+    budgets = [(usage(iface), config.GSM_DAILY_BUDGET), (month_usage(iface), config.GSM_MONTHLY_BUDGET)]
+    if class_budget:
+        budgets.append((usage(iface, traffic_class), config.GSM_CLASS_BUDGETS.get(traffic_class, 0)))
+    for used, budget in budgets:
+        if budget and used+size > budget:
+            return False
+    return True
+
+
+def log_day(day):
+
+    if day not in COUNTERS:
+        return
+    for iface, classes in COUNTERS[day].items():
+        LOGGER.info("> Traffic of "+day+" on "+iface+": "+", ".join(name+" "+str(sum(counter))+" bytes" for name, counter in classes.items()))
+
+
+def save(force = False):
+
+    # Written at most every config.ACCOUNTING_SAVE_INTERVAL seconds (and at exit), replaced atomically
+    global T_LAST_SAVE
+
+    if not force and time.monotonic()-T_LAST_SAVE < config.ACCOUNTING_SAVE_INTERVAL:
+        return True
+    T_LAST_SAVE = time.monotonic()
+
+    try:
+        with COUNTERS_LOCK:
+            data = json.dumps(COUNTERS)
+        tmp_path = config.BAK_PATH+ACCOUNTING_FILE+".tmp"
+        with open(tmp_path, "w") as accounting_file:
+            accounting_file.write(data)
+            accounting_file.flush()
+            os.fsync(accounting_file.fileno())
+        os.replace(tmp_path, config.BAK_PATH+ACCOUNTING_FILE)
+        return True
+
+    except Exception as e:
+        LOGGER.error(">> Can't save the data accounting: "+str(e))
+        LOGGER.exception(e)
+        return False
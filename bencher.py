@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+
+import datetime, math, os, pickle, tempfile, time, zlib
+from queue import LifoQueue
+
+import commander as at
+import config, encoder, queuer
+import serialer as ser
+
+############################################################################
+####                   GLOBAL VARIABLES AND CONSTANTS                   ####
+############################################################################
+
+BENCH_ROUNDS = 2000
+
+UART_CHUNK = 32                 # Bytes made available by the fake port for every read
+
+########################## RECORDED MODEM TRANSCRIPTS ##########################
+
+TRANSCRIPTS = {
+    "CGNSINF": ("AT+CGNSINF", "OK",
+                b"AT+CGNSINF\r\r\n+CGNSINF: 1,1,20230712083015.000,45.464211,9.191383,122.400,0.35,"
+                b"12.6,1,,1.1,1.4,0.9,,12,8,3,,38,3.2,5.1\r\n\r\nOK\r\n"),
+    "COPS": ("AT+COPS?", "OK",
+             b"AT+COPS?\r\r\n+COPS: 0,1,\"I TIM\",7\r\n\r\nOK\r\n"),
+    "CSQ": ("AT+CSQ", "OK",
+            b"AT+CSQ\r\r\n+CSQ: 18,99\r\n\r\nOK\r\n"),
+    "CIPSTATUS": ("AT+CIPSTATUS", "STATE",
+                  b"AT+CIPSTATUS\r\r\nOK\r\n\r\nSTATE: CONNECT OK\r\n"),
+    "HTTPREAD": ("AT+HTTPREAD", "OK",
+                 b"AT+HTTPREAD\r\r\n+HTTPREAD: 1200\r\n" + b";".join([b"1690000000;1.3.1"]*70) + b"\r\nOK\r\n"),
+}
+
+########################## RECORDED FRAMED RESPONSES ##########################
+
+# Text returned by serial_command for every parsed row of commander.AT_TABLE
+RECORDED_RESPONSES = {
+    "CFUN?":        "+CFUN: 1  OK",
+    "CMEE?":        "+CMEE: 2  OK",
+    "CPIN?":        "+CPIN: READY  OK",
+    "COPS?":        "+COPS: 0,1,\"I TIM\",7  OK",
+    "CREG?":        "+CREG: 0,1  OK",
+    "CSQ":          "+CSQ: 18,99  OK",
+    "CGATT?":       "+CGATT: 1  OK",
+    "CSTT?":        "+CSTT: \"iot.1nce.net\",\"\",\"\"  OK",
+    "CIPSTATUS":    "OK  STATE: CONNECT OK",
+    "SAPBR=2":      "+SAPBR: 1,1,\"10.89.12.7\"  OK",
+    "HTTPACTION=":  "OK  +HTTPACTION: 0,200,1200",
+    "HTTPREAD":     "+HTTPREAD: 1200 " + ";".join(["1690000000;1.3.1"]*70) + " OK",   # Body of the framer transcript
+    "CGNSINF":      "+CGNSINF: 1,1,20230712083015.000,45.464211,9.191383,122.400,0.35,12.6,1,,1.1,1.4,0.9,,12,8,3,,38,3.2,5.1  OK",
+}
+
+# Chained split() parsers used before the command table (benchmark baseline)
+LEGACY_PARSERS = {
+    "CFUN?":        lambda at_out: int(at_out.split("+CFUN: ")[1].split(" ")[0]),
+    "CMEE?":        lambda at_out: int(at_out.split("+CMEE: ")[1].split(" ")[0]),
+    "CPIN?":        lambda at_out: at_out.split("+CPIN: ")[1].split("  ")[0],
+    "COPS?":        lambda at_out: at_out.split("+COPS: ")[1].split(",")[2].replace(" ","").replace("\"",""),
+    "CREG?":        lambda at_out: int(at_out.split("+CREG: ")[1].split(",")[1].split(" ")[0]),
+    "CSQ":          lambda at_out: int(at_out.split("+CSQ: ")[1].split(",")[0]),
+    "CGATT?":       lambda at_out: int(at_out.split("+CGATT: ")[1].split(" ")[0]),
+    "CSTT?":        lambda at_out: at_out.split("\"")[1],
+    "CIPSTATUS":    lambda at_out: at_out.split(": ")[1],
+    "SAPBR=2":      lambda at_out: (int(at_out.split(",")[1]), at_out.split(",")[2].split("\"")[1]),
+    "HTTPACTION=":  lambda at_out: (int(at_out.split("+HTTPACTION: ")[1].split(",")[1]), int(at_out.split("+HTTPACTION: ")[1].split(",")[2])),
+    "HTTPREAD":     lambda at_out: at_out.split(" ")[2],
+    "CGNSINF":      lambda at_out: legacy_cgnsinf_parser(at_out.split("+CGNSINF: ")[1].split(" ")[0]),
+}
+
+########################## SAMPLE PACKET CONTENT ##########################
+
+SAMPLE_DEVICE = ("gpstrk-0042", "1.3.0", "ITIM")       # Device id, version, network
+SAMPLE_BLE_TAGS = [("c4:7c:8d:6a:1f:0%d" % index, -60-index) for index in range(6)]
+
+############################################################################
+####                               CLASSES                              ####
+############################################################################
+
+class ReplaySerial():
+
+    # Minimal stand-in for serial.Serial replaying a recorded transcript in UART-sized chunks
+
+    def __init__(self, data, chunk = UART_CHUNK):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+
+    def rewind(self):
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data)-self.pos)
+
+    def read(self, size = 1):
+        out = self.data[self.pos:self.pos+size]
+        self.pos += len(out)
+        return out
+
+    def read_until(self, expected = b"\n"):
+        # Same strategy of pyserial: one read(1) call for every byte until the terminator
+        line = bytearray()
+        while True:
+            c = self.read(1)
+            if not c:
+                break
+            line += c
+            if line[-len(expected):] == expected:
+                break
+        return bytes(line)
+
+############################################################################
+####                              FUNCTIONS                             ####
+############################################################################
+
+def legacy_listen_to_serial(port, exit_word = "OK", timeout = 15, cmd = ""):
+
+    # Line-by-line reader used before the ResponseFramer (kept here as the benchmark baseline)
+    decoded_full_serial_out = ""
+
+    t_start = time.time()
+    t_now = time.time()
+    while exit_word not in decoded_full_serial_out and "ERROR" not in decoded_full_serial_out and (t_now-t_start)<timeout:
+        line = port.read_until()
+
+        line_decoded = str(line.decode("utf-8").split("\n")[0].strip())
+
+        if cmd:
+            if cmd not in line_decoded:
+                if decoded_full_serial_out:
+                    decoded_full_serial_out += " "
+                decoded_full_serial_out += line_decoded
+        else:
+            if decoded_full_serial_out:
+                decoded_full_serial_out += " "
+            decoded_full_serial_out += line_decoded
+
+        t_now = time.time()
+
+    return decoded_full_serial_out
+
+
+def legacy_cgnsinf_parser(cgnsinf):
+
+    # List of strings built before the GnssFix record (9 fields, datetime objects for the UTC time)
+    scan_fields = cgnsinf.split(",")
+    output = []
+    output.append(int(scan_fields[0]))
+    if output[0]==1:
+        output.append(int(scan_fields[1]))
+        if output[1]==1:
+            utc = scan_fields[2]
+            output.append(str((datetime.datetime(int(utc[0:4]), int(utc[4:6]), int(utc[6:8]), int(utc[8:10]),
+                                                 int(utc[10:12]), int(utc[12:14])) - datetime.datetime(1970,1,1)).total_seconds()))
+            output.extend(str(field) for field in scan_fields[3:9])
+    return output
+
+
+def bench_gnss_fix(rounds = BENCH_ROUNDS*10):
+
+    # Parsing plus the conversions done downstream on every fix (flow controller speed, debug print time)
+    at_out = RECORDED_RESPONSES["CGNSINF"]
+    legacy_parser = LEGACY_PARSERS["CGNSINF"]
+    table_parser = at.AT_TABLE["CGNSINF"].parse
+
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        gps_scan = legacy_parser(at_out)
+        float(gps_scan[6]), int(float(gps_scan[2]))
+    t_legacy = (time.perf_counter()-t_start)/rounds
+
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        gps_scan = table_parser(at_out)
+        gps_scan.speed, gps_scan.utc
+    t_record = (time.perf_counter()-t_start)/rounds
+
+    return {"CGNSINF": (t_legacy, t_record)}
+
+
+def bench_packet_encoding(rounds = BENCH_ROUNDS*5):
+
+    fix = at.AT_TABLE["CGNSINF"].parse(RECORDED_RESPONSES["CGNSINF"])
+    device_id, version, network = SAMPLE_DEVICE
+    args = (fix, 12345, 18, device_id, version, network, 20, SAMPLE_BLE_TAGS)
+
+    text_packet = encoder.encode_text_packet(*args)
+    encoder.reset_static()
+    keyframe = encoder.encode_packet(*args)
+    steady = encoder.encode_packet(*args)
+
+    decoded = encoder.decode_packet(keyframe)
+    if (decoded["latitude"], decoded["longitude"], decoded["device_id"]) != (fix.latitude, fix.longitude, device_id):
+        raise AssertionError("Binary packet round trip failed: "+repr(decoded))
+
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        encoder.encode_text_packet(*args)
+    t_text = (time.perf_counter()-t_start)/rounds
+
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        encoder.encode_packet(*args)
+    t_binary = (time.perf_counter()-t_start)/rounds
+
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        encoder.decode_packet(steady)
+    t_decode = (time.perf_counter()-t_start)/rounds
+
+    sizes = {"text": len(text_packet), "binary (static)": len(keyframe), "binary": len(steady)}
+    return sizes, {"encode": (t_text, t_binary)}, t_decode
+
+
+def bench_delta_encoding(packets = 300, keyframe_interval = 10):
+
+    # Average payload over a track: parked (same position, same tags) and driving (~14 m/s, a tag every 5 packets)
+    fix = at.AT_TABLE["CGNSINF"].parse(RECORDED_RESPONSES["CGNSINF"])
+    device_id, version, network = SAMPLE_DEVICE
+
+    sizes = {}
+    for name, step, ble_every in (("parked", 0, 0), ("driving", 0.000127, 5)):
+        total = {"text": 0, "binary": 0, "delta": 0}
+        encoder.reset_static()
+        encoder.KEYFRAME = None
+        keyframe = None
+        current = fix.copy()
+        ble_tags = list(SAMPLE_BLE_TAGS)
+        for counter in range(1, packets+1):
+            current.utc += 60
+            current.latitude = round(current.latitude + step, 6)
+            current.longitude = round(current.longitude + step, 6)
+            if ble_every and counter % ble_every == 0:
+                ble_tags = ble_tags[1:] + [("d0:00:00:00:%02x:%02x" % divmod(counter, 256), -70)]
+            args = (current, counter, 18, device_id, version, network, 20, ble_tags)
+            total["text"] += len(encoder.encode_text_packet(*args))
+            total["binary"] += len(encoder.encode_packet(*args))
+            packet = encoder.encode_delta_packet(*args, keyframe_interval=keyframe_interval)
+            total["delta"] += len(packet)
+
+            decoded = encoder.decode_packet(packet, keyframe)
+            if not decoded["flags"] & encoder.FLAG_DELTA:
+                keyframe = decoded
+            if ((decoded["latitude"], decoded["longitude"], decoded["utc"]) != (current.latitude, current.longitude, current.utc)
+                    or sorted(mac for mac, _ in decoded["ble"]) != sorted(mac.replace(":", "") for mac, _ in ble_tags)):
+                raise AssertionError("Delta packet round trip failed: "+repr(decoded))
+
+        for encoding, size in total.items():
+            sizes[encoding+" ("+name+")"] = round(size/packets)
+
+    encoder.reset_static()
+    encoder.KEYFRAME = None
+    return sizes
+
+
+def bench_queue_drain(packets = 1000, mtu = 1280):
+
+    # Datagrams and bytes on air to drain a backlog of packets, one per datagram or aggregated
+    fix = at.AT_TABLE["CGNSINF"].parse(RECORDED_RESPONSES["CGNSINF"])
+    device_id, version, network = SAMPLE_DEVICE
+    overhead = encoder.UDP_IP_OVERHEAD + encoder.NONCE_SIZE
+
+    backlogs = {"text": [], "delta": []}
+    encoder.KEYFRAME = None
+    current = fix.copy()
+    for counter in range(1, packets+1):
+        current.utc += 60
+        current.latitude = round(current.latitude + 0.000127, 6)
+        args = (current, counter, 18, device_id, version, network, 20, SAMPLE_BLE_TAGS)
+        backlogs["text"].append(encoder.encode_text_packet(*args))
+        backlogs["delta"].append(encoder.encode_delta_packet(*args))
+    encoder.KEYFRAME = None
+
+    results = {}
+    for name, records in backlogs.items():
+        results[name+" single"] = (len(records), sum(len(record) + overhead for record in records), 0)
+        for compress in (False, True):
+            datagrams = 0
+            wire = 0
+            split = []
+            pending = records
+            t_start = time.perf_counter()
+            while pending:
+                payload, count = encoder.aggregate_records(pending[:64], mtu, compress)
+                pending = pending[count:]
+                datagrams += 1
+                wire += len(payload) + overhead
+                split += encoder.split_aggregate(payload)
+            t_pack = (time.perf_counter()-t_start)/datagrams
+            if split != [record.encode("utf-8") if isinstance(record, str) else record for record in records]:
+                raise AssertionError("Aggregate round trip failed on "+name)
+            results[name+(" deflate" if compress else " packed")] = (datagrams, wire, t_pack)
+    return results
+
+
+def bench_compression(rounds = BENCH_ROUNDS):
+
+    # Bytes and CPU per packet of the compression stage, without and with the preset dictionary
+    fix = at.AT_TABLE["CGNSINF"].parse(RECORDED_RESPONSES["CGNSINF"])
+    device_id, version, network = SAMPLE_DEVICE
+    args = (fix, 12345, 18, device_id, version, network, 20, SAMPLE_BLE_TAGS)
+    text = encoder.encode_text_packet(*args).encode("utf-8")
+    encoder.reset_static()
+    encoder.encode_packet(*args)
+    binary = encoder.encode_packet(*args)
+
+    results = {}
+    for name, packet, batch in (("text", text, 1), ("text x10", text, 10), ("binary", binary, 1), ("binary x10", binary, 10)):
+        records = [packet]*batch
+        frames = b"".join(bytes([len(packet)]) + packet for packet in records)
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            plain = zlib.compress(frames, 9)
+        t_plain = (time.perf_counter()-t_start)/rounds/batch
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            payload, _ = encoder.aggregate_records(records, 1280, True)
+        t_preset = (time.perf_counter()-t_start)/rounds/batch
+
+        if encoder.split_aggregate(payload) != records:
+            raise AssertionError("Preset dictionary round trip failed on "+name)
+        results[name] = (len(frames), len(plain), len(payload), t_plain, t_preset)
+
+    return results
+
+
+def print_compression(title, results):
+
+    print("####### "+title+" #######")
+    for name, (size, plain, preset, t_plain, t_preset) in results.items():
+        print("{:<11} {:>5} bytes   zlib {:>5.1f}% {:>6.1f}us/pkt   preset {:>5.1f}% {:>6.1f}us/pkt".format(
+            name, size, 100*plain/size, t_plain*1e6, 100*preset/size, t_preset*1e6))
+
+
+def bench_packet_queue(packets = 100000, directory = None):
+
+    # Enqueue and drain of a backlog: pickled LifoQueue (dumped once) vs the SQLite packet store,
+    # on the SD card when run on the device (BAK_PATH), in a temporary directory elsewhere
+    if directory is None:
+        directory = config.BAK_PATH if os.path.isdir(config.BAK_PATH) else None
+    directory = tempfile.mkdtemp(dir=directory)
+    path = os.path.join(directory, "bench.db")
+    packet = "45.464211;9.191383;122.4;0.4;12.6;18;1689150555;gpstrk-0042;1.3.0;c47c8d6a1f00-60;ITIM;20;12345;"
+
+    results = {}
+    legacy = LifoQueue()
+    t_start = time.perf_counter()
+    for _ in range(packets):
+        legacy.put(packet)
+    with open(os.path.join(directory, "pakq.bak"), "wb") as queue_save_file:
+        pickle.dump(list(legacy.queue), queue_save_file)
+        queue_save_file.flush()
+        os.fsync(queue_save_file.fileno())
+    t_push = time.perf_counter()-t_start
+    t_start = time.perf_counter()
+    while not legacy.empty():
+        legacy.get()
+    results["LifoQueue+pickle"] = (t_push, time.perf_counter()-t_start)
+
+    queuer.init_queuer(path)
+    t_start = time.perf_counter()
+    for _ in range(packets):
+        queuer.push(packet)
+    queuer.flush()
+    t_push = time.perf_counter()-t_start
+    t_start = time.perf_counter()
+    while True:
+        rows = queuer.peek(64)
+        if not rows:
+            break
+        queuer.remove([packet_id for packet_id, _ in rows])
+    results["queuer (SQLite)"] = (t_push, time.perf_counter()-t_start)
+    queuer.close()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return results
+
+
+def backlog_track(hours = 24, period = 5):
+
+    # 5 s packets out of coverage: stops (BLE tags change at some), straight roads and bends
+    track = []
+    utc = 1689150555
+    latitude, longitude, heading = 45.464211, 9.191383, 0.0
+    legs = [("stop", 7200, 0), ("drive", 1800, 0), ("drive", 600, 1.5), ("stop", 3600, 1), ("drive", 2400, -0.8),
+            ("drive", 1200, 0), ("stop", 1800, 0), ("drive", 900, 3)]
+    tags = 0
+    while utc < 1689150555 + hours*3600:
+        for kind, duration, turn in legs:
+            if kind == "stop" and turn:
+                tags += 1
+            for _ in range(duration//period):
+                if kind == "drive":
+                    heading += turn*period/60
+                    step = 14*period                            # ~50 km/h
+                    latitude += step*math.cos(math.radians(heading))/queuer.EARTH_RADIUS*180/math.pi
+                    longitude += (step*math.sin(math.radians(heading))/queuer.EARTH_RADIUS*180/math.pi
+                                  /math.cos(math.radians(latitude)))
+                    speed = 50.0
+                else:
+                    speed = 0.5
+                jitter = 0.00002*math.sin(utc)                 # ~2 m of GPS noise
+                track.append((utc, round(latitude+jitter, 6), round(longitude-jitter, 6), speed, tags, False))
+                utc += period
+    return track
+
+
+def bench_backlog_policies(directory = None):
+
+    # Packets kept by the backlog policies of the packet store and the largest distance of a dropped
+    # position from the route of the kept ones
+    track = backlog_track()
+    directory = tempfile.mkdtemp(dir=directory)
+    saved = {name: getattr(config, name) for name in ("QUEUE_DWELL_RADIUS", "QUEUE_SIMPLIFY_TOLERANCE", "QUEUE_DOWNSAMPLE_SIZE")}
+
+    results = {}
+    for name, dwell, tolerance, downsample in (("no policies", 0, 0, 10**9), ("dwell", saved["QUEUE_DWELL_RADIUS"], 0, 10**9),
+                                               ("dwell+simplify", saved["QUEUE_DWELL_RADIUS"], saved["QUEUE_SIMPLIFY_TOLERANCE"], 10**9),
+                                               ("downsample 2000", 0, 0, 2000)):
+        config.QUEUE_DWELL_RADIUS, config.QUEUE_SIMPLIFY_TOLERANCE, config.QUEUE_DOWNSAMPLE_SIZE = dwell, tolerance, downsample
+        queuer.DOWNSAMPLED_UTC = 0
+        path = os.path.join(directory, name.split()[0]+".db")
+        queuer.init_queuer(path)
+        t_start = time.perf_counter()
+        for meta in track:
+            queuer.push("packet", meta)
+        queuer.flush()
+        t_push = (time.perf_counter()-t_start)/len(track)
+        kept = queuer.DB.execute("SELECT utc, latitude, longitude FROM packets ORDER BY id").fetchall()
+        queuer.close()
+        os.remove(path)
+        results[name] = (len(kept), route_deviation(track, kept), t_push)
+
+    for name, value in saved.items():
+        setattr(config, name, value)
+    queuer.DOWNSAMPLED_UTC = 0
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return len(track), results
+
+
+def route_deviation(track, kept):
+
+    # Distance of every original position from the kept route between the kept positions around it
+    deviation = 0
+    index = 0
+    for point in track:
+        while index < len(kept)-2 and kept[index+1][0] <= point[0]:
+            index += 1
+        origin, end = kept[index], kept[index+1]
+        deviation = max(deviation, queuer.segment_distance(queuer.project(origin, point), queuer.project(origin, end)))
+    return deviation
+
+
+def print_policies(title, packets, results):
+
+    print("####### "+title+" #######")
+    for name, (kept, deviation, t_push) in results.items():
+        print("{:<16} {:>6} packets {:>5.1f}%   max deviation {:>6.1f} m   push {:>6.1f}us/pkt".format(
+            name, kept, 100*kept/packets, deviation, t_push*1e6))
+
+
+def print_queue(title, results, packets = 100000):
+
+    print("####### "+title+" #######")
+    for name, (t_push, t_drain) in results.items():
+        print("{:<18} enqueue {:>7.2f}s {:>8.0f}/s   drain {:>7.2f}s {:>8.0f}/s".format(
+            name, t_push, packets/t_push, t_drain, packets/t_drain))
+
+
+def print_drain(title, results, legacy_sleep = 0.1):
+
+    print("####### "+title+" #######")
+    for name, (datagrams, wire, t_pack) in results.items():
+        print("{:<16} {:>5} datagrams {:>8} bytes   pack {:>7.1f}us/datagram   sleep {:>6.1f}s".format(
+            name, datagrams, wire, t_pack*1e6, datagrams*legacy_sleep if name.endswith("single") else 0))
+
+
+def print_sizes(title, sizes):
+
+    print("####### "+title+" #######")
+    reference = next(iter(sizes.values()))
+    for name, size in sizes.items():
+        print("{:<16} {:>5} bytes   {:>5.1f}%".format(name, size, 100*size/reference))
+
+
+def bench_response_framer(rounds = BENCH_ROUNDS):
+
+    results = {}
+    for name, (cmd, exit_word, data) in TRANSCRIPTS.items():
+        port = ReplaySerial(data)
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            port.rewind()
+            legacy_out = legacy_listen_to_serial(port, exit_word, cmd=cmd)
+        t_legacy = (time.perf_counter()-t_start)/rounds
+
+        ser.SERIAL_PORT = port
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            port.rewind()
+            del ser.SERIAL_RX_BUFFER[:]
+            framer_out = ser.listen_to_serial(exit_word, cmd=cmd)
+        t_framer = (time.perf_counter()-t_start)/rounds
+
+        if legacy_out != framer_out:
+            raise AssertionError("Framer output differs on "+name+": "+repr(framer_out)+" != "+repr(legacy_out))
+        results[name] = (t_legacy, t_framer)
+
+    ser.SERIAL_PORT = None
+    return results
+
+
+def bench_at_parsers(rounds = BENCH_ROUNDS*10):
+
+    results = {}
+    for name, command in at.AT_TABLE.items():
+        if command.parse is at.raw_response:
+            continue
+        if name not in RECORDED_RESPONSES:
+            raise AssertionError("No recorded response for the "+name+" parser")
+        at_out = RECORDED_RESPONSES[name]
+        legacy_parser = LEGACY_PARSERS[name]
+        table_parser = command.parse
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            legacy_parser(at_out)
+        t_legacy = (time.perf_counter()-t_start)/rounds
+
+        t_start = time.perf_counter()
+        for _ in range(rounds):
+            table_parser(at_out)
+        t_table = (time.perf_counter()-t_start)/rounds
+
+        results[name] = (t_legacy, t_table)
+
+    return results
+
+
+def print_results(title, results):
+
+    print("####### "+title+" #######")
+    for name, (t_old, t_new) in results.items():
+        print("{:<12} old {:>8.1f}us   new {:>8.1f}us   x{:.2f}".format(name, t_old*1e6, t_new*1e6, t_old/t_new))
+
+############################################################################
+####                                MAIN                                ####
+############################################################################
+
+def main_bencher():
+
+    print_results("AT response framer", bench_response_framer())
+    print_results("AT command table parsers", bench_at_parsers())
+    print_results("GNSS fix record", bench_gnss_fix())
+    sizes, results, t_decode = bench_packet_encoding()
+    print_sizes("Packet size (6 BLE tags)", sizes)
+    print_results("Packet encoding (old = text, new = binary)", results)
+    print("binary decode {:>8.1f}us".format(t_decode*1e6))
+    print_sizes("Average packet size (keyframe every 10)", bench_delta_encoding())
+    print_drain("Queue drain (1000 packets, MTU 1280)", bench_queue_drain())
+    print_compression("Compression (size % of the framed packets, CPU per packet)", bench_compression())
+    print_queue("Packet queue (100k packets, drain by 64)", bench_packet_queue())
+    print_policies("Backlog policies (a day of 5 s packets)", *bench_backlog_policies())
+
+    return 0
+
+#---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    try:
+        main_bencher()
+    except Exception as e:
+        print("main crashed. Error: %s", e)
@@ -24,7 +24,8 @@ BLE_LIST = []
 BLE_CHANGE_STATE = []
 
 BLE_CHANGES_LIST = []                                           # This list stores the changes to be inserted in the packets with
-                                                                # a differential logic: therefore right now is not used.
+                                                                # a differential logic: therefore right now is not used
+                                                                # (the "delta" packets diff BLE_LIST against their keyframe).
                                                                 # This list will be shared between two threads: the BLE 
                                                                 # scanning routine and the packet forming routine.
 ble_lock = threading.Lock()                                     # So it will need a Lock to handle concurrency.
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import re
 import time
 
+from serial import SerialTimeoutException
+
 import support
-from serialer import serial_command, write_to_serial
+from serialer import serial_command, write_to_serial, escape_data_mode, set_data_mode, data_mode_active, data_mode_idle
 
 ############################################################################
 ####                   GLOBAL VARIABLES AND CONSTANTS                   ####
@@ -11,22 +14,200 @@ from serialer import serial_command, write_to_serial
 
 LOGGER = False
 
+AT_TABLE = {}           # Command name -> ATCommand: filled after the parsers definition
+
+CFUN_STATES = {
+    0: "Minimum functionality",
+    1: "Full functionality",
+    4: "RF disabled",
+    5: "Factory test mode",
+    6: "Reset",
+    7: "Offline mode",
+}
+
+ACCESS_TECHS = {
+    0: "User GSM",
+    1: "GSM compact",
+    3: "GSM EGPRS",
+    7: "LTE-M1-AGB",
+    9: "LTE-NB-S1",
+}
+
+REGISTRATION_STATES = {
+    0: "Unregistered",
+    1: "Registered",
+    2: "Searching",
+    3: "Denied",
+    4: "Unknown",
+    5: "Roaming",
+}
+
+BEARER_STATES = {
+    0: "Bearer connecting",
+    2: "Bearer closing",
+    3: False,
+}
+
+############################################################################
+####                               CLASSES                              ####
+############################################################################
+
+class ATParseError(ValueError):
+    pass
+
+
+class GnssFix():
+
+    # One +CGNSINF answer with every field converted once: floats for the measures, ints for the
+    # counters and the UTC time as epoch seconds. Empty fields (e.g. without fix) are None.
+
+    __slots__ = ("run_status", "fix_status", "utc", "latitude", "longitude", "altitude", "speed", "course",
+                 "fix_mode", "hdop", "pdop", "vdop", "sats_in_view", "gnss_sats_used", "glonass_sats_used",
+                 "cn0_max", "hpa", "vpa")
+
+    def __init__(self, fields):
+        if len(fields) < 21:
+            fields = fields + [""]*(21-len(fields))
+        self.run_status = int(fields[0]) if fields[0] else 0
+        self.fix_status = int(fields[1]) if fields[1] else 0
+        self.utc = support.gps_date_to_timestamp(fields[2]) if fields[2] else None
+        self.latitude = float(fields[3]) if fields[3] else None
+        self.longitude = float(fields[4]) if fields[4] else None
+        self.altitude = float(fields[5]) if fields[5] else None
+        self.speed = float(fields[6]) if fields[6] else None
+        self.course = float(fields[7]) if fields[7] else None
+        self.fix_mode = int(fields[8]) if fields[8] else None
+        self.hdop = float(fields[10]) if fields[10] else None
+        self.pdop = float(fields[11]) if fields[11] else None
+        self.vdop = float(fields[12]) if fields[12] else None
+        self.sats_in_view = int(fields[14]) if fields[14] else None
+        self.gnss_sats_used = int(fields[15]) if fields[15] else None
+        self.glonass_sats_used = int(fields[16]) if fields[16] else None
+        self.cn0_max = int(fields[18]) if fields[18] else None
+        self.hpa = float(fields[19]) if fields[19] else None
+        self.vpa = float(fields[20]) if fields[20] else None
+
+    def __repr__(self):
+        return "GnssFix("+", ".join(slot+"="+str(getattr(self, slot)) for slot in self.__slots__)+")"
+
+    def active(self):
+        return self.run_status == 1
+
+    def fixed(self):
+        return self.run_status == 1 and self.fix_status == 1
+
+    def copy(self):
+        fix = GnssFix.__new__(GnssFix)
+        for slot in self.__slots__:
+            setattr(fix, slot, getattr(self, slot))
+        return fix
+
+
+class ATCommand():
+
+    # One row of the command table: the command template, how the modem ends the answer and the
+    # parser compiled from a pattern whose groups are converted to typed values. A command without
+    # pattern returns the raw response (setters and commands checked by the caller).
+    # The hot commands (every packet, every chunk) pass their own split() parser instead of the pattern.
+
+    __slots__ = ("cmd", "regex", "parse", "exit_word", "timeout")
+
+    def __init__(self, cmd, pattern = None, types = (), exit_word = "OK", timeout = 15, parse = None):
+        self.cmd = cmd
+        self.regex = re.compile(pattern) if pattern else None
+        self.parse = parse or compile_parser(cmd, self.regex, types)
+        self.exit_word = exit_word
+        self.timeout = timeout
+
+    def query(self):
+        # Command without the "AT" prefix, as chained in a batched command line
+        return self.cmd[2:]
+
+def compile_parser(cmd, regex, types):
+
+    # Specialized closures: a parse costs one regex search and the conversions it really needs
+    if regex is None:
+        return raw_response
+
+    search = regex.search
+    if len(types) == 1:
+        convert = types[0]
+
+        def parse(at_out):
+            match = search(at_out)
+            if match is None:
+                raise ATParseError("Unexpected answer to "+cmd+": "+at_out)
+            return convert(match[1])
+
+    else:
+        # Only the groups needing a conversion are touched: str groups are returned as matched
+        converters = tuple((index, convert) for index, convert in enumerate(types) if convert is not str)
+
+        def parse(at_out):
+            match = search(at_out)
+            if match is None:
+                raise ATParseError("Unexpected answer to "+cmd+": "+at_out)
+            values = match.groups()
+            if not converters:
+                return values
+            values = list(values)
+            for index, convert in converters:
+                # Optional groups (e.g. +COPS: 0 when not registered) are returned as None
+                if values[index] is not None:
+                    values[index] = convert(values[index])
+            return tuple(values)
+
+    return parse
+
+
+def raw_response(at_out):
+    return at_out
+
 #########################################################################################################
-####                                          Basic AT Functions                                     ####
+####                                           AT Command Executor                                   ####
 #########################################################################################################
 
-def check_serial():
+def at_execute(name, *args, timeout = None, binary = False, size = False):
+
+    command = AT_TABLE[name]
+    at_out = serial_command(command.cmd.format(*args) if args else command.cmd, exit_word=command.exit_word,
+                            timeout=timeout or command.timeout, binary=binary, size=size)
+    if binary:
+        return at_out
+    return command.parse(at_out)
+
+
+    ############################# BATCHED QUERIES ##################################
+    #   Read commands without side effects can be chained on a single line:        #
+    #   AT+COPS?;+CSQ;+CREG?  ->  +COPS: ..  +CSQ: ..  +CREG: ..  OK               #
+    #   Every pattern looks for its own prefix, so the combined answer is parsed   #
+    #   by the same table rows of the single commands.                             #
+    ################################################################################
+
+def batch_query(names):
 
+    commands = [AT_TABLE[name] for name in names]
     try:
-        at_out = serial_command("AT", timeout=1)
+        at_out = serial_command("AT"+";".join(command.query() for command in commands))
+        return [command.parse(at_out) for command in commands]
 
-    except Exception as e:
+    except SerialTimeoutException as e:
         raise e
 
-    else:
-        if "ERROR" in at_out:
-            return False
-        return True
+    except Exception as e:
+        # Fall back to one command per round trip
+        return [at_execute(name) for name in names]
+
+#########################################################################################################
+####                                          Basic AT Functions                                     ####
+#########################################################################################################
+
+def check_serial():
+
+    at_out = at_execute("AT")
+    if "ERROR" in at_out:
+        return False
+    return True
 
 
 def get_function_state():
@@ -34,63 +215,25 @@ def get_function_state():
     ######################## OUTPUT CFUN #########################################
     # 0     Minimum functionality
     # 1     Full functionality (default)
-    # 4     Disable phone both transmit and receive RF circuits 
-    # 5     Factory Test Mode 
-    # 6     Reset 
+    # 4     Disable phone both transmit and receive RF circuits
+    # 5     Factory Test Mode
+    # 6     Reset
     # 7     Offline Mode
     ##############################################################################
 
-    try:
-        at_out = serial_command("AT+CFUN?")
-        fun_code = int(at_out.split("+CFUN: ")[1])
-
-    except Exception as e:
-        raise e
-
-    else:
-        if fun_code is 0:
-            return "Minimum functionality"
-        elif fun_code is 1:
-            return "Full functionality"
-        elif fun_code is 4:
-            return "RF disabled"
-        elif fun_code is 5:
-            return "Factory test mode"
-        elif fun_code is 6:
-            return "Reset"
-        elif fun_code is 7:
-            return "Offline mode"
+    return CFUN_STATES.get(at_execute("CFUN?"))
 
 
 def set_function_state(code):
-
-    try:
-        serial_command("AT+CFUN="+str(code))
-
-    except Exception as e:
-        raise e
+    at_execute("CFUN=", code)
 
 
 def reset_modem():
-
-    try:
-        serial_command("AT+CFUN=1,1")
-
-    except Exception as e:
-        raise e
+    at_execute("CFUN=", "1,1")
 
 
 def get_at_error_config():
-
-    try:
-        at_out = serial_command("AT+CMEE?")
-        error_code = int(at_out.split("+CMEE: ")[1])
-
-    except Exception as e:
-        raise e
-
-    else:
-        return error_code
+    return at_execute("CMEE?")
 
 
 def set_at_error_output(code=2):
@@ -101,53 +244,35 @@ def set_at_error_output(code=2):
     #   2. Verbose
     ###################################################################
 
-    try:
-        serial_command("AT+CMEE="+str(code))
-
-    except Exception as e:
-        raise e
+    at_execute("CMEE=", code)
 
 
 def set_at_netlight(on = False):
-
-    try:
-        serial_command("AT+CNETLIGHT="+str(int(on)))
-
-    except Exception as e:
-        raise e
+    at_execute("CNETLIGHT=", int(on))
 
 
 def toggle_data_mode():
 
-    try:
-        at_out = serial_command("ATO", exit_word="E", timeout=5)
-        time.sleep(1.001)
+    at_out = at_execute("ATO")
+    if "CONNECT" in at_out:
+        set_data_mode(True)
+    time.sleep(1.001)
 
-    except Exception as e:
-        raise e
-    
-    else:
-        if "CONNECT" in at_out:
-            return True
-        return False
+    if "CONNECT" in at_out:
+        return True
+    return False
 
 
 def toggle_cmd_mode():
+    escape_data_mode()
 
-    try:
-        time.sleep(1.001)
-        serial_command("+++", escape_char="", timeout=2)
-
-    except Exception as e:
-        raise e
-        # try:
-        #     time.sleep(1.001)
-        #     serial_command("+++", escape_char="", timeout=2)
 
-        # except Exception as e:
-        #     config.thread_comm("M1")
-        #     raise e            
+def ensure_data_mode():
 
+    # Open the data session only if it's not open yet
+    if data_mode_active():
+        return True
+    return toggle_data_mode()
 
 #########################################################################################################
 ####                                   SIM7000 CELLULAR FUNCTIONS                                    ####
@@ -156,77 +281,56 @@ def toggle_cmd_mode():
 def get_sim_status():
 
     ############################### OUTPUT CPIN ##########################################
-    # READY         MT is not pending for any password         
-    # SIM PIN       MT is waiting SIM PIN to be given        
-    # SIM PUK       MT is waiting for SIM PUK to be given 
-    # PH_SIM PIN    ME is waiting for phone to SIM card (antitheft) 
-    # PH_SIM PUK    ME is waiting for SIM PUK (antitheft) 
-    # SIM PIN2      PIN2, e.g. for editing the FDN book possible only 
+    # READY         MT is not pending for any password
+    # SIM PIN       MT is waiting SIM PIN to be given
+    # SIM PUK       MT is waiting for SIM PUK to be given
+    # PH_SIM PIN    ME is waiting for phone to SIM card (antitheft)
+    # PH_SIM PUK    ME is waiting for SIM PUK (antitheft)
+    # SIM PIN2      PIN2, e.g. for editing the FDN book possible only
     #               if preceding Command was acknowledged with +CME ERROR:17
-    # SIM PUK2      Possible only if preceding Command was acknowledged with 
-    #               error +CME ERROR: 18. 
+    # SIM PUK2      Possible only if preceding Command was acknowledged with
+    #               error +CME ERROR: 18.
     ######################################################################################
 
-    try:
-        at_out = serial_command("AT+CPIN?")
-        pin_status = at_out.split("+CPIN: ")
-
-    except Exception as e:
-        raise e
-
+    pin_status = at_execute("CPIN?")
+    if pin_status == "READY":
+        return "Unlocked"
+    elif pin_status == "SIM PIN":
+        return "PIN locked"
+    elif pin_status == "SIM PUK":
+        return "PUK locked"
     else:
-        if "READY" in pin_status:
-            return "Unlocked"
-        elif "SIM PIN" in pin_status:
-            return "PIN locked"
-        elif "SIM PUK" in pin_status:
-            return "PUK locked"
-        else:
-            return "Unknown"
+        return "Unknown"
 
 
 def sim_unlock(pin = False, puk = False):
 
-    try:
-        if puk:
-            serial_command("AT+CPIN=\""+puk+"\",\""+pin+"\"")
-        elif pin:
-            serial_command("AT+CPIN=\""+pin+"\"")
-
-    except Exception as e:
-        raise e
+    if puk:
+        at_execute("CPIN=PUK", puk, pin)
+    elif pin:
+        at_execute("CPIN=", pin)
 
 
 def clear_sim_lock(pin):
-
-    try:
-        serial_command("AT+CLCK=\"SC\",0,\""+pin+"\",1")
-
-    except Exception as e:
-        raise e
+    at_execute("CLCK=SC", pin)
 
 
 def get_operator():
-    
+
     ######################## OUTPUT COPS #################################################
     # 0                     No registration
-    # 0,0,"operator",x      x -> access tech (see next function)      
+    # 0,0,"operator",x      x -> access tech (see next function)
     ######################################################################################
 
-    try:
-        at_out = serial_command("AT+COPS?")
-        cops_list = at_out.split("+COPS: ")[1].split(",")
+    return operator_name(at_execute("COPS?"))
 
-    except Exception as e:
-        raise e
 
-    else:
-        if len(cops_list)>2:
-            if "SIM-operator" in cops_list[2]:
-                cops_list[2] = cops_list[2].replace("SIM-operator","")
-            cops_list[2] = cops_list[2].replace(" ","")
-            return cops_list[2].replace("\"","")
+def operator_name(cops):
+
+    operator = cops[1]
+    if operator is None:
         return "No registration"
+    return operator.replace("SIM-operator", "").replace(" ", "")
 
 
 def set_operator_out(code = 1):
@@ -234,7 +338,7 @@ def set_operator_out(code = 1):
     ################################# CODE OUTPUT COPS ###################################
     # Operator code configuration
     # 0     Complete text operator
-    # 1     Reduced text operator      
+    # 1     Reduced text operator
     # 2     Operator code (5 digits)
     # Mode code configuration
     # 0     Automatic mode
@@ -244,11 +348,7 @@ def set_operator_out(code = 1):
     # 4     Manual/automatic
     ######################################################################################
 
-    try:
-        serial_command("AT+COPS=3,"+str(code))
-
-    except Exception as e:
-        raise e
+    at_execute("COPS=3", code)
 
 
 def get_access_tech():
@@ -261,111 +361,65 @@ def get_access_tech():
     # 9     User-specified LTENBS1 access technology
     #####################################################################################
 
-    try:
-        at_out = serial_command("AT+COPS?")
-        cops_list = at_out.split("+COPS: ")[1].split(",")
-        if len(cops_list)>2:
-            acc_tech = int(cops_list[3])
-        else:
-            return False
-
-    except Exception as e:
-        raise e
-
-    else:
-        if acc_tech is 0:
-            return "User GSM"
-        elif acc_tech is 1:
-            return "GSM compact"
-        elif acc_tech is 3:
-            return "GSM EGPRS"
-        elif acc_tech is 7:
-            return "LTE-M1-AGB"
-        elif acc_tech is 9:
-            return "LTE-NB-S1"
+    acc_tech = at_execute("COPS?")[2]
+    if acc_tech is None:
+        return False
+    return ACCESS_TECHS.get(acc_tech)
 
 
 def get_registration_status():
 
     ######################## OUTPUT CREG ###############################################
-    # 0    Not registered, MT is not currently searching a new 
+    # 0    Not registered, MT is not currently searching a new
     #      operator to register to
-    # 1    Registered, home network 
-    # 2    Not  registered,  but  MT  is  currently  searching  
+    # 1    Registered, home network
+    # 2    Not  registered,  but  MT  is  currently  searching
     #      a  new  operator to register to
     # 3    Registration denied
-    # 4    Unknown 
-    # 5    Registered, roaming 
+    # 4    Unknown
+    # 5    Registered, roaming
     ####################################################################################
 
-    try:
-        at_out = serial_command("AT+CREG?")
-        reg_code = int(at_out.split("+CREG: ")[1].split(",")[1].split(" ")[0])
+    return REGISTRATION_STATES.get(at_execute("CREG?"))
 
-    except Exception as e:
-        raise e
 
-    else:
-        if reg_code is 0:
-            return "Unregistered"
-        elif reg_code is 1:
-            return "Registered"
-        elif reg_code is 2:
-            return "Searching"
-        elif reg_code is 3:
-            return "Denied"
-        elif reg_code is 4:
-            return "Unknown"
-        elif reg_code is 5:
-            return "Roaming"
+def get_rssi(dbm = True):
 
+    rssi_vote = at_execute("CSQ")
+    if not dbm:
+        return rssi_vote
+    return rssi_to_dbm(rssi_vote)
 
-def get_rssi(dbm = True):
 
-    try:
-        at_out = serial_command("AT+CSQ")
-        rssi_vote = int(at_out.split("+CSQ: ")[1].split(",")[0])
+def rssi_to_dbm(rssi_vote):
 
-    except Exception as e:
-        raise e
+    if rssi_vote > 31:
+        return rssi_vote
+    return -115 + 2*rssi_vote
 
-    else:
-        if not dbm or rssi_vote > 31:
-            return rssi_vote
-        return -115 + 2*rssi_vote
 
+def get_cellular_info(dbm = True):
 
-def gprs_attach():
+    # Operator, RSSI and registration status in a single modem round trip
+    cops, rssi_vote, reg_code = batch_query(["COPS?", "CSQ", "CREG?"])
+    if dbm:
+        rssi_vote = rssi_to_dbm(rssi_vote)
+    return operator_name(cops), rssi_vote, REGISTRATION_STATES.get(reg_code)
 
-    try:
-        at_out = serial_command("AT+CGATT=1")
 
-    except Exception as e:
-        raise e
+def gprs_attach():
+    at_execute("CGATT=", 1)
 
 
 def gprs_status():
 
-    try:
-        at_out = serial_command("AT+CGATT?")
-        gprs = int(at_out.split("+CGATT: ")[1].split("\n")[0])
-
-    except Exception as e:
-        raise e
-    
-    else:
-        if gprs is 0:
-            return False
-        return True
+    if at_execute("CGATT?") == 0:
+        return False
+    return True
 
 
 def gprs_detach():
-
-    try:
-        at_out = serial_command("AT+CGATT=0")
-
-    except Exception as e:
-        raise e
+    at_execute("CGATT=", 0)
 
 #########################################################################################################
 ####                                 SIM7000 TCP/UDP NET FUNCTIONS                                   ####
@@ -376,7 +430,7 @@ def gprs_detach():
     #   0:  IP INITIAL                               #
     #   1:  IP START                                 #
     #   2:  IP CONFIG                                #
-    #   3:  IP GPRSACT                               #          
+    #   3:  IP GPRSACT                               #
     #   4:  IP STATUS                                #
     #   5:  TCP/UDP CONNECTING - SERVER LISTENING    #
     #   6:  CONNECT OK                               #
@@ -393,24 +447,11 @@ def pdp_set_network(apn):
     #   End:    IP START        #
     #############################
 
-    try:
-        at_out = serial_command("AT+CSTT=\""+apn+"\"")
+    at_execute("CSTT=", apn)
 
-    except Exception as e:
-        raise e
-    
 
 def pdp_get_network_configuration():
-
-    try:
-        at_out = serial_command("AT+CSTT?")
-        apn = at_out.split("\"")[1]
-
-    except Exception as e:
-        raise e
-
-    else:
-        return apn
+    return at_execute("CSTT?")
 
 
 def pdp_gprs_call():
@@ -421,11 +462,7 @@ def pdp_gprs_call():
     #   End:    IP GPRSACT      #
     #############################
 
-    try:
-        at_out = serial_command("AT+CIICR")
-
-    except Exception as e:
-        raise e
+    at_execute("CIICR")
 
 
 def pdp_get_ip():
@@ -436,14 +473,7 @@ def pdp_get_ip():
     #   End:    IP STATUS                                                   #
     #########################################################################
 
-    try:
-        at_out = serial_command("AT+CIFSR", exit_word=".",  timeout=10)
-
-    except Exception as e:
-        raise e
-
-    else:
-        return at_out
+    return at_execute("CIFSR")
 
 
 def pdp_shut_gprs():
@@ -453,11 +483,7 @@ def pdp_shut_gprs():
     #   End:    IP INITIAL      #
     #############################
 
-    try:
-        at_out = serial_command("AT+CIPSHUT")
-
-    except Exception as e:
-        raise e
+    at_execute("CIPSHUT")
 
 
 def start_connection(url, port, protocol="UDP"):
@@ -468,33 +494,24 @@ def start_connection(url, port, protocol="UDP"):
     #   End:    CONNECT OK                                        #
     ###############################################################
 
-    try:
-        at_out = serial_command("AT+CIPSTART=\""+protocol+"\",\""+str(url)+"\",\""+str(port)+"\"", exit_word="CONNECT", timeout=160)
-        
-    except Exception as e:
-        raise e
-    
+    at_out = at_execute("CIPSTART=", protocol, url, port)
+
     if "FAIL" in at_out:
         raise ConnectionError("CONNECT FAIL while activating GSM connection")
 
+    if "CONNECT OK" not in at_out:      # Transparent mode: the modem is already in data mode
+        set_data_mode(True)
+
 
 def connection_status():
-    
+
     ##################################
     #   OK                           #
-    #                                #      
+    #                                #
     #   STATE: <state>               #
     ##################################
 
-    try:
-        at_out = serial_command("AT+CIPSTATUS", exit_word="STATE", timeout=1)
-        state = at_out.split(": ")[1]
-
-    except Exception as e:
-        raise e
-
-    else:
-        return state  
+    return at_execute("CIPSTATUS")
 
 
 def stop_connection():
@@ -505,16 +522,12 @@ def stop_connection():
     #   End:    TCP/UDP CLOSED                                    #
     ###############################################################
 
-    try:
-        at_out = serial_command("AT+CIPCLOSE")
-
-    except Exception as e:
-        raise e
+    at_execute("CIPCLOSE")
 
 
-#+CIPPING: 2,"0.0.0.0",60000,255 
+#+CIPPING: 2,"0.0.0.0",60000,255
 def pdp_ping(server, retry=2, size=1, timeout=30, ttl=64):
-    
+
     ###############################################################
     #   retry       = [1, 100]                                    #
     #   size        = [1, 1024]                                   #
@@ -522,51 +535,31 @@ def pdp_ping(server, retry=2, size=1, timeout=30, ttl=64):
     #   ttl         = [1, 255]                                    #
     ###############################################################
 
-    try:
-        at_out = serial_command("AT+CIPPING="+server+","+str(retry)+","+str(size)+","+str(timeout)+","+str(ttl))
-
-    except Exception as e:
-        raise e
-
-    else:
-        if "60000,255" in at_out:
-            return False
-        return True
+    at_out = at_execute("CIPPING=", server, retry, size, timeout, ttl)
+    if "60000,255" in at_out:
+        return False
+    return True
 
 
 def set_transparent_mode(active=True):
-    
-    try:
-        at_out = serial_command("AT+CIPMODE="+str(int(active)))
-
-    except Exception as e:
-        raise e
+    at_execute("CIPMODE=", int(active))
 
 
 def set_packet_format(hex=True):
-
-    try:
-        at_out = serial_command("AT+CIPSENDHEX="+str(int(hex)))
-
-    except Exception as e:
-        raise e
+    at_execute("CIPSENDHEX=", int(hex))
 
 
 def send_packet(message, transparent = True, length = False): # message needs to be coherent to the packet format set before
 
-    try:
-        if transparent:
-            write_to_serial(message, "")
+    if transparent:
+        write_to_serial(message, "")
+    else:
+        if length:
+            at_execute("CIPSEND=", length)
+            serial_command(message, escape_char="", exit_word="</>")
         else:
-            if length:
-                serial_command("AT+CIPSEND="+str(length), ">")
-                serial_command(message, escape_char="", exit_word="</>")
-            else:
-                serial_command("AT+CIPSEND=", ">")
-                at_out = serial_command(message, escape_char=chr(26))
-
-    except Exception as e:
-        raise e  
+            at_execute("CIPSEND=", "")
+            serial_command(message, escape_char=chr(26))
 
 #########################################################################################################
 ####                                  SIM7000 BEARER NET FUNCTIONS                                   ####
@@ -574,28 +567,18 @@ def send_packet(message, transparent = True, length = False): # message needs to
 
     ######################## AT+SAPBR CMD TYPE #####################################
     # 0    Close bearer
-    # 1    Open bearer 
+    # 1    Open bearer
     # 2    Query bearer
     # 3    Set bearer parameters
-    # 4    Get bearer parameters 
+    # 4    Get bearer parameters
     ################################################################################
 
 def bearer_close(cid):
-
-    try:
-        serial_command("AT+SAPBR=0,"+str(cid), timeout=2)
-
-    except Exception as e:
-        raise e
+    at_execute("SAPBR=0", cid)
 
 
 def bearer_open(cid):
-
-    try:
-        serial_command("AT+SAPBR=1,"+str(cid))
-
-    except Exception as e:
-        raise e
+    at_execute("SAPBR=1", cid)
 
 
 def bearer_query(cid):
@@ -608,23 +591,10 @@ def bearer_query(cid):
     # 3    Bearer is closed
     ##################################################################################
 
-    try:
-        at_out = serial_command("AT+SAPBR=2,"+str(cid), timeout=2)
-        code = int(at_out.split(",")[1])
-        ip = at_out.split(",")[2].split("\"")[1]
-
-    except Exception as e:
-        raise e
-
-    else:
-        if code is 0:
-            return "Bearer connecting"
-        if code is 1:
-            return ip # Bearer connected
-        if code is 2:
-            return "Bearer closing"
-        if code is 3:
-            return False        
+    code, ip = at_execute("SAPBR=2", cid)
+    if code == 1:
+        return ip # Bearer connected
+    return BEARER_STATES.get(code)
 
 
 def bearer_set_config(cid, tag, value):
@@ -634,48 +604,26 @@ def bearer_set_config(cid, tag, value):
     # APN           Connection APN
     # USER          Connection Username
     # PWD           Connection Password
-    # PHONENUM      Phone number for CSD call 
+    # PHONENUM      Phone number for CSD call
     # RATE          CSD connection rate -> [0 (2400), 1 (4800), 2 (9600), 3 (14400)]
     #######################################################################################
 
-    try:
-        serial_command("AT+SAPBR=3,"+str(cid)+",\""+tag+"\",\""+value+"\"", timeout=2)
-
-    except Exception as e:
-        raise e
+    at_execute("SAPBR=3", cid, tag, value)
 
 
 def bearer_get_config(cid):
+    return at_execute("SAPBR=4", cid)
 
-    try:
-        at_out = serial_command("AT+SAPBR=4,"+str(cid), timeout=2)
-
-    except Exception as e:
-        raise e 
-
-    else:
-        return at_out
-        
 #########################################################################################################
 ####                                    SIM7000 HTTP NET FUNCTIONS                                   ####
 #########################################################################################################
 
 def http_init():
-
-    try:
-        serial_command("AT+HTTPINIT")
-
-    except Exception as e:
-        raise e
+    at_execute("HTTPINIT")
 
 
 def http_term():
-
-    try:
-        serial_command("AT+HTTPTERM")
-
-    except Exception as e:
-        raise e
+    at_execute("HTTPTERM")
 
 
 def http_set_config(tag, value):
@@ -684,16 +632,13 @@ def http_set_config(tag, value):
     # CID           Connection bearer ID
     # URL           HTTP client URL
     # TIMEOUT       Request timeout, default is 120, minimum is 30
+    # USERDATA      Custom request header (e.g. "Range: bytes=1024-")
     ################################################################################################
 
-    try:
-        if tag is "URL":
-            serial_command("AT+HTTPPARA=\""+tag+"\",\""+str(value)+"\"")
-        else:
-            serial_command("AT+HTTPPARA=\""+tag+"\","+str(value))
-
-    except Exception as e:
-        raise e
+    if tag == "URL" or tag == "USERDATA":
+        at_execute("HTTPPARA=STR", tag, value)
+    else:
+        at_execute("HTTPPARA=", tag, value)
 
 
 def http_action(action, timeout):
@@ -705,68 +650,39 @@ def http_action(action, timeout):
     # 3    DELETE
     ############################################################################################
 
-    try:
-        at_out = serial_command("AT+HTTPACTION="+str(action), exit_word=":", timeout=timeout)
-        result = at_out.split("+HTTPACTION: ")[1]
-        code = int(result.split(",")[1]) 
-        size = int(result.split(",")[2])
+    return at_execute("HTTPACTION=", action, timeout=timeout)
 
-    except Exception as e:
-        raise e
-    
-    else:
-        return code, size
 
+def http_read_chunk(offset, length, timeout = 15):
 
-def http_read(size, binary = False):
+    # +HTTPREAD: <length> followed by <length> raw bytes of the body starting at offset
+    return at_execute("HTTPREAD=", offset, length, timeout=timeout, binary=True, size=length)
 
-    try:
-        at_out = serial_command("AT+HTTPREAD", binary=binary, size=size)
-        if not binary:
-            get_read = at_out.split(" ")[2]
-
-    except Exception as e:
-        raise e
 
-    else:
-        if not binary:
-            return get_read
-        return at_out
+def http_read(size, binary = False):
+    return at_execute("HTTPREAD", binary=binary, size=size)
 
 #########################################################################################################
 ####                                    SIM7000 GNSS/GPS FUNCTIONS                                   ####
 #########################################################################################################
 
 def gps_enable():
-
-    try:
-        serial_command("AT+CGNSPWR=1")
-
-    except Exception as e:
-        raise e
+    at_execute("CGNSPWR=", 1)
 
 
 def gps_disable():
+    at_execute("CGNSPWR=", 0)
 
-    try:
-        serial_command("AT+CGNSPWR=0")
 
-    except Exception as e:
-        raise e
+def gps_get_location():
+    return at_execute("CGNSINF")
 
 
-def gps_get_location():
+def gps_set_report_period(fixes = 1):
 
-    try:
-        at_out = serial_command("AT+CGNSINF")
-        gps_scan = cgnsinf_parser(at_out.split("+CGNSINF: ")[1])
-        
-    except Exception as e:
-        raise e
+    # +UGNSINF (same fields of +CGNSINF) every n fixes, 0 stops the reports
+    at_execute("CGNSURC=", fixes)
 
-    else:
-        return gps_scan
-        
 ############################################# CGNSINF STRING LEGENDA ################################################
 #
 #  +CGNSINF: run_status,fix_status,utc,latitude,longitude,altitude,speed,course,fix_mode,?,hdop,pdop,vdop,?,
@@ -774,7 +690,7 @@ def gps_get_location():
 #
 #   1- run_status:          0 > GPS disabled
 #                           1 > GPS enabled
-#   2- fix_status:          0 > No fix 
+#   2- fix_status:          0 > No fix
 #                           1 > Fix done
 #   3- utc:                 yyyyMMddhhmmss.sss
 #   4- latitude:            ±dd.dddddd
@@ -793,29 +709,110 @@ def gps_get_location():
 #   17- glonass_used_sat:   0-99
 #   18- ?:                  reserved
 #   19- c/n0_max:           0-55 [dBHz]
-#   20- hpa:                0-9999.9 [m]     
+#   20- hpa:                0-9999.9 [m]
 #   21- vpa:                0-9999.9 [m]
 #
 ####################################################################################################################
 
 def cgnsinf_parser(cgnsinf):
+    return GnssFix(cgnsinf.split(","))
+
+############################################ HOT COMMAND PARSERS ####################################################
+#
+#   Parsers of the commands run at every packet or chunk: partition()/find() of the prefix, no regex.
+#   Same results of the table patterns, ATParseError on an unexpected answer.
+#
+####################################################################################################################
+
+def cgnsinf_response_parser(at_out):
+
+    # +CGNSINF: <fields> (no spaces in the fields)
+    fields = at_out.partition("+CGNSINF: ")[2].partition(" ")[0]
+    if not fields:
+        raise ATParseError("Unexpected answer to AT+CGNSINF: "+at_out)
+    return GnssFix(fields.split(","))
+
+
+def csq_parser(at_out):
+
+    # +CSQ: <rssi>,<ber> (no prefix: int("") fails as well)
+    try:
+        return int(at_out.partition("+CSQ: ")[2].partition(",")[0])
+    except ValueError:
+        raise ATParseError("Unexpected answer to AT+CSQ: "+at_out)
+
+
+def httpread_parser(at_out):
+
+    # +HTTPREAD: <length> <data up to the next space>: find() and one slice, the body (up to
+    # HTTP_CHUNK_SIZE bytes) is copied once
+    prefix = at_out.find("+HTTPREAD: ")
+    start = at_out.find(" ", prefix + 11) + 1
+    if prefix == -1 or not start:
+        raise ATParseError("Unexpected answer to AT+HTTPREAD: "+at_out)
+    end = at_out.find(" ", start)
+    return at_out[start:end] if end != -1 else at_out[start:]
+
+#########################################################################################################
+####                                          AT Command Table                                       ####
+#########################################################################################################
+
+    ################################# TABLE ROWS ###################################
+    #   name:   ATCommand(template, pattern, group types, exit word, timeout)      #
+    #           or ATCommand(template, parse=split parser) for the hot commands    #
+    #   The template is filled with str.format: the arguments of at_execute.      #
+    #   Responses are the framed text of serialer ("+CSQ: 18,99 OK").             #
+    ################################################################################
 
-    scan_fields = cgnsinf.split(",")
-    output = []
-    output.append(int(scan_fields[0]))          # run_status
-    if output[0]==1:
-        output.append(int(scan_fields[1]))      # fix_status
-        if output[1]==1:
-            output.append(str(support.gps_date_to_timestamp(scan_fields[2])))  # utc
-            output.append(str(scan_fields[3]))  # latitude
-            output.append(str(scan_fields[4]))  # longitude
-            output.append(str(scan_fields[5]))  # altitude
-            output.append(str(scan_fields[6]))  # speed
-            output.append(str(scan_fields[7]))  # course
-            output.append(str(scan_fields[8]))  # fix_mode
-
-    ############################################# OUTPUT FORMAT ####################################################
-    #   run_status, fix_status, utc, latitude, longitude, altitude, speed, course, fix_mode                        # 
-    ################################################################################################################
-
-    return output
\ No newline at end of file
+AT_TABLE.update({
+    # Basic
+    "AT":           ATCommand("AT", timeout=1),
+    "ATO":          ATCommand("ATO", exit_word="E", timeout=5),
+    "CFUN?":        ATCommand("AT+CFUN?", r"\+CFUN: (\d+)", (int,)),
+    "CFUN=":        ATCommand("AT+CFUN={}"),
+    "CMEE?":        ATCommand("AT+CMEE?", r"\+CMEE: (\d+)", (int,)),
+    "CMEE=":        ATCommand("AT+CMEE={}"),
+    "CNETLIGHT=":   ATCommand("AT+CNETLIGHT={}"),
+    # Cellular
+    "CPIN?":        ATCommand("AT+CPIN?", r"\+CPIN: ((?:SIM |PH_SIM |NOT )?[A-Z0-9]+)", (str,)),
+    "CPIN=":        ATCommand("AT+CPIN=\"{}\""),
+    "CPIN=PUK":     ATCommand("AT+CPIN=\"{}\",\"{}\""),
+    "CLCK=SC":      ATCommand("AT+CLCK=\"SC\",0,\"{}\",1"),
+    "COPS?":        ATCommand("AT+COPS?", r"\+COPS: (\d+)(?:,\d+,\"([^\"]*)\",(\d+))?", (int, str, int)),
+    "COPS=3":       ATCommand("AT+COPS=3,{}"),
+    "CREG?":        ATCommand("AT+CREG?", r"\+CREG: \d+,(\d+)", (int,)),
+    "CSQ":          ATCommand("AT+CSQ", parse=csq_parser),
+    "CGATT=":       ATCommand("AT+CGATT={}"),
+    "CGATT?":       ATCommand("AT+CGATT?", r"\+CGATT: (\d)", (int,)),
+    # TCP/UDP
+    "CSTT=":        ATCommand("AT+CSTT=\"{}\""),
+    "CSTT?":        ATCommand("AT+CSTT?", r"\+CSTT: \"([^\"]*)\"", (str,)),
+    "CIICR":        ATCommand("AT+CIICR"),
+    "CIFSR":        ATCommand("AT+CIFSR", exit_word=".", timeout=10),
+    "CIPSHUT":      ATCommand("AT+CIPSHUT"),
+    "CIPSTART=":    ATCommand("AT+CIPSTART=\"{}\",\"{}\",\"{}\"", exit_word="CONNECT", timeout=160),
+    "CIPSTATUS":    ATCommand("AT+CIPSTATUS", r"STATE: (.+)", (str,), exit_word="STATE", timeout=1),
+    "CIPCLOSE":     ATCommand("AT+CIPCLOSE"),
+    "CIPPING=":     ATCommand("AT+CIPPING={},{},{},{},{}"),
+    "CIPMODE=":     ATCommand("AT+CIPMODE={}"),
+    "CIPSENDHEX=":  ATCommand("AT+CIPSENDHEX={}"),
+    "CIPSEND=":     ATCommand("AT+CIPSEND={}", exit_word=">"),
+    # Bearer
+    "SAPBR=0":      ATCommand("AT+SAPBR=0,{}", timeout=2),
+    "SAPBR=1":      ATCommand("AT+SAPBR=1,{}"),
+    "SAPBR=2":      ATCommand("AT+SAPBR=2,{}", r"\+SAPBR: \d+,(\d+),\"([^\"]*)\"", (int, str), timeout=2),
+    "SAPBR=3":      ATCommand("AT+SAPBR=3,{},\"{}\",\"{}\"", timeout=2),
+    "SAPBR=4":      ATCommand("AT+SAPBR=4,{}", timeout=2),
+    # HTTP
+    "HTTPINIT":     ATCommand("AT+HTTPINIT"),
+    "HTTPTERM":     ATCommand("AT+HTTPTERM"),
+    "HTTPPARA=":    ATCommand("AT+HTTPPARA=\"{}\",{}"),
+    "HTTPPARA=STR": ATCommand("AT+HTTPPARA=\"{}\",\"{}\""),
+    "HTTPACTION=":  ATCommand("AT+HTTPACTION={}", r"\+HTTPACTION: \d+,(\d+),(\d+)", (int, int), exit_word=":"),
+    "HTTPREAD":     ATCommand("AT+HTTPREAD", parse=httpread_parser),
+    "HTTPREAD=":    ATCommand("AT+HTTPREAD={},{}"),
+    # GNSS
+    "CGNSPWR=":     ATCommand("AT+CGNSPWR={}"),
+    "CGNSINF":      ATCommand("AT+CGNSINF", parse=cgnsinf_response_parser),
+    "CGNSURC=":     ATCommand("AT+CGNSURC={}"),
+})
@@ -27,6 +27,7 @@ GPIO_PWR_PIN = 4
 
 CURRENT_NETWORK_IFACE = False
 IFACE_LOCK = threading.Lock()
+UPLINK_LOCK = threading.Lock()  # Held by the uplink scheduler for each datagram, by the supervisor for modem/network tasks
 CURRENT_OPERATOR = False
 CURRENT_RSSI = False
 
@@ -40,14 +41,59 @@ PRODUCE_PACKET_TIMER = 20
 TIME_TO_NEXT_SEND = PRODUCE_PACKET_TIMER
 CONNECTION_CHECK_TIMER = 25
 TURN_OFF_GSM_TIMER = 30
+DATA_SESSION_IDLE_TIMER = 10
+INTERNET_UP_TTL = 60            # Seconds a reachable interface is trusted without probing (refreshed only by probes)
+INTERNET_DOWN_TTL = 10          # Seconds an unreachable interface is not probed again
+WLAN_PROBE_DEADLINE = 3         # Seconds given to the wlan0 pings by the network monitor
+GSM_PROBE_MARGIN = 1            # Seconds added to the worst case of the GSM probe (its own AT timeouts) for its deadline
+GSM_PING_TIMEOUT = 25           # AT+CIPPING timeout in 100 ms units
 NOW_MOVING = False
 LONG_TIME_NO_MOVE = False
 UPDATE_CHECK_TIMER = 60*15
 TIME_SYNC_TIMER = 60*60*2
 T_LAST_TIME_SYNC = 0
+SERIAL_STATS_TIMER = 60*30
+T_LAST_SERIAL_STATS = 0
+CELLULAR_INFO_TIMER = 30        # Operator and RSSI (in every packet) refreshed on any interface
+T_LAST_CELLULAR_INFO = 0
+GNSS_REPORT_FIXES = 1           # +UGNSINF pushed by the modem every n fixes (~1 fix/s)
+GNSS_FIX_MAX_AGE = 5            # Seconds after which the pushed fix is stale and AT+CGNSINF is polled
+GNSS_HELD_FIX_MAX_AGE = 15      # Seconds the fix polled at the last escape is used while the GSM data session is held
+                                # (no reports in data mode): older, the data mode is escaped for a new one
 
 UP_SERVER_LINK = ""
 UP_SERVER_UDP_PORT = 0
+PACKET_FORMAT = "text"          # "text" (semicolon separated), "binary" or "delta" (encoder.py, the server must support it)
+AGGREGATE_QUEUE = False         # Queued packets sent packed in datagrams of at most UPLINK_MTU bytes (the server must support it)
+AGGREGATE_COMPRESS = True       # Aggregated datagrams are deflated with the preset dictionary when it makes them smaller
+COMPRESS_PACKETS = False        # Live packets deflated with the preset dictionary too (the server must support it)
+AGGREGATE_MAX_RECORDS = 64      # Packets taken from the queue for one aggregated datagram
+UPLINK_MTU = 1280               # Bytes per datagram, IP/UDP headers included
+UPLINK_BACKFILL_RATE = 200      # Bytes/s allowance of the GSM uplink (IP/UDP headers and nonce included): live packets
+UPLINK_BACKFILL_BURST = 4096    # always go, queued ones oldest first with what's left, up to a burst of n bytes
+GSM_DAILY_BUDGET = 2000000     # Bytes per day (UTC) over GSM, overhead included: the rest waits for wlan0 (0: no limit)
+GSM_MONTHLY_BUDGET = 50000000  # Bytes per calendar month (UTC) over GSM, the data plan allowance (0: no limit)
+GSM_CLASS_BUDGETS = {          # Bytes per day (UTC) over GSM of each traffic class (accounter.py, 0: no limit)
+    "telemetry": 0,
+    "backlog": 200000,         # Queued packets: the rest waits for wlan0
+    "config": 100000,
+    "firmware": 1000000,       # Checked before each download: a resumed one doesn't fetch the same bytes twice
+    "logs": 50000,
+}
+ACCOUNTING_SAVE_INTERVAL = 60  # Seconds between two saves of the data accounting
+WLAN_MAX_DEFERRAL = 86400       # Seconds queued packets and firmware downloads wait for wlan0 before going over GSM
+UPLINK_IDLE_WAIT = 5            # Seconds the uplink scheduler waits for live packets when there's nothing to backfill
+QUEUE_COMMIT_BATCH = 32         # Pushed packets committed (fsync) together to the packet store
+QUEUE_COMMIT_INTERVAL = 5       # Seconds after which a push is committed at once
+QUEUE_MAX_PACKETS = 200000      # Packet store bound: the oldest packets are dropped over it
+QUEUE_DWELL_SPEED = 3           # km/h under which queued packets are part of a stop
+QUEUE_DWELL_RADIUS = 30         # Meters: a stop keeps its first and last packet only (0 disables)
+QUEUE_SIMPLIFY_TOLERANCE = 10   # Meters of Douglas-Peucker route simplification of the queue (0 disables)
+QUEUE_SIMPLIFY_SEGMENT = 120    # Queued packets simplified together
+QUEUE_DOWNSAMPLE_SIZE = 20000   # Over n queued packets the ones older than QUEUE_DOWNSAMPLE_AGE seconds
+QUEUE_DOWNSAMPLE_AGE = 3600     # are thinned to 1 every QUEUE_DOWNSAMPLE_PERIOD seconds (0 disables)
+QUEUE_DOWNSAMPLE_PERIOD = 60
+KEYFRAME_INTERVAL = 10          # "delta" format: a full packet at least every n packets, deltas from it in between
 
 DOWN_SERVER_LINK = ""
 CONFIG_DOWN_SERVER_LINK = ""
@@ -61,14 +107,15 @@ start_ble_scanner = threading.Event()
 stop_ble_scanner = threading.Event()
 
 start_producer = threading.Event()
-start_exhauster = threading.Event()
-stop_exhauster = threading.Event()
+stop_uplink = threading.Event()
 
 start_gsm_network = threading.Event()
 stop_gsm_network = threading.Event()
 
 connection_check = threading.Event()
 gps_local_time_sync = threading.Event()
+serial_stats_dump = threading.Event()
+cellular_info_update = threading.Event()
 
 start_update_check = threading.Event()
 start_config_downloader = threading.Event()
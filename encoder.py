@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+
+import struct, time, zlib
+
+############################################################################
+####                   GLOBAL VARIABLES AND CONSTANTS                   ####
+############################################################################
+
+FORMAT_VERSION = 1
+
+    ########################### BINARY PACKET V1 ###################################
+    #   version         u8                                                         #
+    #   flags           u8          FLAG_* below                                   #
+    #   device tag      u32         CRC32 of DEVICE_ID                             #
+    #   counter         varint                                                     #
+    #   utc             varint      epoch seconds                                  #
+    #   lat, lon        i32, i32    degrees * 1e6                                  #
+    #   altitude        zigzag      decimeters                                     #
+    #   speed           u16         0.1 km/h                                       #
+    #   course          u16         0.01 degrees                                   #
+    #   cell rssi       u8          CSQ vote, 255 if not known                     #
+    #   produce timer   varint      seconds                                        #
+    #   ble count       u8          then count * (mac 6 bytes, rssi i8)            #
+    #   [static]        if FLAG_STATIC: device id, version, network (u8 len+utf8)  #
+    #   [error]         if FLAG_ERROR: last error (varint len+utf8)                #
+    ################################################################################
+
+    ########################### DELTA PACKET V1 (FLAG_DELTA) #######################
+    #   version, flags, device tag, counter     as above                           #
+    #   keyframe        u8          counter - keyframe counter                     #
+    #   utc             zigzag      seconds from the keyframe                      #
+    #   lat, lon, alt   zigzag      from the keyframe (1e-6 degrees, decimeters)   #
+    #   speed, course   u16, u16    absolute, as above                             #
+    #   cell rssi, produce timer    as above                                       #
+    #   ble removed     u8          then count * keyframe ble index (u8)           #
+    #   ble updated     u8          then count * (keyframe ble index u8, rssi i8)  #
+    #   ble added       u8          then count * (mac 6 bytes, rssi i8)            #
+    #   [error]         if FLAG_ERROR, as above                                    #
+    ################################################################################
+
+    ########################### AGGREGATE DATAGRAM ################################
+    #   marker          u8          AGGREGATE_MARKER or AGGREGATE_DEFLATE_MARKER   #
+    #   [dictionary]    if DEFLATE: u8 preset dictionary version                   #
+    #   records         (varint len + record) * n, zlib stream if DEFLATE marker   #
+    #   A record is a text or binary packet: binary ones start with the version,   #
+    #   text ones with a digit or "-", the markers are neither                     #
+    ################################################################################
+
+    ########################### PRESET DICTIONARY ##################################
+    #   dictionary      PRESET_DICTIONARIES[version], shipped with the server too: #
+    #                   nothing device specific or volatile (BLE macs), so every   #
+    #                   datagram decompresses on its own, none depends on another  #
+    #   The zlib header carries the Adler-32 of the dictionary (FDICT): the server #
+    #   picks the shipped dictionary by it                                         #
+    ################################################################################
+
+AGGREGATE_MARKER = 0xFA
+AGGREGATE_DEFLATE_MARKER = 0xFB
+UDP_IP_OVERHEAD = 28            # IPv4 + UDP headers
+NONCE_SIZE = 8                  # Salsa20 nonce in front of every datagram
+DEFLATE_SLACK = 16              # Upper bound of the deflate overhead on a datagram sized body
+
+PRESET_DICTIONARIES = {         # Never change a published version: add a new one
+    1: b"|no-fix|False;No registration;vodafoneIT;WINDTRE;iliad;ITIM;wlan0;gsm;-9-8-7-6,;20;60;0.0;0.0;",
+}
+DICTIONARY_VERSION = 1
+
+FLAG_STATIC = 0x01              # Static fields included (first packet, on change and every STATIC_REFRESH packets)
+FLAG_ERROR = 0x02               # Last error string included
+FLAG_DELTA = 0x04               # Fields relative to the last keyframe (a full packet with the static block)
+
+HEADER_STRUCT = struct.Struct("<BBI")
+POSITION_STRUCT = struct.Struct("<ii")
+MOTION_STRUCT = struct.Struct("<HH")
+BLE_STRUCT = struct.Struct("<6sb")
+
+STATIC_REFRESH = 50             # Packets between two static blocks when nothing changes (the server may miss one)
+NO_RSSI = 255
+
+LAST_STATIC = None              # Static fields of the last packet carrying them
+PACKETS_SINCE_STATIC = 0
+DEVICE_TAGS = {}                # DEVICE_ID -> CRC32 tag
+
+KEYFRAME = None                 # Reference of the delta packets: counter, utc, fixed-point position, ble tags, static
+BLE_RSSI_DELTA = 6              # dBm change of a keyframe BLE tag that is worth an update
+
+TEXT_FORMATS = ("{:.6f}", "{:.6f}", "{:.3f}", "{:.2f}", "{:.1f}")    # lat, lon, alt, speed, course as printed by AT+CGNSINF
+
+############################################################################
+####                              FUNCTIONS                             ####
+############################################################################
+
+############################### PRIMITIVES #################################
+
+def put_varint(out, value):
+
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def get_varint(data, offset):
+
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def put_string(out, string):
+
+    raw = string.encode("utf-8")[:255]
+    out.append(len(raw))
+    out += raw
+
+
+def get_string(data, offset):
+
+    length = data[offset]
+    offset += 1
+    return bytes(data[offset:offset+length]).decode("utf-8"), offset+length
+
+
+def device_tag(device_id):
+
+    tag = DEVICE_TAGS.get(device_id)
+    if tag is None:
+        tag = DEVICE_TAGS[device_id] = zlib.crc32(device_id.encode("utf-8"))
+    return tag
+
+################################ ENCODERS ##################################
+
+def encode_text_packet(fix, counter, rssi, device_id, version, network, produce_timer, ble_tags, last_error = ""):
+
+    ########################### TEXT PACKET ########################################
+    #   lat;lon;alt;speed;course;rssi;utc;device id;version;                       #
+    #   mac+rssi,mac+rssi..;operator or iface;produce timer;counter;last error     #
+    ################################################################################
+
+    # The fields are written as the modem prints them (the server parses this text): the measures with the
+    # AT+CGNSINF decimals, utc as epoch seconds with one decimal
+    packet = ""
+
+    for value, text_format in zip((fix.latitude, fix.longitude, fix.altitude, fix.speed, fix.course), TEXT_FORMATS):
+        if value is not None:
+            packet += text_format.format(value)
+        packet +=                                                             ";"
+    if rssi:
+        packet += str(rssi)
+    packet +=                                                                 ";"
+    if fix.utc is not None:
+        packet += str(float(fix.utc))
+    packet +=                                                                 ";"
+    packet += device_id                                                     + ";"
+    packet += version                                                       + ";"
+    packet += ",".join(mac.replace(":","") + str(ble_rssi) for mac, ble_rssi in ble_tags)
+    packet +=                                                                 ";"
+    packet += str(network)                                                  + ";"
+    packet += str(produce_timer)                                            + ";"
+    packet += str(counter)                                                  + ";"
+    packet += str(last_error)
+
+    return packet
+
+
+def encode_packet(fix, counter, rssi, device_id, version, network, produce_timer, ble_tags, last_error = ""):
+
+    # ble_tags: iterable of (mac "aa:bb:cc:dd:ee:ff", rssi dBm)
+    global LAST_STATIC, PACKETS_SINCE_STATIC
+
+    static = (device_id, version, network)
+    flags = 0
+    if static != LAST_STATIC or PACKETS_SINCE_STATIC >= STATIC_REFRESH:
+        flags |= FLAG_STATIC
+        LAST_STATIC = static
+        PACKETS_SINCE_STATIC = 0
+    else:
+        PACKETS_SINCE_STATIC += 1
+    if last_error:
+        flags |= FLAG_ERROR
+
+    out = bytearray(HEADER_STRUCT.pack(FORMAT_VERSION, flags, device_tag(device_id)))
+    put_varint(out, counter)
+    put_varint(out, int(fix.utc))
+    encode_position(out, fix)
+    out.append(rssi if rssi is not False and rssi is not None and 0 <= rssi < NO_RSSI else NO_RSSI)
+    put_varint(out, int(produce_timer))
+    encode_ble_tags(out, ble_tags)
+
+    if flags & FLAG_STATIC:
+        put_string(out, device_id)
+        put_string(out, version)
+        put_string(out, str(network))
+    if flags & FLAG_ERROR:
+        raw = last_error.encode("utf-8")
+        put_varint(out, len(raw))
+        out += raw
+
+    return bytes(out)
+
+
+def encode_delta_packet(fix, counter, rssi, device_id, version, network, produce_timer, ble_tags, last_error = "",
+                        keyframe_interval = 10):
+
+    # Full packet (keyframe) at most every keyframe_interval packets, deltas from it in between.
+    # UDP has no acknowledgement: a delta refers to the last keyframe sent and the keyframe interval
+    # bounds what is lost together with a keyframe
+    global KEYFRAME, LAST_STATIC
+
+    ble_tags = list(ble_tags)
+    latitude, longitude, altitude = fixed_point_position(fix)
+    static = (device_id, version, network)
+
+    distance = counter - KEYFRAME["counter"] if KEYFRAME else 0
+    if not 0 < distance < min(keyframe_interval, 256) or static != KEYFRAME["static"]:
+        LAST_STATIC = None                      # Keyframes always carry the static block
+        packet = encode_packet(fix, counter, rssi, device_id, version, network, produce_timer, ble_tags, last_error)
+        KEYFRAME = {"counter": counter, "utc": int(fix.utc), "position": (latitude, longitude, altitude),
+                    "ble": {mac: (index, ble_rssi) for index, (mac, ble_rssi) in enumerate(ble_tags[:255])},
+                    "static": static}
+        return packet
+
+    flags = FLAG_DELTA
+    if last_error:
+        flags |= FLAG_ERROR
+
+    out = bytearray(HEADER_STRUCT.pack(FORMAT_VERSION, flags, device_tag(device_id)))
+    put_varint(out, counter)
+    out.append(distance)
+    put_varint(out, zigzag(int(fix.utc) - KEYFRAME["utc"]))
+    key_latitude, key_longitude, key_altitude = KEYFRAME["position"]
+    put_varint(out, zigzag(latitude - key_latitude))
+    put_varint(out, zigzag(longitude - key_longitude))
+    put_varint(out, zigzag(altitude - key_altitude))
+    encode_motion(out, fix)
+    out.append(rssi if rssi is not False and rssi is not None and 0 <= rssi < NO_RSSI else NO_RSSI)
+    put_varint(out, int(produce_timer))
+    encode_ble_changes(out, ble_tags, KEYFRAME["ble"])
+
+    if flags & FLAG_ERROR:
+        raw = last_error.encode("utf-8")
+        put_varint(out, len(raw))
+        out += raw
+
+    return bytes(out)
+
+
+def fixed_point_position(fix):
+
+    # Missing measures (no previous fix to borrow them from) are sent as 0
+    return round((fix.latitude or 0)*1e6), round((fix.longitude or 0)*1e6), round((fix.altitude or 0)*10)
+
+
+def encode_position(out, fix):
+
+    latitude, longitude, altitude = fixed_point_position(fix)
+    out += POSITION_STRUCT.pack(latitude, longitude)
+    put_varint(out, zigzag(altitude))
+    encode_motion(out, fix)
+
+
+def encode_motion(out, fix):
+    out += MOTION_STRUCT.pack(min(round((fix.speed or 0)*10), 0xFFFF), round((fix.course or 0)*100) % 36000)
+
+
+def encode_ble_changes(out, ble_tags, keyframe_ble):
+
+    # Tags removed from and added to the keyframe set, keyframe tags whose rssi moved by BLE_RSSI_DELTA
+    current = dict(ble_tags)
+    removed = [index for mac, (index, _) in keyframe_ble.items() if mac not in current]
+    updated = [(index, current[mac]) for mac, (index, ble_rssi) in keyframe_ble.items()
+               if mac in current and abs(current[mac] - ble_rssi) >= BLE_RSSI_DELTA]
+    added = [(mac, ble_rssi) for mac, ble_rssi in ble_tags if mac not in keyframe_ble]
+
+    out.append(len(removed))
+    out += bytes(removed)
+    out.append(len(updated))
+    for index, ble_rssi in updated:
+        out.append(index)
+        out += struct.pack("<b", max(-128, min(127, ble_rssi)))
+    encode_ble_tags(out, added)
+
+
+def encode_ble_tags(out, ble_tags):
+
+    count_index = len(out)
+    out.append(0)
+    count = 0
+    for mac, rssi in ble_tags:
+        if count == 255:
+            break
+        out += BLE_STRUCT.pack(bytes.fromhex(mac.replace(":", "")), max(-128, min(127, rssi)))
+        count += 1
+    out[count_index] = count
+
+
+def reset_static():
+
+    # Next packet carries the static block again (after a failed live send, packager.send_live)
+    global LAST_STATIC
+
+    LAST_STATIC = None
+
+
+def is_delta(packet):
+    return isinstance(packet, (bytes, bytearray)) and bool(packet[1] & FLAG_DELTA)
+
+
+def keyframe_counter(packet):
+
+    # Counter of the keyframe a delta refers to, or of the packet itself when it's a full binary packet
+    # (None for text packets)
+    if not isinstance(packet, (bytes, bytearray)):
+        return None
+    counter, offset = get_varint(packet, HEADER_STRUCT.size)
+    if packet[1] & FLAG_DELTA:
+        return counter - packet[offset]
+    return counter
+
+############################### AGGREGATION ################################
+
+def aggregate_records(records, mtu, compress = False):
+
+    # Packs the first records that fit in one datagram of at most mtu bytes (IP headers and nonce included).
+    # Returns the payload and the number of records in it (at least one, even if it's alone over the mtu)
+    max_size = mtu - UDP_IP_OVERHEAD - NONCE_SIZE - 1
+    plain = bytearray()
+    header = bytearray()
+    deflated = bytearray()
+    compressor = None
+    count = 0
+
+    if compress:
+        header.append(DICTIONARY_VERSION)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, zdict=PRESET_DICTIONARIES[DICTIONARY_VERSION])
+        deflated += compressor.compress(b"")
+
+    for record in records:
+        if isinstance(record, str):
+            record = record.encode("utf-8")
+        frame = bytearray()
+        put_varint(frame, len(record))
+        frame += record
+
+        if compressor:
+            # Trial flush only when the records may not fit (deflate grows incompressible data by a few bytes)
+            if count and len(header) + len(plain) + len(frame) > max_size - DEFLATE_SLACK:
+                trial = compressor.copy()
+                if len(header) + len(deflated) + len(trial.compress(frame)) + len(trial.flush()) > max_size:
+                    break
+            deflated += compressor.compress(frame)
+        elif count and len(plain) + len(frame) > max_size:
+            break
+        plain += frame
+        count += 1
+
+    if compressor:
+        deflated += compressor.flush()
+        if len(header) + len(deflated) < len(plain) or len(plain) > max_size:
+            return bytes([AGGREGATE_DEFLATE_MARKER]) + header + deflated, count
+    return bytes([AGGREGATE_MARKER]) + plain, count
+
+
+def is_aggregate(payload):
+    return isinstance(payload, (bytes, bytearray)) and payload[0] in (AGGREGATE_MARKER, AGGREGATE_DEFLATE_MARKER)
+
+
+def split_aggregate(payload):
+
+    # Reference splitter of the aggregate datagrams (the server implements the same)
+    if payload[0] == AGGREGATE_DEFLATE_MARKER:
+        if payload[1] not in PRESET_DICTIONARIES:
+            raise ValueError("Unknown preset dictionary version "+str(payload[1]))
+        dictionary = PRESET_DICTIONARIES[payload[1]]
+        stream = payload[2:]
+        if stream[1] & 0x20:                    # FDICT: Adler-32 of the dictionary after the 2 header bytes
+            dictionary_id = struct.unpack_from(">I", stream, 2)[0]
+            if dictionary_id != zlib.adler32(dictionary):
+                raise ValueError("Unknown preset dictionary "+hex(dictionary_id))
+            body = zlib.decompressobj(15, zdict=dictionary).decompress(stream)
+        else:
+            body = zlib.decompress(stream)
+    elif payload[0] == AGGREGATE_MARKER:
+        body = payload[1:]
+    else:
+        return [payload]
+
+    records = []
+    offset = 0
+    while offset < len(body):
+        length, offset = get_varint(body, offset)
+        records.append(bytes(body[offset:offset+length]))
+        offset += length
+    return records
+
+################################ DECODER ###################################
+
+def decode_packet(data, keyframe = None):
+
+    # Reference decoder of the binary format (the server implements the same).
+    # Delta packets need the decoded keyframe they refer to (its counter is in "keyframe")
+    version, flags, tag = HEADER_STRUCT.unpack_from(data, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unknown packet format version "+str(version))
+
+    packet = {"version": version, "flags": flags, "device_tag": tag}
+    offset = HEADER_STRUCT.size
+    packet["counter"], offset = get_varint(data, offset)
+    if flags & FLAG_DELTA:
+        offset = decode_delta(data, offset, packet, keyframe)
+    else:
+        packet["utc"], offset = get_varint(data, offset)
+        offset = decode_position(data, offset, packet)
+    rssi = data[offset]
+    packet["rssi"] = None if rssi == NO_RSSI else rssi
+    packet["produce_timer"], offset = get_varint(data, offset+1)
+    if flags & FLAG_DELTA:
+        packet["ble"], offset = decode_ble_changes(data, offset, keyframe["ble"])
+    else:
+        packet["ble"], offset = decode_ble_tags(data, offset)
+
+    if flags & FLAG_STATIC:
+        packet["device_id"], offset = get_string(data, offset)
+        packet["fw_version"], offset = get_string(data, offset)
+        packet["network"], offset = get_string(data, offset)
+    if flags & FLAG_ERROR:
+        length, offset = get_varint(data, offset)
+        packet["last_error"] = bytes(data[offset:offset+length]).decode("utf-8")
+        offset += length
+
+    return packet
+
+
+def decode_delta(data, offset, packet, keyframe):
+
+    packet["keyframe"] = packet["counter"] - data[offset]
+    if not keyframe or keyframe["counter"] != packet["keyframe"] or keyframe["device_tag"] != packet["device_tag"]:
+        raise ValueError("Delta packet "+str(packet["counter"])+" without its keyframe "+str(packet["keyframe"]))
+
+    utc, offset = get_varint(data, offset+1)
+    packet["utc"] = keyframe["utc"] + unzigzag(utc)
+    latitude, offset = get_varint(data, offset)
+    packet["latitude"] = (round(keyframe["latitude"]*1e6) + unzigzag(latitude))/1e6
+    longitude, offset = get_varint(data, offset)
+    packet["longitude"] = (round(keyframe["longitude"]*1e6) + unzigzag(longitude))/1e6
+    altitude, offset = get_varint(data, offset)
+    packet["altitude"] = (round(keyframe["altitude"]*10) + unzigzag(altitude))/10
+    speed, course = MOTION_STRUCT.unpack_from(data, offset)
+    packet["speed"] = speed/10
+    packet["course"] = course/100
+    for field in ("device_id", "fw_version", "network"):
+        packet[field] = keyframe[field]
+    return offset+MOTION_STRUCT.size
+
+
+def decode_position(data, offset, packet):
+
+    latitude, longitude = POSITION_STRUCT.unpack_from(data, offset)
+    packet["latitude"] = latitude/1e6
+    packet["longitude"] = longitude/1e6
+    altitude, offset = get_varint(data, offset+POSITION_STRUCT.size)
+    packet["altitude"] = unzigzag(altitude)/10
+    speed, course = MOTION_STRUCT.unpack_from(data, offset)
+    packet["speed"] = speed/10
+    packet["course"] = course/100
+    return offset+MOTION_STRUCT.size
+
+
+def decode_ble_tags(data, offset):
+
+    count = data[offset]
+    offset += 1
+    tags = []
+    for _ in range(count):
+        mac, rssi = BLE_STRUCT.unpack_from(data, offset)
+        tags.append((mac.hex(), rssi))
+        offset += BLE_STRUCT.size
+    return tags, offset
+
+
+def decode_ble_changes(data, offset, keyframe_ble):
+
+    tags = list(keyframe_ble)
+    count = data[offset]
+    removed = set(data[offset+1:offset+1+count])
+    offset += 1+count
+    count = data[offset]
+    offset += 1
+    for _ in range(count):
+        index, rssi = struct.unpack_from("<Bb", data, offset)
+        tags[index] = (tags[index][0], rssi)
+        offset += 2
+    tags = [tag for index, tag in enumerate(tags) if index not in removed]
+    added, offset = decode_ble_tags(data, offset)
+    return tags + added, offset
+
+
+def debug_print_packet(packet, show_date = True, show_gps = True):
+
+    # Same summary of support.debug_print_packet for the binary packets
+    if packet[0] == AGGREGATE_DEFLATE_MARKER:
+        return "Deflated aggregate, "+str(len(packet))+" bytes"
+    if packet[0] == AGGREGATE_MARKER:
+        return "Aggregate of "+str(len(split_aggregate(packet)))+" records, "+str(len(packet))+" bytes"
+    if packet[1] & FLAG_DELTA:
+        # No keyframe at hand when the packet leaves the queue: counter and reference only
+        counter, offset = get_varint(packet, HEADER_STRUCT.size)
+        return str(counter) + "_delta of " + str(counter - packet[offset])
+
+    fields = decode_packet(packet)
+    output = str(fields["counter"]) + "_"
+    if show_date:
+        output += time.strftime('%H:%M:%S', time.gmtime(fields["utc"]))
+    output += " | BLE: "+str(len(fields["ble"]))
+    if show_gps:
+        output += " | "+str(fields["latitude"])+" "+str(fields["longitude"])+" "+str(fields["speed"])
+    return output
@@ -14,6 +14,12 @@ LOGGER = None
 
 PWRKEY = None
 
+MODEM_INITIALISED = False           # init_comms_layer() done since the last power cycle: URCs of the boots and inits
+                                    # started here are expected, only the ones after it trigger a recovery
+
+GNSS_LAST_FIX = None                # Last fix pushed by the modem (+UGNSINF) or polled
+GNSS_T_LAST_FIX = 0                 # Local time of the last fix
+
 #########################################################################################################
 ####                                            FUNCTIONS                                            ####
 #########################################################################################################
@@ -28,21 +34,31 @@ def init_modemdler():
 
     LOGGER = support.CustomLogger("mod")
     PWRKEY = gpiozero.OutputDevice(config.GPIO_PWR_PIN, active_high = True)
+    ser.register_urc_handler("RDY", urc_modem_ready)
+    ser.register_urc_handler("+CPIN:", urc_sim_status)
+    ser.register_urc_handler("+UGNSINF:", urc_gnss_fix)
+    ser.register_escape_handler(escape_poll_fix)
+    ser.start_serial_reader()
     modem_pwr_on()
 
 
 def init_comms_layer():
 
+    global MODEM_INITIALISED
+
+    MODEM_INITIALISED = False
     at.set_at_netlight()
     at.set_at_error_output(2)
     at.set_operator_out()
     at.gps_enable()
+    at.gps_set_report_period(config.GNSS_REPORT_FIXES)
     if config.SIM_APN and (config.SIM_APN != at.pdp_get_network_configuration() or config.SIM_APN not in at.bearer_get_config(1)):
         at.pdp_shut_gprs()
         at.set_transparent_mode()
         at.pdp_set_network(config.SIM_APN)
         at.pdp_shut_gprs()
         at.bearer_set_config(1, "APN", config.SIM_APN)
+    MODEM_INITIALISED = True
     return
 
 
@@ -50,6 +66,7 @@ def modem_stuck_recovery():
 
     LOGGER.debug("> Modem data mode recovery")
 
+    ser.set_data_mode(False)        # Probe the modem as it is, without the automatic escape
     try:
         at.check_serial()
     
@@ -82,13 +99,107 @@ def modem_stuck_recovery():
     return
 
 
+def urc_modem_ready(line):
+
+    # The modem rebooted by itself (brown-out, watchdog): its software configuration is lost.
+    # During a power on or an init started here it's the expected boot: the sequence configures the modem
+    if not MODEM_INITIALISED:
+        LOGGER.debug("> URC: "+line)
+        return
+    modem_lost_configuration(line)
+
+
+def urc_sim_status(line):
+
+    # READY and the transient NOT READY are normal, and so is everything while booting (SIM PIN included):
+    # after the init a SIM removed (NOT INSERTED) or locked again (modem rebooted) needs the init again
+    if not MODEM_INITIALISED or "READY" in line:
+        LOGGER.debug("> URC: "+line)
+        return
+    modem_lost_configuration(line)
+
+
+def modem_lost_configuration(line):
+
+    global MODEM_INITIALISED
+
+    # One recovery per event: the URCs that follow it (RDY, +CPIN) belong to the init it triggers
+    LOGGER.warning("> URC: "+line)
+    MODEM_INITIALISED = False
+    config.thread_comm("M3")
+
+
+def urc_gnss_fix(line):
+
+    try:
+        fix = at.cgnsinf_parser(line[len("+UGNSINF:"):].strip())
+
+    except Exception as e:
+        LOGGER.warning("> Bad GNSS report: "+line)
+        return
+
+    set_last_fix(fix)
+
+
+def set_last_fix(fix):
+
+    global GNSS_LAST_FIX, GNSS_T_LAST_FIX
+
+    # Reports held by the modem in data mode come out at the escape, older than the fix polled then: not newer, not kept
+    if GNSS_LAST_FIX is not None and fix.utc is not None and GNSS_LAST_FIX.utc is not None and fix.utc < GNSS_LAST_FIX.utc:
+        return
+    GNSS_LAST_FIX = fix
+    GNSS_T_LAST_FIX = time.time()
+
+
+def gnss_last_fix(max_age = None):
+
+    # Last pushed or polled fix (no serial round trip), None if older than max_age (the reports stopped)
+    if GNSS_LAST_FIX is None or time.time()-GNSS_T_LAST_FIX > (max_age or config.GNSS_FIX_MAX_AGE):
+        return None
+    return GNSS_LAST_FIX
+
+
+def poll_fix():
+
+    gps_scan = at.gps_get_location()
+    if isinstance(gps_scan, at.GnssFix):
+        set_last_fix(gps_scan)
+    return gps_scan
+
+
+def escape_poll_fix():
+
+    # Escape handler: the modem is in command mode for another reason (AT command, idle data session, monitor),
+    # the fix is polled then if the reports are stale, without an escape of its own
+    if gnss_last_fix() is None:
+        poll_fix()
+
+
+def gps_get_fix():
+
+    # Pushed fix when fresh, otherwise a AT+CGNSINF poll. The modem doesn't push reports in data mode: while the
+    # GSM data session is held the fix polled at the last escape is used up to config.GNSS_HELD_FIX_MAX_AGE,
+    # older the data mode is escaped for it (the escape handler polls it).
+    # Check and poll are one serial transaction: the uplink can't write a datagram in between.
+    with ser.SERIAL_LOCK:
+        gps_scan = gnss_last_fix()
+        if gps_scan is None and ser.data_mode_active():
+            gps_scan = gnss_last_fix(config.GNSS_HELD_FIX_MAX_AGE)
+            if gps_scan is None:
+                at.toggle_cmd_mode()
+                gps_scan = gnss_last_fix()
+        if gps_scan is None:
+            gps_scan = poll_fix()
+    return gps_scan
+
+
 def get_gps_time():
 
     try:
-        gps_scan = at.gps_get_location()
-        if gps_scan[0]==1:      # GPS is active
-            if gps_scan[1]==1:  # GPS fix is done
-                return gps_scan[2]
+        gps_scan = gps_get_fix()
+        if gps_scan.fixed():    # GPS is active and the fix is done
+            return gps_scan.utc
         return False
         
     except Exception as e:
@@ -125,6 +236,9 @@ def modem_pwr_toggle():
 
 def modem_pwr_on():
 
+    global MODEM_INITIALISED
+
+    MODEM_INITIALISED = False
     LOGGER.debug("> Booting up modem..")
     on = False
     while not on:
@@ -146,6 +260,9 @@ def modem_pwr_on():
 
 def modem_pwr_off():
 
+    global MODEM_INITIALISED
+
+    MODEM_INITIALISED = False
     LOGGER.debug("> Shutting down modem..")
     off = False
     while not off:
@@ -166,6 +283,12 @@ def modem_pwr_off():
 
 def modem_pwr_reset():
 
+    # The serial stats (latencies, learned deadlines and their backoff) describe the modem before the reset:
+    # logged and started again, the adaptive timeouts learn the rebooted one from scratch
+    LOGGER.info("> Serial stats before the modem reset:")
+    for line in ser.command_stats_report():
+        LOGGER.info(">> "+line)
+
     try:
         modem_pwr_off()
         modem_pwr_on()
@@ -174,6 +297,8 @@ def modem_pwr_reset():
         raise e
     
     else:
+        ser.reset_command_stats()
+        config.T_LAST_SERIAL_STATS = time.time()        # The next periodic dump covers the stats since the reset
         LOGGER.debug("> Reset complete")
     
 #---------------------------------------------------------------------------
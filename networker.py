@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
-import socket, time
+import asyncio, socket, struct, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from Crypto.Cipher import Salsa20
 
-import config, support
+import accounter, config, encoder, support
 from config import thread_comm
 import commander as at
+import serialer as ser
 
 ############################################################################
 ####                   GLOBAL VARIABLES AND CONSTANTS                   ####
@@ -20,6 +22,31 @@ T_GSM_TURN_OFF = 0
 
 GSM_ACTIVATED = False
 
+HTTP_CHUNK_SIZE = 4096      # Bytes read with each AT+HTTPREAD=<offset>,<len> when streaming to file
+HTTP_CHUNK_TIMEOUT = 10
+
+UDP_SOCKETS = {}            # Interface -> UDP socket bound to it and connected to the up server
+UDP_SOCKETS_LOCK = threading.Lock()
+SO_BINDTODEVICE = 25
+
+LINK_WATCHER = None         # rtnetlink thread notifying the link changes of the watched interfaces
+LINK_WATCHED = ("wlan0",)
+LINK_STATE = {}             # Interface -> last link state seen by the watcher
+
+SYS_NET_PATH = "/sys/class/net/"
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_LINK_MSGS = (16, 17)    # RTM_NEWLINK, RTM_DELLINK
+RTM_ADDR_MSGS = (20, 21)    # RTM_NEWADDR, RTM_DELADDR
+
+INTERNET_STATE = {}         # Interface -> (reachable, time of the last evidence), per process: the tunneller
+                            # keeps its own copy, refreshed only by its own probes
+INTERNET_STATE_LOCK = threading.Lock()
+PING_HOSTS = ("1.1.1.1", "8.8.8.8")
+GSM_PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsm-probe")     # Outlives asyncio.run()
+
+DEFERRED_TASKS = {}         # Task -> time it was first deferred waiting for wlan0
+
 ############################################################################
 ####                              FUNCTIONS                             ####
 ############################################################################
@@ -31,6 +58,9 @@ def init_networker():
     global LOGGER
 
     LOGGER = support.CustomLogger("net")
+    ser.register_urc_handler("+PDP: DEACT", urc_connection_lost)
+    ser.register_urc_handler("CLOSED", urc_connection_lost)
+    start_link_watcher()
     return
 
 
@@ -40,54 +70,174 @@ def network_monitor():
 
     #LOGGER.debug("Checking connection..")
 
-    update_cellular_info()
+    # wlan0 and GSM probed together, each one within its own deadline (the GSM pings only if wlan0 isn't usable)
+    wlan_up, gsm_up = asyncio.run(probe_networks())
 
-    if iface_status("wlan0"):
-        if check_internet("wlan0"):
+    with config.IFACE_LOCK:
+        if wlan_up:
             config.T_LAST_TIME_SYNC = time.time()
-            if config.CURRENT_NETWORK_IFACE is not "wlan0":     ##### CHANGE NETWORK INTERFACE USED IN WLAN
+            if config.CURRENT_NETWORK_IFACE != "wlan0":     ##### CHANGE NETWORK INTERFACE USED IN WLAN
                 LOGGER.info("[~~~] "+str(config.CURRENT_NETWORK_IFACE)+" ----> wlan0")
-                if config.CURRENT_NETWORK_IFACE is "gsm" or GSM_ACTIVATED:
+                if config.CURRENT_NETWORK_IFACE == "gsm" or GSM_ACTIVATED:
                     T_GSM_TURN_OFF = time.time()
                 config.CURRENT_NETWORK_IFACE = "wlan0"
+                close_udp_sockets("wlan0")
             else:
                 if T_GSM_TURN_OFF != 0:
                     if (time.time()-T_GSM_TURN_OFF)>config.TURN_OFF_GSM_TIMER:
                         thread_comm("N2")
                         T_GSM_TURN_OFF = 0
             return
-        # else:
-        #     LOGGER.warning("> Linked to a WiFi network but not access to internet")
-    # else:
-    #     LOGGER.warning("> No known WiFi network in range")
 
-    try:
-        if "CONNECT OK" in at.connection_status():
-            if check_internet("gsm"):
-                if config.CURRENT_NETWORK_IFACE is not "gsm":       ##### CHANGE NETWORK INTERFACE USED IN GSM
-                    LOGGER.debug("[~~~] "+str(config.CURRENT_NETWORK_IFACE)+" ----> gsm")
-                    config.CURRENT_NETWORK_IFACE = "gsm"
-                    if T_GSM_TURN_OFF != 0:
-                        T_GSM_TURN_OFF = 0
-            else:
-                LOGGER.warning("> GSM connection is active but ping doesn't work")
+        if gsm_up is True:
+            if config.CURRENT_NETWORK_IFACE != "gsm":       ##### CHANGE NETWORK INTERFACE USED IN GSM
+                LOGGER.debug("[~~~] "+str(config.CURRENT_NETWORK_IFACE)+" ----> gsm")
+                config.CURRENT_NETWORK_IFACE = "gsm"
+                close_udp_sockets()
+                if T_GSM_TURN_OFF != 0:
+                    T_GSM_TURN_OFF = 0
             return
-    
-    except Exception as e:
-        LOGGER.exception(e)
-        return
 
-    LOGGER.warning("> No internet connections active")
-    
-    if config.CURRENT_NETWORK_IFACE is not False:
-        LOGGER.debug("[~~~] "+str(config.CURRENT_NETWORK_IFACE)+" ----> False")
-        config.CURRENT_NETWORK_IFACE = False                        ##### CHANGE NETWORK INTERFACE USED IN FALSE (NO CONNECTION)
+        if gsm_up is False:
+            LOGGER.warning("> GSM connection is active but ping doesn't work")
+            return
+
+        if gsm_up == "error":
+            # Modem busy or not answering: keep the current interface until the next check
+            return
+
+        LOGGER.warning("> No internet connections active")
+
+        if config.CURRENT_NETWORK_IFACE is not False:
+            LOGGER.debug("[~~~] "+str(config.CURRENT_NETWORK_IFACE)+" ----> False")
+            config.CURRENT_NETWORK_IFACE = False                        ##### CHANGE NETWORK INTERFACE USED IN FALSE (NO CONNECTION)
+            close_udp_sockets()
 
     config.thread_comm("N1")
 
     return
 
 
+async def probe_networks():
+
+    # The GSM probe starts with wlan0 but at low priority: its local steps (escape, connection status) overlap
+    # the wlan0 pings, its own pings (modem airtime) wait for their result and are skipped when wlan0 is up
+    wlan_result = Future()
+    gsm_probe = asyncio.ensure_future(probe_gsm(wlan_result))
+    wlan_up = False
+    try:
+        wlan_up = await probe_wlan()
+    finally:
+        wlan_result.set_result(wlan_up)
+
+    if wlan_up:
+        # Not waited for: the probe thread stops before the pings by itself
+        gsm_probe.cancel()
+        await asyncio.gather(gsm_probe, return_exceptions=True)
+        return True, None
+    return False, await gsm_probe
+
+
+async def probe_wlan():
+
+    if not iface_status("wlan0"):
+        return False
+    reachable = cached_internet_state("wlan0")
+    if reachable is not None:
+        return reachable
+
+    reachable = await first_positive([fping("wlan0", host) for host in PING_HOSTS], config.WLAN_PROBE_DEADLINE)
+    set_internet_state("wlan0", reachable)
+    return reachable
+
+
+async def fping(iface, host):
+
+    process = await asyncio.create_subprocess_exec("fping", "--quiet", "--alive", "--iface", iface, "--retry=2", host,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        output, _ = await process.communicate()
+
+    except asyncio.CancelledError as e:
+        # Another probe answered first or the deadline expired: the killed fping is reaped (no zombie)
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise e
+
+    return bool(output.strip())
+
+
+async def first_positive(probes, deadline):
+
+    tasks = [asyncio.ensure_future(probe) for probe in probes]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=deadline):
+            try:
+                if await next_done:
+                    return True
+
+            except asyncio.TimeoutError as e:
+                raise e
+
+            except Exception as e:
+                continue
+        return False
+
+    except asyncio.TimeoutError:
+        return False
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)     # Until the cancelled probes are cleaned up
+
+
+async def probe_gsm(wlan_result):
+
+    # The modem has a single UART: its probe runs in a thread and the result is dropped after the deadline
+    # (a late probe keeps running in the background, the monitor doesn't wait for it)
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(GSM_PROBE_EXECUTOR, gsm_connection_probe, wlan_result),
+                                      gsm_probe_deadline())
+
+    except asyncio.TimeoutError:
+        LOGGER.warning("> GSM probe deadline expired")
+        return "error"
+
+
+def gsm_probe_deadline():
+
+    # Worst case of gsm_connection_probe from its own timeouts: escape from the data mode (and the fix polled
+    # on it), connection status, the wait for the wlan0 probe and one ping per host (AT+CIPPING answers
+    # within retry*timeout, retry=1)
+    return (ser.ESCAPE_GUARD_TIME + ser.ESCAPE_TIMEOUT + ser.TIMEOUT_CEILINGS["CGNSINF"] + at.AT_TABLE["CIPSTATUS"].timeout
+            + config.WLAN_PROBE_DEADLINE + len(PING_HOSTS)*config.GSM_PING_TIMEOUT/10 + config.GSM_PROBE_MARGIN)
+
+
+def gsm_connection_probe(wlan_result):
+
+    ##############################################################
+    #   True        Connected and internet reachable             #
+    #   False       Connected but the ping doesn't work          #
+    #   None        No GSM connection                            #
+    #   "error"     Modem error                                  #
+    ##############################################################
+
+    # wlan_result: Future of the concurrent wlan0 probe, the pings wait for it (None: wlan0 up, not needed)
+    try:
+        if "CONNECT OK" not in at.connection_status():
+            return None
+        if wlan_result.result():
+            return None
+        return check_internet("gsm")
+
+    except Exception as e:
+        LOGGER.exception(e)
+        return "error"
+
+
 def gsm_network_activation():
     
     global GSM_ACTIVATED
@@ -100,9 +250,7 @@ def gsm_network_activation():
             else:
                 LOGGER.debug("> Modem already connected")
                 return
-        rssi = at.get_rssi()
-        reg_status = at.get_registration_status()
-        operator = at.get_operator()
+        operator, rssi, reg_status = at.get_cellular_info()
         LOGGER.debug("> Modem is "+reg_status+" at "+operator+" ("+str(rssi)+")")
     
     except Exception as e:
@@ -134,6 +282,7 @@ def gsm_network_activation():
         at.toggle_cmd_mode()
         LOGGER.info("> Modem connected via GSM")
         GSM_ACTIVATED = True
+        invalidate_internet_state("gsm")
         return True
 
     except Exception as e:
@@ -147,6 +296,7 @@ def gsm_network_deactivation():
     try:
         at.pdp_shut_gprs()
         LOGGER.info("> GSM connection deactivation")
+        invalidate_internet_state("gsm")
         return True
 
     except Exception as e:
@@ -166,9 +316,7 @@ def bearer_network_activation():
                 return True
 
         # FROM HERE ON THE BEARER CAN BE CREATED SINCE IT'S SURELY NOT ALREADY OPEN
-        rssi = at.get_rssi()
-        reg_status = at.get_registration_status()
-        operator = at.get_operator()
+        operator, rssi, reg_status = at.get_cellular_info()
         if rssi > -105 and (reg_status is "Registered" or reg_status is "Roaming"):
             at.bearer_open(1)
         else:
@@ -207,8 +355,10 @@ def bearer_network_deactivation():
         return False
 
 
-def http_get(url, timeout, binary):
+def http_get(url, timeout, binary, traffic_class = "config"):
 
+    # The modem pulls the whole body over GSM with HTTPACTION: that's the size charged, read or not
+    size = 0
     try:
         try:
             at.http_term()
@@ -231,66 +381,207 @@ def http_get(url, timeout, binary):
     except Exception as e:
         LOGGER.exception(e)
         return False
+    finally:
+        accounter.count_http("gsm", traffic_class, size)
+
+
+def http_get_to_file(url, timeout, out_file, offset = 0, progress = None, traffic_class = "config"):
+
+    # Streams the body to out_file chunk by chunk: the whole download is never held in memory.
+    # With offset the download resumes asking the server only the missing bytes (Range header);
+    # progress(offset, size) is called after every chunk and stops the download returning False.
+    # The size reported by HTTPACTION is charged: skipped (Range ignored) and unread bytes came over GSM too
+    size = 0
+    try:
+        try:
+            at.http_term()
+        except Exception as e:
+            pass
+        at.http_init()
+
+        at.http_set_config("CID", 1)
+        at.http_set_config("URL", url)
+        if offset:
+            at.http_set_config("USERDATA", "Range: bytes="+str(offset)+"-")
+
+        code, size = at.http_action(0, timeout)
+        if code == 206:         # Only the missing bytes are in the modem buffer
+            total_size = offset+size
+            read_pos = 0
+        elif code == 200:       # Range not honoured: the whole file is in the modem buffer
+            total_size = size
+            read_pos = offset
+        else:
+            LOGGER.warning(">> GET Request failed: "+str(code))
+            return False
+
+        if progress and not progress(offset, total_size):
+            return False
+        while read_pos < size:
+            chunk = at.http_read_chunk(read_pos, min(HTTP_CHUNK_SIZE, size-read_pos), HTTP_CHUNK_TIMEOUT)
+            out_file.write(chunk)
+            read_pos += len(chunk)
+            offset += len(chunk)
+            if progress and not progress(offset, total_size):
+                return False
+        at.http_term()
+
+        if offset != total_size:
+            LOGGER.warning(">> GET Request incomplete: "+str(offset)+"/"+str(total_size))
+            return False
+        return total_size
+
+    except Exception as e:
+        LOGGER.exception(e)
+        return False
+    finally:
+        accounter.count_http("gsm", traffic_class, size)
 
 # --------------------------- NETWORK STATUS UTILITIES ------------------------------
 
-def send_udp_packet(message, interface, loop = False):
+def urc_connection_lost(line):
+
+    global GSM_ACTIVATED
+
+    # PDP context or UDP connection dropped by the network: check the connection right away
+    LOGGER.warning("> URC: "+line)
+    GSM_ACTIVATED = False
+    ser.set_data_mode(False)        # The modem leaves the data mode by itself
+    invalidate_internet_state("gsm")
+    config.thread_comm("N0")
+
+
+def send_udp_packet(message, interface, traffic_class = "telemetry"):
 
     if interface:
         salsa_cipher = Salsa20.new(key=config.SALSA_KEY) 
-        enc_msg = salsa_cipher.nonce + salsa_cipher.encrypt(bytes(message, encoding='utf-8'))
+        if isinstance(message, str):
+            payload = bytes(message, encoding='utf-8')
+        else:
+            payload = message       # Binary packet or aggregate (encoder.py)
+        if config.COMPRESS_PACKETS and not encoder.is_aggregate(payload):
+            deflated = encoder.aggregate_records([payload], config.UPLINK_MTU, True)[0]
+            if deflated[0] == encoder.AGGREGATE_DEFLATE_MARKER:
+                payload = deflated
+        enc_msg = salsa_cipher.nonce + salsa_cipher.encrypt(payload)
 
         if interface is "gsm":
+            # The data session stays open between packets: it's closed by the next AT command or when idle.
+            # Mode check and raw write are one serial transaction: no AT command (GNSS poll, idle escape)
+            # can put the modem back in command mode in between and swallow the datagram
             try:
-                if loop:
-                    at.send_packet(enc_msg)
-                else:
-                    if not at.toggle_data_mode():
+                with ser.SERIAL_LOCK:
+                    if not at.ensure_data_mode():
                         LOGGER.warning("UDP Packet Send Failed: no active connection")
+                        invalidate_internet_state(interface)
                         return False
                     at.send_packet(enc_msg)
 
             except Exception as e:
                 LOGGER.error("UDP Packet Send Failed: "+str(e))
                 LOGGER.exception(e)
-                return False
-            
-            try:
-                if not loop:
-                    at.toggle_cmd_mode()
-            
-            except Exception as e:
-                LOGGER.error(">> Toggle CMD mode failed")
-                config.thread_comm("M2")
+                invalidate_internet_state(interface)
                 return False
 
         else:
+            # No reachability probe per packet: a failed send drops the socket and the monitor checks the link
             try:
-                opened_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                opened_socket.settimeout(3)
-                opened_socket.setsockopt(socket.SOL_SOCKET, 25, str(interface + '\0').encode('utf-8'))
-                if not check_internet(interface):
-                    LOGGER.warning("> No internet connection with wlan0 interface")
-                    return False
-                opened_socket.sendto(enc_msg, (config.UP_SERVER_LINK, config.UP_SERVER_UDP_PORT))
+                get_udp_socket(interface).send(enc_msg)
 
             except socket.timeout:
                 LOGGER.warning("> UDP Packet Send Failed: timeout reached!")
+                close_udp_socket(interface)
+                invalidate_internet_state(interface)
                 return False
 
             except socket.gaierror:
                 LOGGER.warning("> UDP Packet Send Failed: network error!")
+                close_udp_socket(interface)
+                invalidate_internet_state(interface)
                 return False
 
             except OSError:
                 LOGGER.warning("> UDP Packet Send Failed: other error!")
+                close_udp_socket(interface)
+                invalidate_internet_state(interface)
                 return False
 
-        LOGGER.info(support.debug_print_packet(message))
+        # A local send is no proof of reachability (it succeeds on a link with no upstream): the cache is
+        # refreshed only by the probes, a send failure just invalidates it
+        accounter.count_datagram(interface, traffic_class, len(enc_msg))
+        if isinstance(message, str):
+            LOGGER.info(support.debug_print_packet(message))
+        else:
+            LOGGER.info(encoder.debug_print_packet(message))
+        return True
+    return False
+
+
+def get_udp_socket(iface):
+
+    with UDP_SOCKETS_LOCK:
+        udp_socket = UDP_SOCKETS.get(iface)
+        if udp_socket is None:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                udp_socket.settimeout(3)
+                udp_socket.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, str(iface + '\0').encode('utf-8'))
+                udp_socket.connect((config.UP_SERVER_LINK, config.UP_SERVER_UDP_PORT))     # Server name resolved once
+
+            except Exception as e:
+                udp_socket.close()
+                raise e
+            UDP_SOCKETS[iface] = udp_socket
+
+    return udp_socket
+
+
+def close_udp_socket(iface):
+
+    with UDP_SOCKETS_LOCK:
+        udp_socket = UDP_SOCKETS.pop(iface, None)
+    if udp_socket is not None:
+        udp_socket.close()
+
+
+def close_udp_sockets(keep = None):
+
+    # Sockets of the interfaces not in use anymore (e.g. after a handover)
+    for iface in list(UDP_SOCKETS):
+        if iface != keep:
+            close_udp_socket(iface)
+
+
+def defer_to_wlan(task):
+
+    # Bulk transfers wait for wlan0 while on GSM, for config.WLAN_MAX_DEFERRAL seconds at most
+    if config.CURRENT_NETWORK_IFACE != "gsm":
+        DEFERRED_TASKS.pop(task, None)
+        return False
+
+    if task not in DEFERRED_TASKS:
+        DEFERRED_TASKS[task] = time.time()
+        LOGGER.info("> "+task+" deferred until wlan0 is available")
+    if time.time()-DEFERRED_TASKS[task] < config.WLAN_MAX_DEFERRAL:
         return True
+
+    LOGGER.warning("> "+task+" waited "+support.calc_str_time(time.time()-DEFERRED_TASKS.pop(task))+" for wlan0: going over GSM")
     return False
 
 
+def data_session_monitor():
+
+    # Idle check and escape together: a datagram written in between would make the session not idle
+    with ser.SERIAL_LOCK:
+        if at.data_mode_active() and at.data_mode_idle() > config.DATA_SESSION_IDLE_TIMER:
+            try:
+                at.toggle_cmd_mode()
+
+            except Exception as e:
+                LOGGER.error(">> Toggle CMD mode failed")
+                config.thread_comm("M2")
+
+
 def flow_controller(caller, speed = False):
 
     global STOP_HIST_COUNTER
@@ -337,13 +628,130 @@ def flow_controller(caller, speed = False):
 
 def iface_status(iface):
 
-    if iface in support.bash_cmd("ifconfig -s", timeout=0.1):
-        return True
-    return False
+    # Link state from sysfs: "unknown" is reported by drivers without operstate, then the carrier tells
+    try:
+        with open(SYS_NET_PATH+iface+"/operstate", "r") as operstate_file:
+            operstate = operstate_file.read().strip()
+        if operstate == "up":
+            return True
+        if operstate == "unknown":
+            with open(SYS_NET_PATH+iface+"/carrier", "r") as carrier_file:
+                return carrier_file.read().strip() == "1"
+        return False
+
+    except OSError:
+        # Interface missing or down (carrier can't be read on a down interface)
+        return False
+
+
+def link_watcher_thread():
+
+    try:
+        netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        netlink.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+
+    except Exception as e:
+        LOGGER.warning("> Link watcher not available, link changes seen only by the connection check: "+str(e))
+        return
+
+    for iface in LINK_WATCHED:
+        LINK_STATE[iface] = iface_status(iface)
+
+    while True:
+        try:
+            data = netlink.recv(65535)
+        except OSError as e:
+            LOGGER.exception(e)
+            time.sleep(1)
+            continue
+
+        changed = set()
+        offset = 0
+        while offset+16 <= len(data):
+            msg_len, msg_type = struct.unpack_from("=LH", data, offset)
+            if msg_len < 16:
+                break
+            if msg_type in RTM_LINK_MSGS:
+                changed.add(struct.unpack_from("=i", data, offset+20)[0])       # ifinfomsg.ifi_index
+            elif msg_type in RTM_ADDR_MSGS:
+                changed.add(struct.unpack_from("=I", data, offset+20)[0])       # ifaddrmsg.ifa_index
+            offset += (msg_len+3) & ~3
+
+        for index in changed:
+            try:
+                iface = socket.if_indextoname(index)
+            except OSError:
+                iface = None        # Interface removed: check all the watched ones
+            for watched in LINK_WATCHED:
+                if iface is None or iface == watched:
+                    link_changed(watched)
+
+
+def link_changed(iface):
+
+    link_up = iface_status(iface)
+    if LINK_STATE.get(iface) == link_up:
+        return
+    LINK_STATE[iface] = link_up
+
+    # Handover right away instead of waiting for the next connection check
+    LOGGER.info("> Link "+iface+(" up" if link_up else " down"))
+    invalidate_internet_state(iface)
+    close_udp_socket(iface)
+    config.connection_check.set()
+
+
+def start_link_watcher():
+
+    global LINK_WATCHER
+
+    if LINK_WATCHER is None or not LINK_WATCHER.is_alive():
+        LINK_WATCHER = threading.Thread(target=link_watcher_thread, daemon=True)
+        LINK_WATCHER.start()
+
+    return
 
 
 def check_internet(iface):
 
+    # Cached reachability: the interface is probed only when the last evidence is older than its TTL
+    reachable = cached_internet_state(iface)
+    if reachable is not None:
+        return reachable
+
+    reachable = probe_internet(iface)
+    set_internet_state(iface, reachable)
+    return reachable
+
+
+def cached_internet_state(iface):
+
+    with INTERNET_STATE_LOCK:
+        state = INTERNET_STATE.get(iface)
+    if state is None:
+        return None
+    reachable, t_state = state
+    ttl = config.INTERNET_UP_TTL if reachable else config.INTERNET_DOWN_TTL
+    if time.time()-t_state < ttl:
+        return reachable
+    return None
+
+
+def set_internet_state(iface, reachable):
+
+    with INTERNET_STATE_LOCK:
+        INTERNET_STATE[iface] = (reachable, time.time())
+
+
+def invalidate_internet_state(iface):
+
+    # Next check_internet() will probe again
+    with INTERNET_STATE_LOCK:
+        INTERNET_STATE.pop(iface, None)
+
+
+def probe_internet(iface):
+
     # if iface is False:
     #     return False
     try:
@@ -357,10 +765,9 @@ def check_internet(iface):
             return False
         
         if iface is "gsm":
-            if at.pdp_ping("1.1.1.1"):
-                return True
-            if at.pdp_ping("8.8.8.8"):
-                return True
+            for host in PING_HOSTS:
+                if at.pdp_ping(host, retry=1, timeout=config.GSM_PING_TIMEOUT):
+                    return True
             return False
     
     except Exception as e:
@@ -371,7 +778,6 @@ def check_internet(iface):
 def update_cellular_info():
     
     try:
-        config.CURRENT_OPERATOR = at.get_operator()
-        config.CURRENT_RSSI = at.get_rssi(False)
+        config.CURRENT_OPERATOR, config.CURRENT_RSSI, reg_status = at.get_cellular_info(False)
     except Exception as e:
         LOGGER.exception(e)
\ No newline at end of file
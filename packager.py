@@ -1,12 +1,10 @@
 #!/usr/bin/env python3
 
 from logging.handlers import QueueListener
-import time, math
-from time import sleep
+import os, queue, time, math, zlib
 import pickle
-from queue import LifoQueue
 
-import blendler, config, networker, support
+import accounter, blendler, config, encoder, modemdler, networker, queuer, support
 import commander as at
 
 
@@ -18,10 +16,20 @@ COUNTER = 0
 
 LOGGER = None
 
-PACKET_LIFO_QUEUE = LifoQueue()                           # In this queue are stored the packets ready to be sent in LiFo criteria
+PACKET_STORE = "pakq.db"                                        # Disk-backed queue of the packets ready to be sent (queuer.py)
+LIVE_QUEUE = queue.Queue()                                      # Fresh packets from the producer to the uplink scheduler
 
-LAST_GPS_SCAN = ["-", "-", "-", "-", "-", "-", "-", "-", "-"]   # Last GPS scan for reliability purposes (not resetting GPS)
+UPLINK_TOKENS = 0                                               # Token bucket (bytes) of the uplink allowance
+T_UPLINK_TOKENS = 0
+BACKFILL_DEFERRED = False                                       # GSM budget used up, backfill waits for wlan0
+LIVE_DEFERRED = False                                           # GSM budget used up, live packets are queued
+LAST_KEYFRAME = None                                            # (counter, packet) of the newest keyframe produced (delta format)
+LIVE_KEYFRAME = None                                            # Counter of the last keyframe delivered live
+HELD_KEYFRAME = None                                            # (packet, meta) of a keyframe to queue, pinned if a delta follows it
+
+LAST_GPS_SCAN = None                                            # Last GPS fix for reliability purposes (not resetting GPS)
 GPS_FAIL = 0                                                    # Consecutive GPS fails counter
+GPS_PACKET_FIELDS = ("utc", "latitude", "longitude", "altitude", "speed", "course")     # Fix fields needed by a packet
 
 OMEGA = math.pi/60
 TZERO = 0                                          
@@ -44,36 +52,38 @@ def init_packager():
 
 def packet_producer():
 
+    # (packet, meta) for packet_handler, False if no packet could be built
     global LAST_GPS_SCAN, OMEGA, TZERO, GPS_FAIL
 
     #LOGGER.debug("Getting GPS coordinates..")
     try:
-        gps_scan = at.gps_get_location()
+        gps_scan = modemdler.gps_get_fix()
     except Exception as e:
         LOGGER.exception(e)
         gps_scan = False
       
     if gps_scan:
         
-        if gps_scan[0]==1:      # GPS is active
-            if gps_scan[1]==1:  # GPS fix is done
+        if gps_scan.active():      # GPS is active
+            if gps_scan.fixed():    # GPS fix is done
 
                 already_failed = False
 
-                for i, field in enumerate(gps_scan):
-                    if not field:
+                for field in GPS_PACKET_FIELDS:
+                    if getattr(gps_scan, field) is None:
                         LOGGER.warning(">> Error on GPS scan: "+str(gps_scan))
-                        if "-" not in LAST_GPS_SCAN[i]:
-                            gps_scan[i] = LAST_GPS_SCAN[i]
                         if not already_failed:
                             already_failed = True
+                            gps_scan = gps_scan.copy()      # The pushed fix is shared with modemdler
                             GPS_FAIL += 1
                             if GPS_FAIL >= 5:
                                 config.thread_comm("M1gps")
                                 GPS_FAIL = 0
+                        if LAST_GPS_SCAN:
+                            setattr(gps_scan, field, getattr(LAST_GPS_SCAN, field))
 
                 try:
-                    networker.flow_controller("gps", float(gps_scan[6]))
+                    networker.flow_controller("gps", gps_scan.speed)
 
                 except Exception as e:
                     LOGGER.warning(">> Error on GPS scan after flow controller: "+str(gps_scan))
@@ -96,8 +106,9 @@ def packet_producer():
                 LOGGER.warning("> No fix")
                 networker.flow_controller("nofix")
 
-                if "-" not in LAST_GPS_SCAN:
-                    LAST_GPS_SCAN[2] = support.get_utc_timestamp()
+                if LAST_GPS_SCAN:
+                    LAST_GPS_SCAN = LAST_GPS_SCAN.copy()
+                    LAST_GPS_SCAN.utc = int(time.time())
                     config.LAST_ERROR += "|no-fix|"
                     return build_packet(LAST_GPS_SCAN)
                 
@@ -116,70 +127,231 @@ def packet_producer():
         return False
 
 
-def packet_handler(packet):
+def packet_handler(record):
+
+    # Hands a fresh (packet, meta) from the producer to the uplink scheduler: it's sent before any queued one
+    LIVE_QUEUE.put(record)
+
+
+def uplink_thread():
+
+    # Live first: the freshest packet is sent as soon as it's produced (older ones still waiting are queued).
+    # Then one queued datagram at a time, oldest first, while the allowance of config.UPLINK_BACKFILL_RATE allows
+    LOGGER.info("> Starting the uplink scheduler")
+    wait = 0
+    while not config.stop_uplink.is_set():
+        records = []
+        try:
+            records.append(LIVE_QUEUE.get(timeout=wait))
+            while not LIVE_QUEUE.empty():
+                records.append(LIVE_QUEUE.get())
+        except queue.Empty:
+            pass
+
+        try:
+            with config.UPLINK_LOCK:
+                if records:
+                    for packet, meta in records[:-1]:
+                        remember_keyframe(packet)
+                        queue_packet(packet, meta)
+                    send_live(*records[-1])
+                wait = backfill()
+        except Exception as e:
+            LOGGER.exception(e)
+            wait = config.UPLINK_IDLE_WAIT
+    else:
+        LOGGER.warning("> Shutting down the uplink scheduler")
+        config.stop_uplink.clear()
+
+
+def send_live(packet, meta):
+
+    global LIVE_DEFERRED
+
+    remember_keyframe(packet)
+
+    # Over the GSM budget the packet waits in the queue like the ones produced offline
+    if not accounter.allowed(config.CURRENT_NETWORK_IFACE, "telemetry", len(packet)+encoder.NONCE_SIZE+encoder.UDP_IP_OVERHEAD):
+        if not LIVE_DEFERRED:
+            LOGGER.warning("> GSM data budget used ("+str(accounter.usage("gsm"))+" bytes today): live packets wait for wlan0")
+        LIVE_DEFERRED = True
+        queue_packet(packet, meta)
+        return
+    LIVE_DEFERRED = False
+
+    # A delta is decoded only with its keyframe: when that wasn't delivered live (superseded by a newer record,
+    # queued or lost with a failed send) it goes first, the server may get it again with the backfill
+    reference = encoder.keyframe_counter(packet) if encoder.is_delta(packet) else None
+    if reference is not None and reference != LIVE_KEYFRAME and LAST_KEYFRAME is not None and LAST_KEYFRAME[0] == reference:
+        sent = deliver_live(LAST_KEYFRAME[1]) and deliver_live(packet)
+    else:
+        sent = deliver_live(packet)
 
-    if not networker.send_udp_packet(packet, config.CURRENT_NETWORK_IFACE):
+    if not sent:
         config.thread_comm("N0")
-        PACKET_LIFO_QUEUE.put(packet)
+        encoder.reset_static()          # The next packets describe the device again (static block) until one is delivered
+        queue_packet(packet, meta)
 
 
-def queue_exhauster():
+def deliver_live(packet):
 
-    data = False
-    LOGGER.debug("> Emptying the packets queue..")
-    try:
-        if config.CURRENT_NETWORK_IFACE is "gsm":
-            at.toggle_data_mode()
-        data = True
-        while not PACKET_LIFO_QUEUE.empty() and not config.start_producer.is_set() and not config.connection_check.is_set():
-            current_packet = PACKET_LIFO_QUEUE.get()
-            PACKET_LIFO_QUEUE.task_done()
-
-            if not networker.send_udp_packet(current_packet, config.CURRENT_NETWORK_IFACE, True):
-                PACKET_LIFO_QUEUE.put(current_packet)
-                config.connection_check.set()
-                break
-            sleep(0.1)
+    global LIVE_KEYFRAME, HELD_KEYFRAME
+
+    if not uplink_send(packet):
+        return False
+    if config.PACKET_FORMAT == "delta" and not encoder.is_delta(packet):
+        LIVE_KEYFRAME = encoder.keyframe_counter(packet)
+    if HELD_KEYFRAME is not None:
+        # The next deltas refer to the keyframe delivered live: no queued delta will refer to the held one
+        if encoder.keyframe_counter(HELD_KEYFRAME[0]) == LIVE_KEYFRAME:
+            HELD_KEYFRAME = None                # Delivered already
         else:
-            if config.CURRENT_NETWORK_IFACE is "gsm":
-                try:
-                    at.toggle_cmd_mode()
+            flush_held_keyframe()
+    return True
 
-                except Exception as e:
-                    LOGGER.error(">> Toggle CMD mode failed")
-                    config.thread_comm("M2")
 
-            if PACKET_LIFO_QUEUE.empty():
-                LOGGER.debug("> Packets queue is empty")
-            else:
-                LOGGER.debug("> Emptying queue stopped")
-    
-    except Exception as e:
-        LOGGER.exception(e)
-        if data:
-            try:
-                at.toggle_cmd_mode()
-            except Exception as e:
-                LOGGER.error(">> Toggle CMD mode failed")
-                config.thread_comm("M2")
-                return False
+def queue_packet(packet, meta):
+
+    # A queued keyframe is pinned (never dropped by the backlog policies) only if a queued delta refers to it:
+    # it's held until the next packet is queued, which tells. Without queued deltas it's a packet like the others
+    global HELD_KEYFRAME
+
+    if HELD_KEYFRAME is not None:
+        held_packet, held_meta = HELD_KEYFRAME
+        HELD_KEYFRAME = None
+        if encoder.is_delta(packet) and encoder.keyframe_counter(packet) == encoder.keyframe_counter(held_packet):
+            held_meta = held_meta[:5] + (True,)
+        queuer.push(held_packet, held_meta)
+
+    if config.PACKET_FORMAT == "delta" and meta is not None and not encoder.is_delta(packet):
+        HELD_KEYFRAME = (packet, meta)
+    else:
+        queuer.push(packet, meta)
+
+
+def flush_held_keyframe():
+
+    global HELD_KEYFRAME
 
+    if HELD_KEYFRAME is not None:
+        queuer.push(*HELD_KEYFRAME)
+        HELD_KEYFRAME = None
 
-def packet_lifo_queue_empty():
-    return PACKET_LIFO_QUEUE.empty()
+
+def remember_keyframe(packet):
+
+    # Records reach the scheduler in production order: a delta refers to the newest keyframe before it
+    global LAST_KEYFRAME
+
+    if config.PACKET_FORMAT == "delta" and isinstance(packet, bytes) and not encoder.is_delta(packet):
+        LAST_KEYFRAME = (encoder.keyframe_counter(packet), packet)
+
+
+def backfill():
+
+    # Sends one datagram of queued packets, returns the seconds to wait before the next one
+    if queuer.empty() or not config.CURRENT_NETWORK_IFACE or config.connection_check.is_set():
+        return config.UPLINK_IDLE_WAIT
+
+    if config.CURRENT_NETWORK_IFACE == "gsm":
+        # wlan0 is free and fast: on GSM the backfill is paced and has a daily budget
+        if not gsm_backfill_allowed():
+            return config.UPLINK_IDLE_WAIT
+        tokens = uplink_tokens()
+        if tokens < 0:
+            return -tokens/config.UPLINK_BACKFILL_RATE
+
+    if config.AGGREGATE_QUEUE:
+        sent = send_aggregate(newest=False)
+    else:
+        packet_id, packet = queuer.peek(1, newest=False)[0]
+        sent = uplink_send(packet, backfill=True)
+        if sent:
+            queuer.remove([packet_id])
+
+    if not sent:
+        config.connection_check.set()
+        return config.UPLINK_IDLE_WAIT
+    if queuer.empty():
+        LOGGER.debug("> Packets queue is empty")
+    return 0
+
+
+def send_aggregate(newest = True):
+
+    # One datagram (one nonce) with as many queued packets as fit in config.UPLINK_MTU
+    rows = queuer.peek(config.AGGREGATE_MAX_RECORDS, newest)
+    payload, count = encoder.aggregate_records([packet for _, packet in rows], config.UPLINK_MTU, config.AGGREGATE_COMPRESS)
+    if not uplink_send(payload, backfill=not newest):
+        return False
+
+    queuer.remove([packet_id for packet_id, _ in rows[:count]])     # The others stay at the same end of the queue
+    return True
+
+
+def uplink_send(payload, backfill = False):
+
+    # Every GSM datagram is charged to the allowance, failed ones too (airtime is spent anyway)
+    global UPLINK_TOKENS
+
+    if config.CURRENT_NETWORK_IFACE == "gsm":
+        uplink_tokens()
+        UPLINK_TOKENS -= len(payload) + encoder.UDP_IP_OVERHEAD + encoder.NONCE_SIZE
+    return networker.send_udp_packet(payload, config.CURRENT_NETWORK_IFACE, "backlog" if backfill else "telemetry")
+
+
+def gsm_backfill_allowed():
+
+    # Within the backlog budget, or past it (not past the GSM daily and monthly ones) when the oldest queued
+    # packet waited config.WLAN_MAX_DEFERRAL for wlan0
+    global BACKFILL_DEFERRED
+
+    if accounter.allowed("gsm", "backlog"):
+        BACKFILL_DEFERRED = False
+        return True
+
+    oldest = queuer.oldest_utc()
+    if oldest is not None and time.time()-oldest > config.WLAN_MAX_DEFERRAL and accounter.allowed("gsm", "backlog", class_budget=False):
+        if BACKFILL_DEFERRED:
+            LOGGER.warning("> Queued packets waited too long for wlan0: backfilling over GSM")
+        BACKFILL_DEFERRED = False
+        return True
+
+    if not BACKFILL_DEFERRED:
+        LOGGER.info("> GSM backfill budget used ("+str(accounter.usage("gsm", "backlog"))+" bytes): "+str(queuer.size())+" packets wait for wlan0")
+    BACKFILL_DEFERRED = True
+    return False
+
+
+def uplink_tokens():
+
+    global UPLINK_TOKENS, T_UPLINK_TOKENS
+
+    t_now = time.monotonic()
+    UPLINK_TOKENS = min(config.UPLINK_BACKFILL_BURST, UPLINK_TOKENS + (t_now-T_UPLINK_TOKENS)*config.UPLINK_BACKFILL_RATE)
+    T_UPLINK_TOKENS = t_now
+    return UPLINK_TOKENS
 
 
 def packet_queue_load():
-    
-    global PACKET_LIFO_QUEUE
+
+    # Opens the packet store (packets left by a crash are replayed from it) and moves there the old pickled queue
+    try:
+        count = queuer.init_queuer(config.BAK_PATH+PACKET_STORE)
+        LOGGER.info("> "+str(count)+" packets in the queue store")
+    except Exception as e:
+        LOGGER.exception(e)
+        LOGGER.error(">> Error opening the queue store: "+str(e))
+        return
 
     try:
         with open(config.BAK_PATH+"pakq.bak","rb") as queue_save_file:
             queue_list = pickle.load(queue_save_file)
-            for element in queue_list:
-                PACKET_LIFO_QUEUE.put(element)
-            support.bash_cmd("rm pakq.bak")
-            LOGGER.info("> Loaded "+ str(len(queue_list)) +" packets from queue backup file")
+        for element in queue_list:              # Oldest first, as they were put in the LifoQueue
+            queuer.push(element)
+        queuer.flush()
+        os.remove(config.BAK_PATH+"pakq.bak")
+        LOGGER.info("> Loaded "+ str(len(queue_list)) +" packets from queue backup file")
     except FileNotFoundError:
         LOGGER.info("> No QUEUE backup file found")
     except Exception as e:
@@ -189,13 +361,11 @@ def packet_queue_load():
 
 def packet_queue_dump():
 
+    # Packets are on disk already: only the not yet committed ones are written
     try:
-        if not PACKET_LIFO_QUEUE.empty():
-            with open(config.BAK_PATH+"pakq.bak","wb") as queue_save_file:
-                pickle.dump(list(PACKET_LIFO_QUEUE.queue), queue_save_file)
-            LOGGER.info("> Saved "+ str(len(PACKET_LIFO_QUEUE.queue)) +" packets to file")
-            return True
-        LOGGER.info("> Queue is empty")
+        flush_held_keyframe()
+        queuer.flush()
+        LOGGER.info("> "+ str(queuer.size()) +" packets in the queue store")
         return True
     except Exception as e:
         LOGGER.exception(e)
@@ -213,43 +383,33 @@ def build_packet(coords):
 
     if COUNTER>99999:
         COUNTER = 0
-    
-    count = 0
-
-    packet = ""
-
-    packet += coords[3]                                                     + ";"
-    packet += coords[4]                                                     + ";"
-    packet += coords[5]                                                     + ";"
-    packet += str(coords[6])                                                + ";"
-    packet += coords[7]                                                     + ";"
-    if config.CURRENT_RSSI:
-        packet += str(config.CURRENT_RSSI)
-    packet +=                                                                 ";"
-    packet += coords[2]                                                     + ";"
-    packet += config.DEVICE_ID                                              + ";"
-    packet += config.VERSION                                                + ";"
-    
-    for ble in blendler.BLE_LIST:
-        if ble.vis is 1:
-            print_ble = ""
-            if count is not 0:
-                print_ble = ","
-            print_ble += ble.mac.replace(":","") + str(ble.rssi)
-            packet += print_ble
-            count += 1
-
-    packet +=                                                                 ";"
-    if config.CURRENT_NETWORK_IFACE is "gsm":
-        packet += str(config.CURRENT_OPERATOR)                              + ";"
+
+    if config.CURRENT_NETWORK_IFACE == "gsm":
+        network = config.CURRENT_OPERATOR
     else:
-        packet += str(config.CURRENT_NETWORK_IFACE)                         + ";"
-    packet += str(config.PRODUCE_PACKET_TIMER)                              + ";"
-    packet += str(COUNTER)                                                  + ";"
-    packet += str(config.LAST_ERROR)                
+        network = config.CURRENT_NETWORK_IFACE
+    ble_tags = [(ble.mac, ble.rssi) for ble in blendler.BLE_LIST if ble.vis == 1]
+
+    if config.PACKET_FORMAT == "delta":
+        packet = encoder.encode_delta_packet(coords, COUNTER, config.CURRENT_RSSI, config.DEVICE_ID, config.VERSION, network,
+                                             config.PRODUCE_PACKET_TIMER, ble_tags, config.LAST_ERROR, config.KEYFRAME_INTERVAL)
+    else:
+        if config.PACKET_FORMAT == "binary":
+            encode = encoder.encode_packet
+        else:
+            encode = encoder.encode_text_packet
+        packet = encode(coords, COUNTER, config.CURRENT_RSSI, config.DEVICE_ID, config.VERSION, network,
+                        config.PRODUCE_PACKET_TIMER, ble_tags, config.LAST_ERROR)
+
+    # Meta of the packet store: visible tags as CRC32, errors never dropped (keyframes are pinned when queued, queue_packet)
+    tags = zlib.crc32(",".join(sorted(mac for mac, _ in ble_tags)).encode("utf-8"))
+    pinned = bool(config.LAST_ERROR)
+    meta = None
+    if coords.latitude is not None and coords.longitude is not None:
+        meta = (int(coords.utc), coords.latitude, coords.longitude, coords.speed or 0, tags, pinned)
 
     config.LAST_ERROR = ""
 
-    return packet
+    return packet, meta
 
 #---------------------------------------------------------------------------
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import math, sqlite3, threading, time
+
+import config, support
+
+############################################################################
+####                   GLOBAL VARIABLES AND CONSTANTS                   ####
+############################################################################
+
+LOGGER = None
+
+DB = None                                                       # SQLite (WAL) connection of the packet store
+QUEUE_LOCK = threading.Lock()                                   # Producer and uplink scheduler share the store
+
+PENDING = []                                                    # Pushed (packet, meta) not committed yet (small in-RAM head)
+COUNT = 0                                                       # Packets in the store, pending ones included
+T_LAST_COMMIT = 0
+
+TAIL = []                                                       # Last two rows (id, meta) for the dwell collapse
+UNSIMPLIFIED = 0                                                # Rows with a position not simplified yet
+NEWEST_UTC = 0                                                  # Newest packet time in the store
+DOWNSAMPLED_UTC = 0                                             # Packets older than this are downsampled already
+
+EARTH_RADIUS = 6371000
+
+    ############################ PACKET STORE ######################################
+    #   packets(id INTEGER PRIMARY KEY, payload, utc, latitude, longitude, speed,  #
+    #           tags, pinned, simplified)                                          #
+    #   id grows with the push order: newest end = max id, oldest end = min id     #
+    #   payload keeps its type: TEXT for text packets, BLOB for binary ones        #
+    #   meta (utc .. pinned) is NULL for packets pushed without it: never dropped  #
+    #   tags is a CRC32 of the visible BLE macs, pinned packets are never dropped  #
+    #   A packet whose tags differ from the previous one (BLE enter/leave) is      #
+    #   pinned when committed                                                      #
+    #   Packets are removed only after they're sent: a crash between the send and #
+    #   the remove sends them again (at least once delivery)                       #
+    ################################################################################
+
+    ############################ BACKLOG POLICIES ##################################
+    #   Run as packets are committed, in the same transaction:                     #
+    #   dwell       a stop (speed, radius, same tags) keeps its first and its      #
+    #               last packet only (arrival and departure)                       #
+    #   simplify    Douglas-Peucker on lat/lon every QUEUE_SIMPLIFY_SEGMENT        #
+    #               packets, pinned packets and segment ends are kept              #
+    #   downsample  over QUEUE_DOWNSAMPLE_SIZE packets, the ones older than        #
+    #               QUEUE_DOWNSAMPLE_AGE are thinned to 1 per period               #
+    #   Past QUEUE_MAX_PACKETS the oldest packets are dropped anyway               #
+    ################################################################################
+
+META_COLUMNS = ("utc", "latitude", "longitude", "speed", "tags", "pinned")
+
+############################################################################
+####                              FUNCTIONS                             ####
+############################################################################
+
+def init_queuer(path):
+
+    global LOGGER, DB, T_LAST_COMMIT
+
+    LOGGER = support.CustomLogger("que")
+
+    with QUEUE_LOCK:
+        DB = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        DB.execute("PRAGMA journal_mode=WAL")
+        DB.execute("PRAGMA synchronous=FULL")               # One fsync per commit: commits are batched
+        DB.execute("CREATE TABLE IF NOT EXISTS packets (id INTEGER PRIMARY KEY, payload BLOB NOT NULL)")
+
+        # Stores written before the backlog policies get the meta columns (NULL meta: kept as they are)
+        columns = [row[1] for row in DB.execute("PRAGMA table_info(packets)")]
+        for column, declaration in (("utc", "INTEGER"), ("latitude", "REAL"), ("longitude", "REAL"), ("speed", "REAL"),
+                                    ("tags", "INTEGER"), ("pinned", "INTEGER NOT NULL DEFAULT 1"),
+                                    ("simplified", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                DB.execute("ALTER TABLE packets ADD COLUMN "+column+" "+declaration)
+
+        reload_counters()
+        reload_tail()
+        T_LAST_COMMIT = time.monotonic()
+
+    return COUNT
+
+
+def push(packet, meta = None):
+
+    # meta: (utc, latitude, longitude, speed, tags, pinned) of the packet, needed by the backlog policies.
+    # Committed with the next batch: at once if the last commit is older than QUEUE_COMMIT_INTERVAL
+    global COUNT
+
+    with QUEUE_LOCK:
+        PENDING.append((packet, meta))
+        COUNT += 1
+        if len(PENDING) >= config.QUEUE_COMMIT_BATCH or time.monotonic()-T_LAST_COMMIT >= config.QUEUE_COMMIT_INTERVAL:
+            commit_pending()
+
+
+def peek(count = 1, newest = True):
+
+    # (id, packet) of up to count packets from the newest (LiFo) or the oldest (FiFo) end, newest first if LiFo
+    with QUEUE_LOCK:
+        commit_pending()
+        order = "DESC" if newest else "ASC"
+        return DB.execute("SELECT id, payload FROM packets ORDER BY id "+order+" LIMIT ?", (count,)).fetchall()
+
+
+def oldest_utc():
+
+    # Time of the oldest packet with meta, None if there's none
+    with QUEUE_LOCK:
+        commit_pending()
+        row = DB.execute("SELECT utc FROM packets WHERE utc IS NOT NULL ORDER BY id LIMIT 1").fetchone()
+        return row[0] if row else None
+
+
+def remove(ids):
+
+    # Not synced on its own (one fsync per sent datagram): the next synced commit makes it durable with it.
+    # A remove lost on power failure only means the packets are sent again (at least once delivery)
+    global COUNT
+
+    if not ids:
+        return
+    with QUEUE_LOCK:
+        DB.execute("PRAGMA synchronous=NORMAL")
+        try:
+            removed = DB.execute("DELETE FROM packets WHERE id IN ("+",".join("?"*len(ids))+")", ids).rowcount
+        finally:
+            DB.execute("PRAGMA synchronous=FULL")
+        COUNT -= removed
+        if any(row_id in ids for row_id, _ in TAIL):
+            reload_tail()
+
+
+def pop(newest = True):
+
+    rows = peek(1, newest)
+    if not rows:
+        return None
+    remove([rows[0][0]])
+    return rows[0][1]
+
+
+def size():
+    return COUNT
+
+
+def empty():
+    return COUNT == 0
+
+
+def flush():
+
+    with QUEUE_LOCK:
+        commit_pending()
+
+
+def close():
+
+    global DB
+
+    with QUEUE_LOCK:
+        if DB is not None:
+            commit_pending()
+            DB.close()
+            DB = None
+
+
+def commit_pending():
+
+    # Called with QUEUE_LOCK held: one transaction (one fsync) for the whole batch and its policies.
+    # On failure nothing is written: the batch stays pending and the counters are read back from the table
+    global COUNT, T_LAST_COMMIT, UNSIMPLIFIED, NEWEST_UTC, DOWNSAMPLED_UTC
+
+    if not PENDING:
+        return
+
+    downsampled_utc = DOWNSAMPLED_UTC
+    DB.execute("BEGIN")
+    try:
+        for packet, meta in PENDING:
+            if meta is None:
+                meta = (None, None, None, None, None, True)
+            elif meta[0] is not None:
+                NEWEST_UTC = max(NEWEST_UTC, meta[0])
+                UNSIMPLIFIED += 1
+            collapse_dwell(meta)
+            meta = pin_tags_change(meta)
+            row_id = DB.execute("INSERT INTO packets (payload, utc, latitude, longitude, speed, tags, pinned) VALUES (?,?,?,?,?,?,?)",
+                                (packet,)+tuple(meta)).lastrowid
+            TAIL.append((row_id, meta))
+            del TAIL[:-2]
+
+        if config.QUEUE_SIMPLIFY_TOLERANCE and UNSIMPLIFIED >= config.QUEUE_SIMPLIFY_SEGMENT:
+            simplify_segment()
+        if config.QUEUE_DOWNSAMPLE_PERIOD and COUNT > config.QUEUE_DOWNSAMPLE_SIZE:
+            downsample()
+
+        if COUNT > config.QUEUE_MAX_PACKETS:
+            # The oldest packets are dropped: the store is bounded as the SD card is
+            dropped = DB.execute("DELETE FROM packets WHERE id IN (SELECT id FROM packets ORDER BY id ASC LIMIT ?)",
+                                 (COUNT - config.QUEUE_MAX_PACKETS,)).rowcount
+            COUNT -= dropped
+            reload_tail()
+            LOGGER.warning("> Packet store full: dropped the "+str(dropped)+" oldest packets")
+        DB.execute("COMMIT")
+    except Exception as e:
+        if DB.in_transaction:
+            DB.execute("ROLLBACK")
+        DOWNSAMPLED_UTC = downsampled_utc
+        reload_counters()
+        reload_tail()
+        raise e
+    del PENDING[:]
+
+    T_LAST_COMMIT = time.monotonic()
+
+
+def reload_counters():
+
+    # Pending packets are counted by push, their utc by the commit
+    global COUNT, UNSIMPLIFIED, NEWEST_UTC
+
+    COUNT = DB.execute("SELECT COUNT(*) FROM packets").fetchone()[0] + len(PENDING)
+    UNSIMPLIFIED = DB.execute("SELECT COUNT(*) FROM packets WHERE simplified = 0 AND utc IS NOT NULL").fetchone()[0]
+    NEWEST_UTC = DB.execute("SELECT MAX(utc) FROM packets").fetchone()[0] or 0
+
+
+def reload_tail():
+
+    TAIL[:] = [(row[0], row[1:]) for row in reversed(DB.execute(
+        "SELECT id, "+", ".join(META_COLUMNS)+" FROM packets ORDER BY id DESC LIMIT 2").fetchall())]
+
+
+############################# BACKLOG POLICIES #############################
+
+def collapse_dwell(meta):
+
+    # The last row goes if it's in the middle of a stop together with the one before it and the new one
+    global COUNT
+
+    if not config.QUEUE_DWELL_RADIUS or len(TAIL) < 2:
+        return
+    (_, first), (last_id, last) = TAIL
+    if last[5] or first[0] is None or last[0] is None or meta[0] is None:
+        return
+    if not first[4] == last[4] == meta[4]:
+        return                                          # BLE tags changed during the stop: both are kept
+    if max(first[3], last[3], meta[3]) >= config.QUEUE_DWELL_SPEED:
+        return
+    if distance(first, last) > config.QUEUE_DWELL_RADIUS or distance(first, meta) > config.QUEUE_DWELL_RADIUS:
+        return
+
+    DB.execute("DELETE FROM packets WHERE id = ?", (last_id,))
+    COUNT -= 1
+    TAIL.pop()
+
+
+def pin_tags_change(meta):
+
+    # The first packet with a new tag set carries the BLE event: pinned, it splits the simplified segments
+    # and the downsampling skips it
+    if meta[0] is None or meta[5] or not TAIL or TAIL[-1][1][0] is None or TAIL[-1][1][4] == meta[4]:
+        return meta
+    return tuple(meta[:5]) + (True,)
+
+
+def simplify_segment():
+
+    # Douglas-Peucker on the rows not simplified yet. The last one stays unsimplified: next segment starts from it
+    global COUNT, UNSIMPLIFIED
+
+    rows = DB.execute("SELECT id, latitude, longitude, pinned FROM packets WHERE simplified = 0 AND utc IS NOT NULL "
+                      "ORDER BY id").fetchall()
+    if len(rows) < 3:
+        return
+
+    keep = [False]*len(rows)
+    start = 0
+    for index, row in enumerate(rows):
+        if row[3] or index == len(rows)-1:             # Pinned rows split the segment
+            douglas_peucker(rows, start, index, keep)
+            start = index
+
+    dropped = [row[0] for row, kept in zip(rows, keep) if not kept]
+    for chunk in range(0, len(dropped), 500):
+        ids = dropped[chunk:chunk+500]
+        DB.execute("DELETE FROM packets WHERE id IN ("+",".join("?"*len(ids))+")", ids)
+    DB.execute("UPDATE packets SET simplified = 1 WHERE simplified = 0 AND utc IS NOT NULL AND id < ?", (rows[-1][0],))
+    COUNT -= len(dropped)
+    UNSIMPLIFIED = 1
+    if dropped:
+        reload_tail()
+
+
+def douglas_peucker(rows, first, last, keep):
+
+    # Iterative: segments can be long after days out of coverage
+    keep[first] = keep[last] = True
+    stack = [(first, last)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        origin = rows[first]
+        end = project(origin, rows[last])
+        farthest, max_distance = None, config.QUEUE_SIMPLIFY_TOLERANCE
+        for index in range(first+1, last):
+            point_distance = segment_distance(project(origin, rows[index]), end)
+            if point_distance > max_distance:
+                farthest, max_distance = index, point_distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+
+def downsample():
+
+    # Packets older than QUEUE_DOWNSAMPLE_AGE: the first of each QUEUE_DOWNSAMPLE_PERIOD seconds is kept
+    global COUNT, DOWNSAMPLED_UTC
+
+    cutoff = NEWEST_UTC - config.QUEUE_DOWNSAMPLE_AGE
+    if cutoff < DOWNSAMPLED_UTC + config.QUEUE_DOWNSAMPLE_PERIOD:
+        return
+    period = config.QUEUE_DOWNSAMPLE_PERIOD
+    start = DOWNSAMPLED_UTC - DOWNSAMPLED_UTC % period            # The last bucket may be partial
+    dropped = DB.execute("DELETE FROM packets WHERE pinned = 0 AND utc >= ? AND utc < ? AND id NOT IN "
+                         "(SELECT MIN(id) FROM packets WHERE utc >= ? AND utc < ? GROUP BY utc / ?)",
+                         (start, cutoff, start, cutoff, period)).rowcount
+    COUNT -= dropped
+    DOWNSAMPLED_UTC = cutoff
+    if dropped:
+        reload_tail()
+        LOGGER.info("> Packet store over "+str(config.QUEUE_DOWNSAMPLE_SIZE)+": downsampled "+str(dropped)+" old packets")
+
+
+def project(origin, point):
+
+    # Local plane in meters around origin (equirectangular, fine at the scale of a segment)
+    return ((point[2]-origin[2])*math.cos(math.radians(origin[1]))*math.pi/180*EARTH_RADIUS,
+            (point[1]-origin[1])*math.pi/180*EARTH_RADIUS)
+
+
+def segment_distance(point, end):
+
+    # Distance of point from the segment (0,0)-end
+    length = end[0]*end[0] + end[1]*end[1]
+    if length == 0:
+        return math.hypot(point[0], point[1])
+    ratio = max(0, min(1, (point[0]*end[0] + point[1]*end[1])/length))
+    return math.hypot(point[0]-ratio*end[0], point[1]-ratio*end[1])
+
+
+def distance(first, second):
+
+    # meta tuples: (utc, latitude, longitude, ...)
+    return math.hypot(*project(first, second))
+
+#---------------------------------------------------------------------------
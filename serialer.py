@@ -1,20 +1,190 @@
 #!/usr/bin/env python3
 
-import time
+import threading, time, re
+from collections import deque
+from functools import lru_cache
 from serial import Serial
 from serial import SerialException
 from serial import SerialTimeoutException
 
-import config
+import config, support
 
 ############################################################################
 ####                   GLOBAL VARIABLES AND CONSTANTS                   ####
 ############################################################################
 
+LOGGER = support.CustomLogger("ser")     # Needed before any init: the reader thread dispatches URCs
+
 SERIAL_PORT = None
 
 SERIAL_TIMEOUT_HIST = 0b0000000              # 0 -> no timeout, 1 -> timeout
 
+SERIAL_RX_BUFFER = bytearray()              # Single receive buffer: bytes read from the port and not yet framed
+SERIAL_RX_CONDITION = threading.Condition() # Guards SERIAL_RX_BUFFER and signals new bytes from the reader thread
+SERIAL_LOCK = threading.RLock()             # One AT transaction (write + response) at a time
+SERIAL_BUSY = False                         # A command is waiting for its response: the reader must not drop lines
+
+SERIAL_READER = None
+stop_serial_reader = threading.Event()
+
+MODEM_DATA_MODE = False                     # Modem in transparent data mode: AT commands need the "+++" escape first
+ESCAPE_GUARD_TIME = 1.001                   # Silence required before "+++"
+ESCAPE_TIMEOUT = 2                          # Seconds for the OK to "+++"
+T_LAST_TX = 0                               # Last write to the port
+
+URC_HANDLERS = {}                           # Unsolicited result code prefix -> list of callbacks
+ESCAPE_HANDLERS = []                        # Callbacks run after each escape from the data mode (they may send AT commands)
+URC_LINES = deque()                         # URCs framed and not dispatched yet
+
+SERIAL_RX_BYTES = 0                         # Total bytes read from the port
+COMMAND_STATS = {}                          # AT verb -> CommandStats
+STATS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)  # Latency histogram upper bounds [s] (+ overflow bucket)
+VERB_REGEX = re.compile(r"\+([A-Z]+)")
+
+ADAPTIVE_TIMEOUTS = True
+ADAPTIVE_MIN_SAMPLES = 10                   # Successful samples needed before the learned deadline is used
+ADAPTIVE_MARGIN = 3                         # Deadline = p95 of the recent latencies * margin (+ 0.5 s)
+ADAPTIVE_MAX_BACKOFF = 64                   # Each timeout doubles the learned deadline (up to the caller's timeout)
+TIMEOUT_FLOORS = {                          # Network bound commands: the modem waits for the network, not for us
+    "CIPSTART": 160,
+    "CIPPING": 15,
+    "CIICR": 15,
+    "CIPSHUT": 15,
+    "HTTPACTION": 30,
+    "HTTPREAD": 15,
+}
+TIMEOUT_CEILINGS = {                        # Upper bounds tighter than the caller's timeout
+    "CGNSINF": 5,
+    "COPS;CSQ;CREG": 5,
+    "CSQ": 5,
+    "CREG": 5,
+}
+DEFAULT_TIMEOUT_FLOOR = 1
+
+############################################################################
+####                               CLASSES                              ####
+############################################################################
+
+class ResponseFramer():
+
+    # Frames an AT response directly on the bytes of the receive buffer: every line is scanned
+    # only once for the final result codes and the response is decoded once when it's complete.
+    # The framed text is the same of the old line-by-line reader ("line1 line2 ... OK").
+
+    def __init__(self, exit_word = "OK", cmd = "", partial = True):
+        self.exit_word = exit_word.encode("utf-8")
+        if isinstance(cmd, str):
+            cmd = cmd.encode("utf-8")
+        self.cmd = bytes(cmd)
+        self.partial = partial      # Accept a line without \n made only of the exit word (e.g. the "> " prompt)
+        self.lines = []
+        self.scan_pos = 0           # Start of the first line not framed yet
+        self.search_pos = 0         # Where to resume the search of the next \n
+        self.done = False
+        self.error = False
+        self.deact = False
+
+    def add_line(self, line):
+        if self.cmd and self.cmd in line:   # Command echo
+            return
+        if b"+PDP: DEACT" in line:
+            self.deact = True
+        if match_urc(line, self.cmd):       # URC landed inside the response
+            URC_LINES.append(line)
+            return
+        self.lines.append(line)
+        if self.exit_word in line:
+            self.done = True
+        if b"ERROR" in line:                # ERROR, +CME ERROR, +CMS ERROR
+            self.done = True
+            self.error = True
+
+    def feed(self, buffer):
+        end = buffer.find(b"\n", max(self.search_pos, self.scan_pos))
+        while end != -1 and not self.done:
+            self.add_line(bytes(buffer[self.scan_pos:end]).strip())
+            self.scan_pos = end+1
+            end = buffer.find(b"\n", self.scan_pos)
+        self.search_pos = len(buffer)
+        if not self.done and self.partial and 0 < len(buffer)-self.scan_pos <= len(self.exit_word)+2:
+            tail = bytes(buffer[self.scan_pos:]).strip()
+            if tail == self.exit_word:
+                self.add_line(tail)
+                self.scan_pos = len(buffer)
+        return self.done
+
+    def flush(self, buffer):
+        # Frame also the last incomplete line (used on timeout)
+        if self.scan_pos < len(buffer):
+            self.add_line(bytes(buffer[self.scan_pos:]).strip())
+            self.scan_pos = len(buffer)
+            self.search_pos = len(buffer)
+
+    def consume(self, buffer):
+        # Drop the framed bytes from the receive buffer, leaving what arrived after the response
+        del buffer[:self.scan_pos]
+        self.scan_pos = 0
+        self.search_pos = 0
+
+    def text(self):
+        return b" ".join(self.lines).decode("utf-8", errors="replace")
+
+class CommandStats():
+
+    # Counters of one AT verb: cheap enough to be updated on every command
+
+    __slots__ = ("count", "errors", "timeouts", "slow", "bytes_in", "bytes_out", "total", "max", "hist", "recent", "backoff")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.slow = 0               # Timeouts with the modem still answering to AT
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0]*(len(STATS_BUCKETS)+1)
+        self.recent = deque(maxlen=32)      # Latencies of the last successful commands
+        self.backoff = 1                    # Learned deadline multiplier: timeouts add no sample, they widen it
+
+    def record(self, latency, bytes_in, bytes_out, timeout = False, error = False):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        if timeout:
+            self.timeouts += 1
+            self.backoff = min(self.backoff*2, ADAPTIVE_MAX_BACKOFF)
+        elif error:
+            self.errors += 1
+        else:
+            self.recent.append(latency)
+            self.backoff = max(1, self.backoff/2)     # Back to the learned deadline as the slow samples come in
+        index = 0
+        while index < len(STATS_BUCKETS) and latency > STATS_BUCKETS[index]:
+            index += 1
+        self.hist[index] += 1
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested fraction of the samples
+        target = fraction*self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.hist):
+            seen += bucket_count
+            if seen >= target and bucket_count:
+                return STATS_BUCKETS[index] if index < len(STATS_BUCKETS) else self.max
+        return self.max
+
+    def print_status(self, verb):
+        if not self.count:
+            return verb+" n=0"
+        return (verb+" n="+str(self.count)+" err="+str(self.errors)+" to="+str(self.timeouts)
+                +" avg="+str(round(self.total/self.count, 3))+"s p50<="+str(self.percentile(0.5))+"s p90<="+str(self.percentile(0.9))
+                +"s max="+str(round(self.max, 3))+"s slow="+str(self.slow)+" deadline="+str(round(learned_deadline(self), 2))+"s in="+str(self.bytes_in)+"B out="+str(self.bytes_out)+"B hist="+str(self.hist))
+
 #########################################################################################################
 ####                                     Serial Debug Functions                                      ####
 #########################################################################################################
@@ -39,9 +209,237 @@ def check_history():
     return False
 
 
-#def unsolicited_result_codes_handler(serial_out):
-# TODO: Handle unsolicited result codes
+@lru_cache(maxsize=256)
+def command_verb(cmd):
+
+    # "AT+CGNSINF" -> CGNSINF, "AT+COPS?;+CSQ;+CREG?" -> COPS;CSQ;CREG, "ATO" -> ATO, "+++" -> +++
+    if cmd == "+++":
+        return cmd
+    if not isinstance(cmd, str) or not cmd.startswith("AT"):
+        return "DATA"
+    verbs = VERB_REGEX.findall(cmd.split("=")[0])
+    if verbs:
+        return ";".join(verbs)
+    return cmd
+
+
+def update_command_stats(cmd, latency, bytes_in, bytes_out, timeout = False, error = False):
+
+    verb = command_verb(cmd)
+    stats = COMMAND_STATS.get(verb)
+    if stats is None:
+        stats = COMMAND_STATS[verb] = CommandStats()
+    stats.record(latency, bytes_in, bytes_out, timeout, error)
+
+    return
+
+
+def command_stats_report():
+
+    # Slowest verbs (by total time spent on the UART) first
+    ranking = sorted(COMMAND_STATS.items(), key=lambda item: item[1].total, reverse=True)
+    return [stats.print_status(verb) for verb, stats in ranking]
+
+
+def learned_deadline(stats):
+
+    # A modem slower than the deadline only times out: the backoff lets the next calls wait long enough
+    # to succeed and bring the slower latencies into the samples
+    recent = sorted(stats.recent)
+    if len(recent) < ADAPTIVE_MIN_SAMPLES:
+        return 0
+    return (recent[int(0.95*(len(recent)-1))]*ADAPTIVE_MARGIN + 0.5)*stats.backoff
+
+
+def adaptive_timeout(cmd, timeout):
+
+    # Deadline learned from the recent latencies of the verb, bounded by its floor and ceiling
+    # (the caller's timeout is always the hardest ceiling)
+    if not ADAPTIVE_TIMEOUTS:
+        return timeout
+    verb = command_verb(cmd)
+    ceiling = min(timeout, TIMEOUT_CEILINGS.get(verb, timeout))
+    floor = min(ceiling, TIMEOUT_FLOORS.get(verb, DEFAULT_TIMEOUT_FLOOR))
+    stats = COMMAND_STATS.get(verb)
+    deadline = learned_deadline(stats) if stats is not None else 0
+    if not deadline:
+        return ceiling
+    return max(floor, min(ceiling, deadline))
+
+
+def reset_command_stats():
+
+    COMMAND_STATS.clear()
+
+    return
+
+
+#########################################################################################################
+####                                       Modem Mode Functions                                      ####
+#########################################################################################################
+
+    ########################### MODEM MODE STATE MACHINE ###########################
+    #                                                                              #
+    #   COMMAND --(ATO / CIPSTART transparent: CONNECT)--> DATA                    #
+    #   DATA --(guard, "+++", guard: OK)--> COMMAND                                #
+    #   DATA --(CLOSED / +PDP: DEACT)--> COMMAND                                   #
+    #                                                                              #
+    #   Any AT command requested while in DATA escapes to COMMAND first, so the    #
+    #   data session can stay open while packets are flowing.                      #
+    ################################################################################
+
+def set_data_mode(active):
+
+    global MODEM_DATA_MODE
 
+    MODEM_DATA_MODE = active
+
+    return
+
+
+def data_mode_active():
+    return MODEM_DATA_MODE
+
+
+def data_mode_idle():
+
+    # Seconds since the last write while in data mode
+    if not MODEM_DATA_MODE:
+        return 0
+    return time.time()-T_LAST_TX
+
+
+def escape_data_mode():
+
+    with SERIAL_LOCK:
+        # Wait only what's left of the guard time since the last write
+        guard = ESCAPE_GUARD_TIME-(time.time()-T_LAST_TX)
+        if guard > 0:
+            time.sleep(guard)
+        try:
+            serial_command("+++", escape_char="", timeout=ESCAPE_TIMEOUT)
+        finally:
+            # On failure the mode is unknown: the next command (or the M2 recovery) will tell
+            set_data_mode(False)
+        run_escape_handlers()
+
+    return
+
+
+def register_escape_handler(callback):
+
+    # Callbacks run with SERIAL_LOCK held, in command mode: what needs the command mode rides on escapes already paid
+    ESCAPE_HANDLERS.append(callback)
+
+    return
+
+
+def run_escape_handlers():
+
+    for callback in ESCAPE_HANDLERS:
+        try:
+            callback()
+        except Exception as e:
+            LOGGER.error(">> Escape handler failed: "+str(e))
+            LOGGER.exception(e)
+
+    return
+
+
+#########################################################################################################
+####                                 Unsolicited Result Codes Functions                              ####
+#########################################################################################################
+
+def register_urc_handler(prefix, callback):
+
+    # Callbacks receive the URC line (str) from the reader thread: they must be quick and must not send AT commands
+    URC_HANDLERS.setdefault(prefix.encode("utf-8"), []).append(callback)
+
+    return
+
+
+def match_urc(line, cmd = b""):
+
+    for prefix in URC_HANDLERS:
+        if line.startswith(prefix):
+            if prefix.strip(b"+: ") in cmd:     # It's the answer to the command (e.g. +CPIN: to AT+CPIN?)
+                return False
+            return True
+    return False
+
+
+def frame_urc_lines(buffer):
+
+    # Outside of a command every complete line is either a URC or a stray/late response to drop
+    end = buffer.find(b"\n")
+    while end != -1:
+        line = bytes(buffer[:end]).strip()
+        del buffer[:end+1]
+        if match_urc(line):
+            URC_LINES.append(line)
+        end = buffer.find(b"\n")
+
+    return
+
+
+def dispatch_urcs():
+
+    # Called by the reader thread and by the command callers: each line is taken (atomically) by one of them
+    while True:
+        try:
+            line = URC_LINES.popleft()
+        except IndexError:
+            break
+        for prefix, callbacks in URC_HANDLERS.items():
+            if line.startswith(prefix):
+                for callback in callbacks:
+                    try:
+                        callback(line.decode("utf-8", errors="replace"))
+                    except Exception as e:
+                        LOGGER.error(">> URC handler failed on "+line.decode("utf-8", errors="replace")+": "+str(e))
+                        LOGGER.exception(e)
+
+    return
+
+
+def serial_reader_thread():
+
+    global SERIAL_RX_BYTES
+
+    while not stop_serial_reader.is_set():
+        port = SERIAL_PORT
+        try:
+            data = port.read(max(port.in_waiting, 1))
+        except Exception as e:
+            # Port not opened yet or being replaced by init_serial_object
+            time.sleep(0.1)
+            continue
+
+        if data:
+            with SERIAL_RX_CONDITION:
+                SERIAL_RX_BUFFER.extend(data)
+                SERIAL_RX_BYTES += len(data)
+                if not SERIAL_BUSY:
+                    frame_urc_lines(SERIAL_RX_BUFFER)
+                SERIAL_RX_CONDITION.notify_all()
+            dispatch_urcs()
+    else:
+        stop_serial_reader.clear()
+
+
+def start_serial_reader():
+
+    global SERIAL_READER
+
+    if not serial_reader_running():
+        SERIAL_READER = threading.Thread(target=serial_reader_thread, daemon=True)
+        SERIAL_READER.start()
+
+    return
+
+
+def serial_reader_running():
+    return SERIAL_READER is not None and SERIAL_READER.is_alive()
 
 
 #########################################################################################################
@@ -52,6 +450,11 @@ def init_serial_object(path, baud = 38400, timeout = 5): # After a test we know
 
     global SERIAL_PORT
 
+    if SERIAL_PORT is not None and SERIAL_PORT.is_open:
+        SERIAL_PORT.close()
+    with SERIAL_RX_CONDITION:
+        del SERIAL_RX_BUFFER[:]
+
     SERIAL_PORT = Serial(path, baudrate=baud, timeout=float(timeout))# rtscts=True, dsrdtr=True)
     SERIAL_PORT.write("A\r".encode("utf-8"))
     
@@ -73,126 +476,182 @@ def write_to_serial(cmd, escape_char = "\r"):
     else:
         cmd_encoded = cmd
 
-    SERIAL_PORT.write(cmd_encoded)
+    global T_LAST_TX
+
+    with SERIAL_LOCK:
+        SERIAL_PORT.write(cmd_encoded)
+        T_LAST_TX = time.time()
     
-    return
+    return len(cmd_encoded)
 
 
-def listen_to_serial(exit_word = "OK", timeout = 15, cmd = ""):
+def read_serial_chunk(size = 0):
 
-    decoded_full_serial_out = ""
+    global SERIAL_RX_BYTES
 
-    t_start = time.time()
-    t_now = time.time()
-    while exit_word not in decoded_full_serial_out and "ERROR" not in decoded_full_serial_out and (t_now-t_start)<timeout:
-        line = SERIAL_PORT.read_until()
+    # Block for the first byte (up to the port timeout), then take everything already waiting
+    data = SERIAL_PORT.read(max(size, SERIAL_PORT.in_waiting, 1))
+    SERIAL_RX_BUFFER.extend(data)
+    SERIAL_RX_BYTES += len(data)
 
-        line_decoded = str(line.decode("utf-8").split("\n")[0].strip())
+    return len(data)
 
-        if cmd:
-            if cmd not in line_decoded:
-                if decoded_full_serial_out:
-                    decoded_full_serial_out += " "
-                decoded_full_serial_out += line_decoded
-        else:
-            if decoded_full_serial_out:
-                decoded_full_serial_out += " "
-            decoded_full_serial_out += line_decoded
-        
+
+def wait_for_serial(step, timeout, size = 0):
+
+    # Run step on the receive buffer until it returns True: the bytes come from the reader thread
+    # when it's running, otherwise they're read from the port here. size is the buffer length to reach
+    # for raw reads (so that no byte after it is read).
+    t_start = time.time()
+
+    if serial_reader_running():
+        with SERIAL_RX_CONDITION:
+            done = step(SERIAL_RX_BUFFER)
+            while not done and (time.time()-t_start)<timeout:
+                SERIAL_RX_CONDITION.wait(timeout-(time.time()-t_start))
+                done = step(SERIAL_RX_BUFFER)
+        return done
+
+    t_now = t_start
+    done = step(SERIAL_RX_BUFFER)
+    while not done and (t_now-t_start)<timeout:
+        read_serial_chunk(max(0, size-len(SERIAL_RX_BUFFER)))
         t_now = time.time()
+        done = step(SERIAL_RX_BUFFER)
+
+    return done
+
+
+def listen_to_serial(exit_word = "OK", timeout = 15, cmd = ""):
+
+    framer = ResponseFramer(exit_word, cmd)
+
+    wait_for_serial(framer.feed, timeout)
+
+    with SERIAL_RX_CONDITION:
+        if not framer.done:
+            framer.flush(SERIAL_RX_BUFFER)
+        framer.consume(SERIAL_RX_BUFFER)
+    decoded_full_serial_out = framer.text()
 
-    if "+PDP: DEACT" in decoded_full_serial_out:
-        raise SerialException("Network disconnection registered: "+cmd+" "+decoded_full_serial_out)
+    if framer.deact:
+        raise SerialException("Network disconnection registered: "+str(cmd)+" "+decoded_full_serial_out)
 
-    if (t_now-t_start)>=timeout:
-        raise SerialTimeoutException("Modem serial external timeout: "+cmd+" "+decoded_full_serial_out)
+    if not framer.done:
+        raise SerialTimeoutException("Modem serial external timeout: "+str(cmd)+" "+decoded_full_serial_out)
 
-    if "ERROR" in decoded_full_serial_out:
-        raise SerialException("Error on command: "+cmd+" "+decoded_full_serial_out)
+    if framer.error:
+        raise SerialException("Error on command: "+str(cmd)+" "+decoded_full_serial_out)
     
     return decoded_full_serial_out
 
 
 def read_binary_get_serial_output(size, timeout = 15, cmd = ""):
 
-    decoded_full_serial_out = ""
+    # Reading the first rows containing the command and the initial response (not past the header line)
+    framer = ResponseFramer(str(size), cmd, partial=False)
 
-    t_start = time.time()
-    t_now = time.time()
-    # Reading the first two rows containing the command and the initial response
-    while str(size) not in decoded_full_serial_out and "ERROR" not in decoded_full_serial_out and (t_now-t_start)<(timeout/2):
-        line = SERIAL_PORT.read_until()
-
-        line_decoded = str(line.decode("utf-8").split("\n")[0].strip())
-
-        if cmd:
-            if cmd not in line_decoded:
-                if decoded_full_serial_out:
-                    decoded_full_serial_out += " "
-                decoded_full_serial_out += line_decoded
-        else:
-            if decoded_full_serial_out:
-                decoded_full_serial_out += " "
-            decoded_full_serial_out += line_decoded
-        
-        t_now = time.time()
+    wait_for_serial(framer.feed, timeout/2)
 
-    if "+PDP: DEACT" in decoded_full_serial_out:
-        raise SerialException("Network disconnection registered: "+cmd+" "+decoded_full_serial_out)
+    with SERIAL_RX_CONDITION:
+        framer.consume(SERIAL_RX_BUFFER)
+    decoded_full_serial_out = framer.text()
 
-    if (t_now-t_start)>=timeout:
-        raise SerialTimeoutException("Modem serial external timeout: "+cmd+" "+decoded_full_serial_out)
+    if framer.deact:
+        raise SerialException("Network disconnection registered: "+str(cmd)+" "+decoded_full_serial_out)
 
-    if "ERROR" in decoded_full_serial_out or str(size) not in decoded_full_serial_out:
-        raise SerialException("Error on command: "+cmd+" "+decoded_full_serial_out)
+    if not framer.done:
+        raise SerialTimeoutException("Modem serial external timeout: "+str(cmd)+" "+decoded_full_serial_out)
+
+    if framer.error:
+        raise SerialException("Error on command: "+str(cmd)+" "+decoded_full_serial_out)
 
     # Reading the actual bytes of the downloaded file
-    bytes_line = SERIAL_PORT.read(size)
+    if not wait_for_serial(lambda buffer: len(buffer) >= size, timeout/2, size):
+        raise SerialTimeoutException("Modem serial external timeout: "+str(cmd)+" read "+str(len(SERIAL_RX_BUFFER))+"/"+str(size)+" bytes")
 
-    decoded_full_serial_out = ""
+    with SERIAL_RX_CONDITION:
+        bytes_line = bytes(SERIAL_RX_BUFFER[:size])
+        del SERIAL_RX_BUFFER[:size]
 
-    t_start = time.time()
-    t_now = time.time()
     # Reading the rest of the command left on the serial port (it should be a \n and an OK\n)
-    while "OK" not in decoded_full_serial_out and "ERROR" not in decoded_full_serial_out and (t_now-t_start)<(timeout/2):
-        line = SERIAL_PORT.read_until()
+    framer = ResponseFramer("OK")
 
-        line_decoded = str(line.decode("utf-8").split("\n")[0].strip())
+    wait_for_serial(framer.feed, timeout/2)
 
-        if decoded_full_serial_out:
-            decoded_full_serial_out += " "
-        decoded_full_serial_out += line_decoded
-        
-        t_now = time.time()
+    with SERIAL_RX_CONDITION:
+        if not framer.done:
+            framer.flush(SERIAL_RX_BUFFER)
+        framer.consume(SERIAL_RX_BUFFER)
+    decoded_full_serial_out = framer.text()
 
-    if "+PDP: DEACT" in decoded_full_serial_out:
-        raise SerialException("Network disconnection registered: "+cmd+" "+decoded_full_serial_out)
+    if framer.deact:
+        raise SerialException("Network disconnection registered: "+str(cmd)+" "+decoded_full_serial_out)
 
-    if "OK" not in decoded_full_serial_out:
-        raise SerialException("Error on command: "+cmd+" "+decoded_full_serial_out)
+    if not framer.done or framer.error:
+        raise SerialException("Error on command: "+str(cmd)+" "+decoded_full_serial_out)
 
     return bytes_line
 
 
-def serial_command(cmd, exit_word = "OK", timeout = 15, escape_char = "\r", binary = False, size = False):
+def modem_responsive(timeout = 1):
 
-    write_to_serial(cmd, escape_char)
+    # Bare AT probe used after a timeout (it also swallows the late answer of the timed out command)
     try:
-        if not binary:
-            out = listen_to_serial(exit_word=exit_word, timeout=timeout, cmd=cmd)
-        else:
-            out = read_binary_get_serial_output(size, timeout, cmd)
-
-        update_history(False)
-        return out
-    
+        write_to_serial("AT")
+        listen_to_serial(timeout=timeout, cmd="AT")
+        return True
     except SerialTimeoutException as e:
-        update_history(True)
-    
-        if check_history():
-            config.thread_comm("M1ser")
-
-        raise e
-    
+        return False
     except Exception as e:
-        raise e
\ No newline at end of file
+        return True     # ERROR or +PDP: DEACT: it's answering anyway
+
+
+def serial_command(cmd, exit_word = "OK", timeout = 15, escape_char = "\r", binary = False, size = False):
+
+    global SERIAL_BUSY
+
+    with SERIAL_LOCK:
+        if MODEM_DATA_MODE and cmd != "+++":
+            escape_data_mode()
+
+        SERIAL_BUSY = True
+        rx_bytes_start = SERIAL_RX_BYTES
+        bytes_out = 0
+        t_start = time.time()
+        try:
+            bytes_out = write_to_serial(cmd, escape_char)
+            if not binary:
+                out = listen_to_serial(exit_word=exit_word, timeout=adaptive_timeout(cmd, timeout), cmd=cmd)
+            else:
+                out = read_binary_get_serial_output(size, timeout, cmd)
+
+            update_history(False)
+            update_command_stats(cmd, time.time()-t_start, SERIAL_RX_BYTES-rx_bytes_start, bytes_out)
+            return out
+        
+        except SerialTimeoutException as e:
+            update_command_stats(cmd, time.time()-t_start, SERIAL_RX_BYTES-rx_bytes_start, bytes_out, timeout=True)
+
+            # A slow modem still answers to AT: only a dead one counts toward the hardware reset
+            if command_verb(cmd) not in ("+++", "ATO", "DATA") and modem_responsive():
+                COMMAND_STATS[command_verb(cmd)].slow += 1
+                update_history(False)
+            else:
+                update_history(True)
+        
+            if check_history():
+                config.thread_comm("M1ser")
+
+            raise e
+        
+        except Exception as e:
+            update_command_stats(cmd, time.time()-t_start, SERIAL_RX_BYTES-rx_bytes_start, bytes_out, error=True)
+            raise e
+
+        finally:
+            if serial_reader_running():
+                with SERIAL_RX_CONDITION:
+                    frame_urc_lines(SERIAL_RX_BUFFER)
+            SERIAL_BUSY = False
+            dispatch_urcs()
\ No newline at end of file
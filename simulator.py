@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+
+import os, tty, select, threading, time, random, re, sys
+
+############################################################################
+####                   GLOBAL VARIABLES AND CONSTANTS                   ####
+############################################################################
+
+DEFAULT_LATENCY = 0.02          # Seconds between the end of a command and its response
+GUARD_TIME = 1.0                # Silence required around "+++" to leave the data mode
+TRACK_PERIOD = 1.0              # Seconds spent on each point of the GPS track
+GNSS_FIX_PERIOD = 1.0           # Seconds between two GNSS fixes (the +UGNSINF URC is sent every n fixes)
+
+DEFAULT_TRACK = [               # lat, lon, alt, speed, course
+    (45.464211, 9.191383, 122.4, 0.0, 0.0),
+    (45.464350, 9.191500, 122.5, 18.3, 32.1),
+    (45.464590, 9.191710, 122.5, 27.9, 33.0),
+    (45.464880, 9.191950, 122.6, 35.2, 33.4),
+    (45.465210, 9.192230, 122.8, 36.0, 34.0),
+    (45.465520, 9.192500, 122.8, 21.4, 35.2),
+    (45.465640, 9.192600, 122.9, 0.0, 0.0),
+]
+
+VERB_REGEX = re.compile(r"^AT\+?([A-Z]*)")
+
+############################################################################
+####                               CLASSES                              ####
+############################################################################
+
+class Sim7000Simulator():
+
+    # Scriptable SIM7000E emulator behind a pseudo-terminal: serialer.init_serial_object(sim.path)
+    # opens it as the real /dev/serial0. Only the AT subset used by commander.py is implemented.
+    #
+    # Fault injection (by AT verb, e.g. "CGNSINF", "CIPPING", "O" for ATO):
+    #   latencies[verb] = seconds       per-command response latency
+    #   fail_next(verb, count, error)   answer ERROR/+CME ERROR to the next count commands
+    #   hang_next(verb, count)          never answer the next count commands (serial timeout)
+    #   error_rate                      probability of a random ERROR on any command
+    #   inject_pdp_deact()              network drops the PDP context (+PDP: DEACT)
+    #   inject_urc(line)                write any unsolicited line (RDY, +CPIN: NOT READY, ...)
+
+    def __init__(self, track = None, latency = DEFAULT_LATENCY, track_period = TRACK_PERIOD, guard_time = GUARD_TIME):
+        self.track = track or DEFAULT_TRACK
+        self.track_period = track_period
+        self.latency = latency
+        self.latencies = {}
+        self.guard_time = guard_time
+        self.error_rate = 0.0
+        self.failures = {}
+        self.hangs = {}
+
+        self.http_content = {}          # url -> bytes served by HTTPACTION/HTTPREAD
+        self.sent_packets = []          # Payloads written in transparent data mode
+        self.commands = []              # Log of the received commands
+
+        self.operator = "I TIM"
+        self.access_tech = 7
+        self.csq = 18
+        self.creg = 1
+        self.sim_ready = True
+        self.ping_ok = True
+        self.gps_fix = True
+
+        self.cfun = 1
+        self.cmee = 0
+        self.cops_format = 0
+        self.gps_power = False
+        self.gnss_urc = 0               # AT+CGNSURC=n: +UGNSINF every n fixes (0 = off)
+        self.t_last_gnss_urc = 0
+        self.apn = ""
+        self.ip_state = "IP INITIAL"
+        self.transparent = False
+        self.data_mode = False
+        self.connected = False
+        self.bearer = {}                # cid -> {"state": code, "APN": .., ..}
+        self.http = None                # {"URL": .., "status": .., "body": ..}
+
+        self.path = None
+        self.master = None
+        self.slave = None
+        self.t_start = time.time()
+        self.t_last_rx = 0
+        self.write_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    ############################## PTY HANDLING ##############################
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.t_start = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.path
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(1)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except Exception as e:
+                pass
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.write_lock:
+            os.write(self.master, data)
+
+    def write_later(self, delay, data):
+        timer = threading.Timer(delay, self.write, [data])
+        timer.daemon = True
+        timer.start()
+
+    def run(self):
+        rx = bytearray()
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            self.gnss_urc_tick()
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                time.sleep(0.1)
+                continue
+            t_now = time.time()
+
+            if self.data_mode:
+                if data == b"+++" and (t_now-self.t_last_rx) >= self.guard_time:
+                    self.t_last_rx = t_now
+                    self.escape_data_mode()
+                    continue
+                self.t_last_rx = t_now
+                self.sent_packets.append(bytes(data))
+                continue
+
+            self.t_last_rx = t_now
+            rx.extend(data)
+            end = rx.find(b"\r")
+            while end != -1:
+                cmd = bytes(rx[:end]).decode("utf-8", errors="replace").strip()
+                del rx[:end+1]
+                if cmd:
+                    self.handle(cmd)
+                end = rx.find(b"\r")
+
+    def escape_data_mode(self):
+        # The modem answers only after the trailing guard time with no more data
+        time.sleep(self.guard_time)
+        self.data_mode = False
+        self.write("\r\nOK\r\n")
+
+    ############################# FAULT INJECTION ############################
+
+    def fail_next(self, verb, count = 1, error = "ERROR"):
+        self.failures[verb] = [count, error]
+
+    def hang_next(self, verb, count = 1):
+        self.hangs[verb] = count
+
+    def inject_urc(self, line):
+        self.write("\r\n"+line+"\r\n")
+
+    def inject_pdp_deact(self):
+        self.ip_state = "PDP DEACT"
+        self.connected = False
+        self.data_mode = False
+        for bearer in self.bearer.values():
+            bearer["state"] = 3
+        self.inject_urc("+PDP: DEACT")
+
+    def take_fault(self, faults, verb):
+        fault = faults.get(verb)
+        if fault is None:
+            return None
+        if isinstance(fault, list):
+            fault[0] -= 1
+            if fault[0] <= 0:
+                del faults[verb]
+            return fault[1]
+        faults[verb] -= 1
+        if faults[verb] <= 0:
+            del faults[verb]
+        return True
+
+    ############################# COMMAND PARSER #############################
+
+    def handle(self, cmd):
+        self.commands.append(cmd)
+        self.write(cmd+"\r")                                # Echo (ATE1)
+
+        verb = self.verb(cmd)
+        if self.take_fault(self.hangs, verb):
+            return
+        time.sleep(self.latencies.get(verb, self.latency))
+
+        error = self.take_fault(self.failures, verb)
+        if error is None and self.error_rate and random.random() < self.error_rate:
+            error = "ERROR"
+        if error:
+            self.write("\r\n"+error+"\r\n")
+            return
+
+        # Chained commands: AT+COPS?;+CSQ;+CREG?
+        lines = []
+        for sub_cmd in cmd[2:].split(";"):
+            try:
+                sub_lines = self.execute("AT"+sub_cmd)
+            except Exception as e:
+                self.write("\r\nERROR\r\n")
+                return
+            if sub_lines is None:                           # Response already written by the handler
+                return
+            lines += sub_lines
+        self.write("".join("\r\n"+line+"\r\n" for line in lines)+"\r\nOK\r\n")
+
+    def verb(self, cmd):
+        if cmd == "+++":
+            return "+++"
+        match = VERB_REGEX.match(cmd.upper())
+        if match is None:
+            return ""
+        return match.group(1) or "AT"
+
+    def execute(self, cmd):
+        verb = self.verb(cmd)
+        args = cmd.split("=", 1)[1] if "=" in cmd else ""
+        query = cmd.endswith("?")
+        handler = getattr(self, "at_"+verb.lower(), None)
+        if handler is None:
+            raise ValueError("Unsupported command "+cmd)
+        return handler(args, query)
+
+    ############################## BASIC / SIM ###############################
+
+    def at_at(self, args, query):
+        return []
+
+    def at_o(self, args, query):
+        if self.connected:
+            self.write("\r\nCONNECT\r\n")
+            self.data_mode = True
+        else:
+            self.write("\r\nNO CARRIER\r\n")
+        return None
+
+    def at_cfun(self, args, query):
+        if query:
+            return ["+CFUN: "+str(self.cfun)]
+        self.cfun = int(args.split(",")[0])
+        return []
+
+    def at_cmee(self, args, query):
+        if query:
+            return ["+CMEE: "+str(self.cmee)]
+        self.cmee = int(args)
+        return []
+
+    def at_cnetlight(self, args, query):
+        return []
+
+    def at_cpin(self, args, query):
+        if query:
+            return ["+CPIN: "+("READY" if self.sim_ready else "SIM PIN")]
+        self.sim_ready = True
+        return []
+
+    def at_clck(self, args, query):
+        return []
+
+    ############################### CELLULAR #################################
+
+    def at_cops(self, args, query):
+        if query:
+            if self.creg not in (1, 5):
+                return ["+COPS: 0"]
+            return ["+COPS: 0,"+str(self.cops_format)+",\""+self.operator+"\","+str(self.access_tech)]
+        self.cops_format = int(args.split(",")[1])
+        return []
+
+    def at_creg(self, args, query):
+        return ["+CREG: 0,"+str(self.creg)]
+
+    def at_csq(self, args, query):
+        return ["+CSQ: "+str(self.csq)+",99"]
+
+    def at_cgatt(self, args, query):
+        if query:
+            return ["+CGATT: "+str(int(self.creg in (1, 5)))]
+        return []
+
+    ################################ TCP/UDP #################################
+
+    def at_cstt(self, args, query):
+        if query:
+            return ["+CSTT: \""+self.apn+"\",\"\",\"\""]
+        self.apn = args.split(",")[0].strip("\"")
+        self.ip_state = "IP START"
+        return []
+
+    def at_ciicr(self, args, query):
+        self.ip_state = "IP GPRSACT"
+        return []
+
+    def at_cifsr(self, args, query):
+        self.ip_state = "IP STATUS"
+        self.write("\r\n10.170.33.12\r\n")
+        return None
+
+    def at_cipshut(self, args, query):
+        self.ip_state = "IP INITIAL"
+        self.connected = False
+        self.write("\r\nSHUT OK\r\n")
+        return None
+
+    def at_cipmode(self, args, query):
+        self.transparent = bool(int(args))
+        return []
+
+    def at_cipsendhex(self, args, query):
+        return []
+
+    def at_cipstart(self, args, query):
+        if self.creg not in (1, 5):
+            self.write("\r\nOK\r\n\r\nCONNECT FAIL\r\n")
+            return None
+        self.ip_state = "CONNECT OK"
+        self.connected = True
+        if self.transparent:
+            self.write("\r\nOK\r\n\r\nCONNECT\r\n")
+            self.data_mode = True
+        else:
+            self.write("\r\nOK\r\n\r\nCONNECT OK\r\n")
+        return None
+
+    def at_cipstatus(self, args, query):
+        self.write("\r\nOK\r\n\r\nSTATE: "+self.ip_state+"\r\n")
+        return None
+
+    def at_cipclose(self, args, query):
+        self.connected = False
+        self.ip_state = "UDP CLOSED"
+        self.write("\r\nCLOSE OK\r\n")
+        return None
+
+    def at_cipping(self, args, query):
+        params = args.split(",")
+        server = params[0].strip("\"")
+        retries = int(params[1]) if len(params) > 1 else 4
+        lines = []
+        for reply_id in range(1, retries+1):
+            if self.ping_ok and self.ip_state not in ("IP INITIAL", "PDP DEACT"):
+                lines.append("+CIPPING: "+str(reply_id)+",\""+server+"\",6,52")
+            else:
+                lines.append("+CIPPING: "+str(reply_id)+",\""+server+"\",60000,255")
+        return lines
+
+    ################################# BEARER #################################
+
+    def at_sapbr(self, args, query):
+        params = args.split(",")
+        cmd_type = int(params[0])
+        cid = int(params[1])
+        bearer = self.bearer.setdefault(cid, {"state": 3, "APN": "", "CONTYPE": "GPRS"})
+        if cmd_type == 0:
+            if bearer["state"] != 1:
+                raise ValueError("Bearer not open")
+            bearer["state"] = 3
+            return []
+        if cmd_type == 1:
+            if self.creg not in (1, 5):
+                raise ValueError("Not registered")
+            bearer["state"] = 1
+            return []
+        if cmd_type == 2:
+            ip = "10.170.33.13" if bearer["state"] == 1 else "0.0.0.0"
+            return ["+SAPBR: "+str(cid)+","+str(bearer["state"])+",\""+ip+"\""]
+        if cmd_type == 3:
+            bearer[params[2].strip("\"")] = params[3].strip("\"")
+            return []
+        return ["+SAPBR: CONTYPE: "+bearer["CONTYPE"]+" APN: "+bearer["APN"]]
+
+    ################################## HTTP ##################################
+
+    def at_httpinit(self, args, query):
+        if self.http is not None:
+            raise ValueError("HTTP already initialized")
+        self.http = {"URL": "", "status": 0, "body": b""}
+        return []
+
+    def at_httpterm(self, args, query):
+        if self.http is None:
+            raise ValueError("HTTP not initialized")
+        self.http = None
+        return []
+
+    def at_httppara(self, args, query):
+        tag, value = args.split(",", 1)
+        self.http[tag.strip("\"")] = value.strip("\"")
+        return []
+
+    def at_httpaction(self, args, query):
+        if self.http is None or not any(bearer["state"] == 1 for bearer in self.bearer.values()):
+            raise ValueError("No bearer")
+        body = self.http_content.get(self.http["URL"])
+        if body is None:
+            self.http["status"], self.http["body"] = 404, b""
+        elif self.http.get("USERDATA", "").startswith("Range: bytes="):
+            start = int(self.http["USERDATA"].split("=")[1].split("-")[0])
+            self.http["status"], self.http["body"] = 206, body[start:]
+        else:
+            self.http["status"], self.http["body"] = 200, body
+        self.write("\r\nOK\r\n")
+        self.write_later(self.latency*5, "\r\n+HTTPACTION: "+args+","+str(self.http["status"])+","+str(len(self.http["body"]))+"\r\n")
+        return None
+
+    def at_httpread(self, args, query):
+        body = self.http["body"]
+        if args:
+            start, length = [int(param) for param in args.split(",")]
+            body = body[start:start+length]
+        self.write(b"\r\n+HTTPREAD: "+str(len(body)).encode("utf-8")+b"\r\n"+body+b"\r\nOK\r\n")
+        return None
+
+    ################################## GNSS ##################################
+
+    def at_cgnspwr(self, args, query):
+        if query:
+            return ["+CGNSPWR: "+str(int(self.gps_power))]
+        self.gps_power = bool(int(args))
+        return []
+
+    def at_cgnsurc(self, args, query):
+        if query:
+            return ["+CGNSURC: "+str(self.gnss_urc)]
+        self.gnss_urc = int(args)
+        self.t_last_gnss_urc = time.time()
+        return []
+
+    def gnss_urc_tick(self):
+        # No URC in data mode: the real modem holds them back until the command mode
+        if not self.gnss_urc or not self.gps_power or self.data_mode:
+            return
+        t_now = time.time()
+        if t_now-self.t_last_gnss_urc >= self.gnss_urc*GNSS_FIX_PERIOD:
+            self.t_last_gnss_urc = t_now
+            self.inject_urc("+UGNSINF: "+self.cgnsinf())
+
+    def at_cgnsinf(self, args, query):
+        return ["+CGNSINF: "+self.cgnsinf()]
+
+    def cgnsinf(self):
+        if not self.gps_power:
+            return "0,,,,,,,,,,,,,,,,,,,,"
+        utc = time.strftime("%Y%m%d%H%M%S", time.gmtime())+".000"
+        if not self.gps_fix:
+            return "1,0,"+utc+",,,,0.00,0.0,0,,,,,,12,0,0,,,,"
+        lat, lon, alt, speed, course = self.track[int((time.time()-self.t_start)/self.track_period) % len(self.track)]
+        return ("1,1,"+utc+",{:.6f},{:.6f},{:.3f},{:.2f},{:.1f},1,,1.1,1.4,0.9,,12,8,3,,38,3.2,5.1").format(lat, lon, alt, speed, course)
+
+############################################################################
+####                              FUNCTIONS                             ####
+############################################################################
+
+def load_track(path):
+
+    # CSV lines: lat,lon,alt,speed,course
+    track = []
+    with open(path, "r") as track_file:
+        for line in track_file:
+            fields = line.strip().split(",")
+            if len(fields) == 5 and not line.startswith("#"):
+                track.append(tuple(float(field) for field in fields))
+    return track
+
+############################################################################
+####                                MAIN                                ####
+############################################################################
+
+def main_simulator():
+
+    track = load_track(sys.argv[1]) if len(sys.argv) > 1 else None
+    sim = Sim7000Simulator(track)
+    print("SIM7000 simulator listening on "+sim.start())
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+    return 0
+
+#---------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    try:
+        main_simulator()
+    except Exception as e:
+        print("main crashed. Error: %s", e)
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
-import threading, time
+import socket, threading, time, signal
 
-import blendler, config, modemdler, networker, packager, support, updater
+import accounter, blendler, config, modemdler, networker, packager, serialer, support, updater
 from modemdler import init_modemdler
 from networker import init_networker
 from updater import init_updater
@@ -46,7 +46,7 @@ COUNTER_M1_FOR_CRASH = 0
 
 log_publisher = threading.Thread(target=support.logger_publisher_thread)
 ble_scanner = threading.Thread(target=blendler.ble_thread)
-queue_sender = threading.Thread(target=packager.queue_exhauster)
+uplink_scheduler = threading.Thread(target=packager.uplink_thread)
 
 ############################################################################
 ####                              FUNCTIONS                             ####
@@ -57,11 +57,13 @@ def init_system():
     global LOGGER
 
     support.set_os_timezone()
-    config.DEVICE_ID = support.bash_cmd("hostname").split()[0]
+    config.DEVICE_ID = socket.gethostname()
     support.setup_logger(config.DEVICE_ID)
     log_publisher.start()
     LOGGER = support.CustomLogger("sup")
+    signal.signal(signal.SIGUSR1, lambda signum, frame: config.serial_stats_dump.set())     # Dump serial stats on demand
 
+    accounter.init_accounter()
     init_networker()
     init_updater()
     init_packager()
@@ -149,9 +151,11 @@ def error_handler():
         config.stop_ble_scanner.set()
         if ble_scanner.is_alive():
             ble_scanner.join()
-        if queue_sender.is_alive():
-            queue_sender.join()
+        config.stop_uplink.set()
+        if uplink_scheduler.is_alive():
+            uplink_scheduler.join()
         packager.packet_queue_dump()
+        accounter.save(force=True)
         blendler.ble_lists_dump()
         if "0" in error_code:
             support.reboot_system()
@@ -167,6 +171,14 @@ def task_coordinator(t_now, t_last_connection_check, t_last_update_check, t_last
     if (t_now-config.T_LAST_TIME_SYNC) > config.TIME_SYNC_TIMER and config.CURRENT_NETWORK_IFACE is not "wlan0":
         config.gps_local_time_sync.set()
 
+    # Set the trigger for the serial statistics dump
+    if (t_now-config.T_LAST_SERIAL_STATS) > config.SERIAL_STATS_TIMER:
+        config.serial_stats_dump.set()
+
+    # Set the trigger for the cellular info refresh
+    if (t_now-config.T_LAST_CELLULAR_INFO) > config.CELLULAR_INFO_TIMER:
+        config.cellular_info_update.set()
+
     # Set the trigger for the network monitor
     if (t_now-t_last_connection_check) > config.CONNECTION_CHECK_TIMER:
         config.connection_check.set()
@@ -183,16 +195,13 @@ def task_coordinator(t_now, t_last_connection_check, t_last_update_check, t_last
     if not config.NOW_MOVING:
         config.stop_ble_scanner.clear()
         config.start_ble_scanner.set()
-        if not packager.packet_lifo_queue_empty():
-            if config.TIME_TO_NEXT_SEND==60:
-                config.start_exhauster.set()
     else:
         config.stop_ble_scanner.set()           
 
 
 def task_starter(t_now, t_last_connection_check, t_last_update_check, t_last_packet_produced):
 
-    global ble_scanner, queue_sender
+    global ble_scanner, uplink_scheduler
     # SECTIONS TO START THE TASKS BASED ON EACH TRIGGER
 
     # Start the ble scanner
@@ -204,7 +213,7 @@ def task_starter(t_now, t_last_connection_check, t_last_update_check, t_last_pac
     
     # Set time from GPS
     if config.gps_local_time_sync.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             gps_timestamp = modemdler.get_gps_time()
             #LOGGER.debug("> "+str(float(gps_timestamp)))
             if gps_timestamp:
@@ -213,9 +222,26 @@ def task_starter(t_now, t_last_connection_check, t_last_update_check, t_last_pac
                 config.T_LAST_TIME_SYNC = t_now
                 config.gps_local_time_sync.clear()
 
+    # Write the per-command serial statistics to the log
+    if config.serial_stats_dump.is_set():
+        LOGGER.info("> Serial stats since "+support.calc_str_time(t_now-config.T_LAST_SERIAL_STATS)+" ago:")
+        for line in serialer.command_stats_report():
+            LOGGER.info(">> "+line)
+        config.T_LAST_SERIAL_STATS = t_now
+        config.serial_stats_dump.clear()
+
+    # Refresh operator and RSSI, whatever the interface in use
+    if config.cellular_info_update.is_set():
+        networker.update_cellular_info()
+        config.T_LAST_CELLULAR_INFO = t_now
+        config.cellular_info_update.clear()
+
+    # Close the GSM data session when no packet is flowing
+    networker.data_session_monitor()
+
     # Start the gsm network
     if config.start_gsm_network.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             if networker.gsm_network_activation():
                 config.start_gsm_network.clear()
             else:
@@ -224,53 +250,51 @@ def task_starter(t_now, t_last_connection_check, t_last_update_check, t_last_pac
 
     # Stop the gsm network
     if config.stop_gsm_network.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             if not networker.gsm_network_deactivation():
                 LOGGER.error(">> Couldn't disconnect GSM connection")
             config.stop_gsm_network.clear()     
 
     # Start the network monitor
     if config.connection_check.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             networker.network_monitor()
             t_last_connection_check = t_now
             config.connection_check.clear()
 
     # Start the update controller (for sim config and firmware)
     if config.start_update_check.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             updater.get_remote_update_info(config.CURRENT_NETWORK_IFACE)
             t_last_update_check = t_now
             config.start_update_check.clear()
 
     # Start the config downloader
     if config.start_config_downloader.is_set():
-        if not queue_sender.is_alive():
+        with config.UPLINK_LOCK:
             updater.get_remote_sim_config(config.CURRENT_NETWORK_IFACE)
             config.start_config_downloader.clear()
     # Start the firmware downloader
     if config.start_firmware_updater.is_set():
-        if not queue_sender.is_alive():
-            updater.download_and_update_firmware(config.CURRENT_NETWORK_IFACE)
-            config.start_firmware_updater.clear()
+        if not (config.DOWNLOAD_FW and networker.defer_to_wlan("Firmware download")):
+            with config.UPLINK_LOCK:
+                updater.download_and_update_firmware(config.CURRENT_NETWORK_IFACE)
+                config.start_firmware_updater.clear()
 
-    # Start the producer
+    # Start the producer (concurrent with the uplink: the packet goes to the scheduler)
     if config.start_producer.is_set():
-        if not queue_sender.is_alive():
-            packet = packager.packet_producer()
+        packet = packager.packet_producer()
 
-            # if packet:
-            #     packager.packet_handler(packet)
-            
-            t_last_packet_produced = t_now
-            config.start_producer.clear()
+        if packet:
+            packager.packet_handler(packet)
+        
+        t_last_packet_produced = t_now
+        config.start_producer.clear()
 
-    # Start the queue exhauster
-    if config.start_exhauster.is_set():
-        if not queue_sender.is_alive():
-            queue_sender = threading.Thread(target=packager.queue_exhauster)
-            queue_sender.start()
-        config.start_exhauster.clear()
+    # Start the uplink scheduler (live packets first, then the queue oldest first)
+    if not uplink_scheduler.is_alive():
+        uplink_scheduler = threading.Thread(target=packager.uplink_thread)
+        uplink_scheduler.start()
 
     return t_last_connection_check, t_last_update_check, t_last_packet_produced
 
@@ -286,6 +310,7 @@ def main_supervisor():
     t_last_packet_produced = time.time()-config.PRODUCE_PACKET_TIMER+5
     t_last_update_check = time.time()-config.UPDATE_CHECK_TIMER+5
     config.T_LAST_TIME_SYNC = time.time()-config.TIME_SYNC_TIMER+1
+    config.T_LAST_SERIAL_STATS = time.time()
     t_last_connection_check = 0
 
     while True:
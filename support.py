@@ -15,6 +15,8 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 LOGGER = False
 
+GPS_HOUR_CACHE = ("", 0)        # Last GPS date and hour (yyyyMMddhh) and its epoch seconds
+
 ############################################################################
 ####                               CLASSES                              ####
 ############################################################################
@@ -181,12 +183,29 @@ def iso_to_timestamp(isodate):
 
 
 def gps_date_to_timestamp(gps_datetime):
-    return (datetime.datetime(int(gps_datetime[0:4]),
-                              int(gps_datetime[4:6]),
-                              int(gps_datetime[6:8]),
-                              int(gps_datetime[8:10]),
-                              int(gps_datetime[10:12]),
-                              int(gps_datetime[12:14])) - datetime.datetime(1970,1,1)).total_seconds()
+
+    # yyyyMMddhhmmss.sss (UTC) -> epoch seconds: the date part is converted once per hour
+    global GPS_HOUR_CACHE
+
+    hour, hour_seconds = GPS_HOUR_CACHE
+    if gps_datetime[0:10] != hour:
+        hour = gps_datetime[0:10]
+        hour_seconds = days_from_civil(int(hour[0:4]), int(hour[4:6]), int(hour[6:8]))*86400 + int(hour[8:10])*3600
+        GPS_HOUR_CACHE = (hour, hour_seconds)
+
+    minutes_seconds = int(gps_datetime[10:14])
+    return hour_seconds + (minutes_seconds//100)*60 + minutes_seconds%100
+
+
+def days_from_civil(year, month, day):
+
+    # Days since 1970-01-01 of a proleptic Gregorian date (H. Hinnant's algorithm)
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era*400
+    day_of_year = (153*(month + (-3 if month > 2 else 9)) + 2)//5 + day-1
+    day_of_era = year_of_era*365 + year_of_era//4 - year_of_era//100 + day_of_year
+    return era*146097 + day_of_era - 719468
 
 
 def debug_print_packet(packet, show_date = True, show_gps = True, show_ble = False):
@@ -194,7 +213,7 @@ def debug_print_packet(packet, show_date = True, show_gps = True, show_ble = Fal
     packet_list = packet.split(";")
     output = packet_list[12] + "_"
     if show_date:
-        output += datetime.datetime.utcfromtimestamp(int(float(packet_list[6]))).strftime('%H:%M:%S')
+        output += time.strftime('%H:%M:%S', time.gmtime(int(float(packet_list[6]))))
     output += " | BLE: "+ str(packet_list[9].count("-"))
     if show_gps:
         output += " | "+packet_list[0]+" "+packet_list[1]+" "+packet_list[3]
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 
-import requests, json, zipfile
+import requests, json, zipfile, os
 from os import path
 from configparser import ConfigParser
 
 from Crypto.Cipher import Salsa20
 
-import config, networker, support
+import accounter, config, networker, support
 
 ############################################################################
 ####                   GLOBAL VARIABLES AND CONSTANTS                   ####
@@ -17,6 +17,8 @@ LOGGER = None
 LAST_SSID = ""
 LAST_PWD = ""
 
+PARTIAL_SAVE_STEP = 64*1024     # Bytes between two sidecar updates on the wlan0 path
+
 ############################################################################
 ####                              FUNCTIONS                             ####
 ############################################################################
@@ -75,26 +77,179 @@ def write_sim_config():
         return False
 
 
-def get_data_from_server(interface, url, timeout = 15, binary = False):
+def get_data_from_server(interface, url, timeout = 15, binary = False, dest = False, traffic_class = "config"):
+
+    if dest:
+        return download_to_file(interface, url, dest, timeout, traffic_class)
+
+    iface = "wlan0" if interface == "wlan0" else "gsm"
+    if not accounter.allowed(iface, traffic_class):
+        LOGGER.warning("> GSM "+traffic_class+" budget used: download postponed")
+        return False
 
-    if interface is not "wlan0":
+    if interface != "wlan0":
         if not networker.bearer_network_activation():
             return False
-        get_out = networker.http_get(url, timeout, binary) 
+        get_out = networker.http_get(url, timeout, binary, traffic_class)      # Counted by networker
         networker.bearer_network_deactivation()
     else:
+        # Streamed to count what was received also when the request fails halfway
+        received = 0
         try:
-            out = requests.get("https://" + url, timeout=timeout, verify=False)
+            out = requests.get("https://" + url, timeout=timeout, verify=False, stream=True)
+            chunks = []
+            for chunk in out.iter_content(networker.HTTP_CHUNK_SIZE):
+                chunks.append(chunk)
+                received += len(chunk)
             if binary:
-                get_out = out.content
+                get_out = b"".join(chunks)
             else:
-                get_out = out.text
+                get_out = b"".join(chunks).decode(out.encoding or "utf-8", errors="replace")
         except Exception as e:
             LOGGER.error(">> Server request error: "+str(e))
-            return False        
+            return False
+        finally:
+            accounter.count_http(iface, traffic_class, received)
     return get_out
 
 
+def download_to_file(interface, url, dest, timeout = 15, traffic_class = "config"):
+
+    # The body is streamed to dest.part, with a dest.part.json sidecar recording url, size and offset
+    # reached: an interrupted download (link drop, reboot, interface switch) resumes from there.
+    # dest is written only when the size is verified.
+    # Over the GSM budget the download doesn't start (the modem fetches the whole body with AT+HTTPACTION,
+    # it can't be paused halfway): the next attempt resumes it, so a failed download is never paid twice.
+    # The bytes are counted by the transfer functions: what HTTPACTION pulled, what requests received
+    part_path = dest+".part"
+    partial = load_partial_download(url, part_path)
+    iface = "wlan0" if interface == "wlan0" else "gsm"
+    if not accounter.allowed(iface, traffic_class):
+        LOGGER.warning("> GSM "+traffic_class+" budget used: download postponed at "+str(partial["offset"])+" bytes")
+        return False
+
+    try:
+        with open(part_path, "ab") as out_file:
+
+            def progress(offset, size):
+                if partial["size"] and size != partial["size"]:
+                    LOGGER.warning("> Remote file changed during the download: restarting")
+                    partial["stale"] = True
+                    return False
+                out_file.flush()
+                os.fsync(out_file.fileno())
+                partial["size"] = size
+                partial["offset"] = offset
+                save_partial_download(part_path, partial)
+                return True
+
+            if partial["offset"]:
+                LOGGER.info("> Resuming download from "+str(partial["offset"])+"/"+str(partial["size"])+" bytes")
+            if interface != "wlan0":
+                if not networker.bearer_network_activation():
+                    return False
+                size = networker.http_get_to_file(url, timeout, out_file, partial["offset"], progress, traffic_class)
+                networker.bearer_network_deactivation()
+            else:
+                size = requests_get_to_file(url, timeout, out_file, partial["offset"], progress, traffic_class)
+
+        if partial.get("stale") or (size and path.getsize(part_path) != size):
+            LOGGER.error(">> Downloaded file size mismatch")
+            remove_partial_download(part_path)
+            return False
+        if not size:
+            return False
+        os.replace(part_path, dest)
+        remove_partial_download(part_path)
+        return True
+
+    except Exception as e:
+        LOGGER.error(">> Server request error: "+str(e))
+        return False
+
+
+def requests_get_to_file(url, timeout, out_file, offset = 0, progress = None, traffic_class = "config"):
+
+    received = {"bytes": 0}
+    try:
+        return requests_stream_to_file(url, timeout, out_file, offset, progress, received)
+    finally:
+        accounter.count_http("wlan0", traffic_class, received["bytes"])
+
+
+def requests_stream_to_file(url, timeout, out_file, offset, progress, received):
+
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes="+str(offset)+"-"
+    out = requests.get("https://" + url, timeout=timeout, verify=False, stream=True, headers=headers)
+
+    if out.status_code == 206:
+        size = int(out.headers["Content-Range"].split("/")[1])
+    elif out.status_code == 200:
+        size = int(out.headers.get("Content-Length", 0))
+        if offset:                  # Range not honoured: start over
+            out_file.truncate(0)
+            offset = 0
+    else:
+        LOGGER.warning(">> GET Request failed: "+str(out.status_code))
+        return False
+
+    if progress and not progress(offset, size):
+        return False
+    last_saved = offset
+    for chunk in out.iter_content(networker.HTTP_CHUNK_SIZE):
+        out_file.write(chunk)
+        offset += len(chunk)
+        received["bytes"] += len(chunk)
+        if progress and offset-last_saved >= PARTIAL_SAVE_STEP:
+            if not progress(offset, size):
+                return False
+            last_saved = offset
+    if progress and not progress(offset, size):
+        return False
+
+    if not size:
+        size = offset
+    elif offset != size:
+        LOGGER.warning(">> GET Request incomplete: "+str(offset)+"/"+str(size))
+        return False
+    return size
+
+
+def load_partial_download(url, part_path):
+
+    partial = {"url": url, "size": 0, "offset": 0}
+    try:
+        if path.exists(part_path+".json") and path.exists(part_path):
+            with open(part_path+".json", "r") as meta_file:
+                saved = json.load(meta_file)
+            if saved["url"] == url and path.getsize(part_path) >= saved["offset"]:
+                partial = saved
+        # Bytes after the recorded offset were never confirmed: drop them
+        with open(part_path, "ab") as part_file:
+            part_file.truncate(partial["offset"])
+    except Exception as e:
+        LOGGER.warning("> Partial download not usable: "+str(e))
+        partial = {"url": url, "size": 0, "offset": 0}
+        remove_partial_download(part_path)
+    return partial
+
+
+def save_partial_download(part_path, partial):
+
+    with open(part_path+".json.tmp", "w") as meta_file:
+        json.dump(partial, meta_file)
+    os.replace(part_path+".json.tmp", part_path+".json")
+
+
+def remove_partial_download(part_path):
+
+    for file_path in (part_path, part_path+".json"):
+        if path.exists(file_path):
+            os.remove(file_path)
+
+
 def get_remote_update_info(interface):
     
     get_out = get_data_from_server(interface, config.DOWN_SERVER_LINK + config.DEVICE_ID)
@@ -134,7 +289,11 @@ def get_remote_sim_config(interface):
     # Get GSM configuration from server
     LOGGER.info("> Update SIM config from server")
 
-    get_out = get_data_from_server(interface, config.CONFIG_DOWN_SERVER_LINK + config.DEVICE_ID, binary=True)
+    get_out = False
+    if get_data_from_server(interface, config.CONFIG_DOWN_SERVER_LINK + config.DEVICE_ID, binary=True, dest=config.BAK_PATH+"sim_config.bin"):
+        with open(config.BAK_PATH+"sim_config.bin", "rb") as config_file:
+            get_out = config_file.read()
+        os.remove(config.BAK_PATH+"sim_config.bin")
 
     if get_out:
         salsa_cipher = Salsa20.new(key=config.SALSA_KEY, nonce=get_out[:8])
@@ -220,16 +379,7 @@ def get_firmware_update(interface):
         # get firmware update from server
         LOGGER.info("> Download firmware update from server")
 
-        get_out = get_data_from_server(interface, config.FIRM_DOWN_SERVER_LINK + config.DEVICE_ID, 60, True)
-        if get_out:
-            try:
-                with open(config.BAK_PATH+config.REMOTE_VERSION+".zip", "wb") as file:
-                    file.write(get_out)
-            except Exception as e:
-                LOGGER.error(">> ZIP saving error")
-                LOGGER.exception(e)
-                return False
-        else:
+        if not get_data_from_server(interface, config.FIRM_DOWN_SERVER_LINK + config.DEVICE_ID, 60, True, config.BAK_PATH+config.REMOTE_VERSION+".zip", "firmware"):
             LOGGER.error(">> No data downloaded")
             return False
     return True